@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+"""
+Measures the performance of the CLI runner using the stub component in mpf_cli_benchmark_stub.py.
+
+The load test starts a component server for the stub component and runs jobs from multiple
+concurrent clients. It reports the latency percentiles, throughput, and peak resident memory of
+the component server and its executor processes. The micro-benchmarks measure converting
+component results to dictionaries, serializing the output in each output format, sorting NDJSON
+tracks, and merging job properties with the component's defaults.
+
+The results are written as JSON so that they can be compared across releases. This must run in an
+image with the Python component SDK installed, in a container where the component server is not
+already running. Component server environment variables, like COMPONENT_SERVER_EXECUTOR_TEMPLATE,
+are passed through to the component server.
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    args = parse_args()
+    # The CLI runner's modules are imported from the directory being benchmarked.
+    sys.path.insert(0, args.cli_runner_dir)
+    sys.path.insert(0, BENCHMARKS_DIR)
+
+    results: Dict[str, Any] = {'metadata': get_metadata(args)}
+    if not args.skip_micro:
+        results['micro_benchmarks'] = run_micro_benchmarks(args)
+    if not args.skip_load:
+        results['load_tests'] = run_load_tests(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f'Wrote results to {args.output}.', file=sys.stderr)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--cli-runner-dir', default=get_default_cli_runner_dir(),
+        help='Directory containing the CLI runner to benchmark. Defaults to the parent of this '
+             'script\'s directory, or /scripts/cli_runner when this script is not in the source '
+             'tree.')
+    parser.add_argument('--output', '-o',
+                        help='Path where the JSON results are written. Defaults to standard out.')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16],
+                        help='Numbers of concurrent clients to run the load test with.')
+    parser.add_argument('--jobs-per-client', type=int, default=50,
+                        help='Number of measured jobs each client runs.')
+    parser.add_argument('--warmup-jobs', type=int, default=2,
+                        help='Number of unmeasured jobs each client runs first.')
+    parser.add_argument(
+        '--client-mode', choices=('connection', 'session', 'process'), default='connection',
+        help='"connection" opens a new connection for each job, like the command line client. '
+             '"session" runs all of a client\'s jobs in a single mpf_cli_client.Session. '
+             '"process" starts a new command line client process for each job, which includes '
+             'the client\'s start up time.')
+    parser.add_argument('--media-type', choices=('image', 'video', 'generic'), default='video')
+    parser.add_argument('--tracks', type=int, default=10,
+                        help='Number of tracks the stub component returns for each job.')
+    parser.add_argument('--detections', type=int, default=10,
+                        help='Number of detections in each video track.')
+    parser.add_argument('--sleep-ms', type=int, default=0,
+                        help='Time the stub component spends on each job.')
+    parser.add_argument('--micro-tracks', type=int, default=2000,
+                        help='Number of video tracks used by the micro-benchmarks.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times each micro-benchmark runs.')
+    parser.add_argument('--skip-micro', action='store_true', help='Skip the micro-benchmarks.')
+    parser.add_argument('--skip-load', action='store_true', help='Skip the load test.')
+    return parser.parse_args()
+
+
+def get_default_cli_runner_dir() -> str:
+    parent_dir = os.path.dirname(BENCHMARKS_DIR)
+    if os.path.exists(os.path.join(parent_dir, 'mpf_cli_client.py')):
+        return parent_dir
+    return '/scripts/cli_runner'
+
+
+def get_metadata(args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        'time': datetime.datetime.now().astimezone().isoformat(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cli_runner_dir': args.cli_runner_dir,
+        'arguments': {k: v for k, v in vars(args).items() if k not in ('output', 'cli_runner_dir')},
+        'component_server_env': {k: v for k, v in os.environ.items()
+                                 if k.startswith(('COMPONENT_SERVER_', 'COMPONENT_MAX_'))},
+    }
+
+
+def run_micro_benchmarks(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    import mpf_cli_benchmark_stub
+    import mpf_cli_job_runner
+    import mpf_cli_output_encoders as encoders
+
+    converter = mpf_cli_job_runner.ComponentResultToDictConverter
+    video_tracks = mpf_cli_benchmark_stub.create_video_tracks(args.micro_tracks, args.detections)
+    image_locations = mpf_cli_benchmark_stub.create_image_locations(args.micro_tracks)
+    num_detections = args.micro_tracks * args.detections
+
+    results = [
+        time_benchmark('convert_video_tracks', args.repeat, num_detections,
+                       lambda: converter.convert(30, 'BENCHMARK', video_tracks)),
+        time_benchmark('convert_image_locations', args.repeat, args.micro_tracks,
+                       lambda: converter.convert(0, 'BENCHMARK', image_locations))
+    ]
+
+    track_dicts = converter.convert(30, 'BENCHMARK', video_tracks)
+    document = {'media': [{'path': '/media/video.mp4', 'output': {
+        'BENCHMARK': [{'tracks': track_dicts}]}}]}
+    for output_format, pretty in (('json', False), ('json', True), ('msgpack', False),
+                                  ('cbor', False)):
+        name = f'serialize_{output_format}' + ('_pretty' if pretty else '')
+        try:
+            results.append(time_benchmark(
+                name, args.repeat, num_detections,
+                lambda: write_to_memory(
+                    lambda out: encoders.write_document(document, output_format, pretty, out))))
+        except RuntimeError as e:
+            # The package for a binary output format is not installed.
+            results.append({'name': name, 'skipped': str(e)})
+
+    results.append(time_benchmark(
+        'serialize_ndjson', args.repeat, num_detections,
+        lambda: write_to_memory(
+            lambda out: out.writelines(encoders.dumps_json(t) + '\n' for t in track_dicts))))
+    results.append(time_benchmark(
+        'sort_ndjson_tracks', args.repeat, args.micro_tracks,
+        lambda: collections.deque(
+            mpf_cli_job_runner.sort_track_lines(iter(track_dicts)), maxlen=0)))
+
+    # A component with a typical number of properties, where each job sets a few of them.
+    num_jobs = 1000
+    property_defaults = {f'PROPERTY_{i}': str(i) for i in range(50)}
+    job_property_defaults = mpf_cli_job_runner.JobPropertyDefaults(os.environ, property_defaults)
+    job_props = {'PROPERTY_10': 'x', 'CONFIDENCE_THRESHOLD': '0.5', 'MIN_SIZE': '10'}
+    results.append(time_benchmark(
+        'merge_job_properties', args.repeat, num_jobs,
+        lambda: [job_property_defaults.overlay(job_props) for _ in range(num_jobs)]))
+    return results
+
+
+def time_benchmark(name: str, repeat: int, num_items: int,
+                   func: Callable[[], Any]) -> Dict[str, Any]:
+    run_times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        run_times.append(time.perf_counter() - start)
+    best_time = min(run_times)
+    benchmark_result = {
+        'name': name,
+        'runs': repeat,
+        'best_s': round(best_time, 6),
+        'median_s': round(statistics.median(run_times), 6),
+        'items': num_items,
+        'items_per_s': round(num_items / best_time, 1) if best_time > 0 else None,
+    }
+    if isinstance(result, int):
+        benchmark_result['output_bytes'] = result
+    return benchmark_result
+
+
+def write_to_memory(write: Callable[[io.TextIOWrapper], Any]) -> int:
+    """ :return: The number of bytes written. """
+    output = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+    write(output)
+    output.flush()
+    return output.buffer.getbuffer().nbytes
+
+
+def run_load_tests(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    with StubComponentServer(args.cli_runner_dir) as server, \
+            tempfile.TemporaryDirectory() as media_dir:
+        job_args = get_job_args(args, media_dir)
+        return [run_load_test(args, server, job_args, n) for n in args.clients]
+
+
+def get_job_args(args: argparse.Namespace, media_dir: str) -> List[str]:
+    # The stub component does not read the media, so it only needs to exist.
+    extension = {'image': 'png', 'video': 'mp4', 'generic': 'txt'}[args.media_type]
+    media_path = os.path.join(media_dir, f'media.{extension}')
+    open(media_path, 'w').close()
+    job_args = [media_path, '-t', args.media_type, '-P', f'NUM_TRACKS={args.tracks}',
+                '-P', f'DETECTIONS_PER_TRACK={args.detections}', '-P', f'SLEEP_MS={args.sleep_ms}']
+    if args.media_type == 'video':
+        job_args.extend(('-M', 'FPS=30'))
+    return job_args
+
+
+def run_load_test(args: argparse.Namespace, server: StubComponentServer, job_args: List[str],
+                  num_clients: int) -> Dict[str, Any]:
+    print(f'Running load test with {num_clients} clients...', file=sys.stderr)
+    run_client = get_client_function(args.client_mode, job_args)
+    barrier = threading.Barrier(num_clients + 1)
+    client_results: List[List[JobMeasurement]] = [[] for _ in range(num_clients)]
+
+    def client_thread(measurements: List[JobMeasurement]) -> None:
+        try:
+            run_client(args.warmup_jobs, [])
+        finally:
+            barrier.wait()
+        run_client(args.jobs_per_client, measurements)
+
+    threads = [threading.Thread(target=client_thread, args=(r,)) for r in client_results]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    with server.measure_peak_rss() as get_peak_rss:
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+
+    measurements = [m for r in client_results for m in r]
+    succeeded = [m for m in measurements if m.exit_code == 0]
+    overheads = [m.latency - m.executor_time for m in succeeded if m.executor_time is not None]
+    return {
+        'clients': num_clients,
+        'client_mode': args.client_mode,
+        'jobs': len(measurements),
+        'failed_jobs': len(measurements) - len(succeeded),
+        'duration_s': round(duration, 3),
+        'throughput_jobs_per_s': round(len(succeeded) / duration, 2),
+        'latency_ms': summarize_ms([m.latency for m in succeeded]),
+        # The time spent outside of the executor process, including connecting, waiting for an
+        # executor process, and receiving the job status.
+        'overhead_ms': summarize_ms(overheads) if overheads else None,
+        'peak_rss_bytes': get_peak_rss(),
+    }
+
+
+class JobMeasurement(NamedTuple):
+    exit_code: int
+    latency: float
+    # The time the executor process spent on the job. Not available when the command line client
+    # is used.
+    executor_time: Optional[float] = None
+
+    @classmethod
+    def from_status(cls, latency: float, status: Dict[str, Any]) -> JobMeasurement:
+        total_ms = status.get('timing', {}).get('total_ms')
+        return cls(status['exit_code'], latency, None if total_ms is None else total_ms / 1000)
+
+
+def get_client_function(client_mode: str, job_args: List[str]) \
+        -> Callable[[int, List[JobMeasurement]], None]:
+    import mpf_cli_client
+    import mpf_cli_runner_util as util
+
+    def run_connection_client(num_jobs: int, measurements: List[JobMeasurement]) -> None:
+        with open(os.devnull, 'r+') as dev_null:
+            fd = dev_null.fileno()
+            for _ in range(num_jobs):
+                start = time.perf_counter()
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(util.SOCKET_ADDRESS)
+                    status, = mpf_cli_client.submit_jobs(
+                        sock, [mpf_cli_client.JobSubmission(['runner', *job_args], fd, fd, fd)])
+                measurements.append(
+                    JobMeasurement.from_status(time.perf_counter() - start, status))
+
+    def run_session_client(num_jobs: int, measurements: List[JobMeasurement]) -> None:
+        with open(os.devnull, 'r+') as dev_null, mpf_cli_client.Session() as session:
+            for _ in range(num_jobs):
+                start = time.perf_counter()
+                result = session.run(job_args, stdout=dev_null, stderr=dev_null)
+                measurements.append(
+                    JobMeasurement.from_status(time.perf_counter() - start, result.status))
+
+    def run_process_client(num_jobs: int, measurements: List[JobMeasurement]) -> None:
+        command = [sys.executable, mpf_cli_client.__file__, *job_args]
+        for _ in range(num_jobs):
+            start = time.perf_counter()
+            proc = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+            measurements.append(JobMeasurement(proc.returncode, time.perf_counter() - start))
+
+    return {'connection': run_connection_client,
+            'session': run_session_client,
+            'process': run_process_client}[client_mode]
+
+
+def summarize_ms(seconds: Sequence[float]) -> Optional[Dict[str, float]]:
+    if not seconds:
+        return None
+    sorted_ms = sorted(s * 1000 for s in seconds)
+    return {
+        'p50': round(percentile(sorted_ms, 50), 3),
+        'p95': round(percentile(sorted_ms, 95), 3),
+        'p99': round(percentile(sorted_ms, 99), 3),
+        'mean': round(statistics.fmean(sorted_ms), 3),
+        'max': round(sorted_ms[-1], 3),
+    }
+
+
+def percentile(sorted_values: Sequence[float], percent: float) -> float:
+    # Nearest-rank method, so the result is always one of the measured values.
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class StubComponentServer(contextlib.AbstractContextManager):
+    """
+    Runs a component server for the stub component using a temporary MPF_HOME. The environment
+    variables are also set in this process, so that clients started by the benchmark use the
+    same configuration.
+    """
+    _DESCRIPTOR = {
+        'componentName': 'BenchmarkStub',
+        'sourceLanguage': 'python',
+        'batchLibrary': 'mpf_cli_benchmark_stub',
+        'algorithm': {
+            'name': 'BENCHMARK_STUB',
+            'trackType': 'BENCHMARK',
+            'providesCollection': {
+                'properties': [
+                    {'name': 'NUM_TRACKS', 'defaultValue': '10'},
+                    {'name': 'DETECTIONS_PER_TRACK', 'defaultValue': '10'},
+                    {'name': 'SLEEP_MS', 'defaultValue': '0'}
+                ]
+            }
+        }
+    }
+
+    def __init__(self, cli_runner_dir: str):
+        import mpf_cli_runner_util as util
+        with contextlib.ExitStack() as exit_stack:
+            with socket.socket(socket.AF_UNIX) as sock:
+                if sock.connect_ex(util.SOCKET_ADDRESS) == 0:
+                    raise RuntimeError(
+                        'A component server is already running. The benchmark must run in a '
+                        'container where the component server has not been started.')
+
+            self._temp_dir = exit_stack.enter_context(tempfile.TemporaryDirectory())
+            self._write_plugin(self._temp_dir)
+            os.environ['MPF_HOME'] = self._temp_dir
+            os.environ['COMPONENT_SERVER_LOG'] = os.path.join(self._temp_dir, 'server.log')
+            os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, (
+                os.path.join(self._temp_dir, 'site'), BENCHMARKS_DIR, cli_runner_dir,
+                os.getenv('PYTHONPATH'))))
+
+            self._process = subprocess.Popen(
+                [sys.executable, os.path.join(cli_runner_dir, 'mpf_cli_server.py')],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            exit_stack.callback(self._stop)
+            self._wait_until_listening(util.SOCKET_ADDRESS)
+            self._exit_stack = exit_stack.pop_all()
+
+
+    def __exit__(self, *exc_details):
+        return self._exit_stack.__exit__(*exc_details)
+
+
+    @contextlib.contextmanager
+    def measure_peak_rss(self) -> Iterator[Callable[[], int]]:
+        """
+        Samples the total resident memory of the component server and all of its descendants
+        until the with block exits.
+        """
+        import mpf_cli_metrics
+        peak_rss = 0
+        stop_event = threading.Event()
+
+        def sample() -> None:
+            nonlocal peak_rss
+            while True:
+                pids = (self._process.pid, *get_descendant_pids(self._process.pid))
+                total = sum(mpf_cli_metrics.get_resident_memory_bytes(p) or 0 for p in pids)
+                peak_rss = max(peak_rss, total)
+                if stop_event.wait(0.05):
+                    return
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        try:
+            yield lambda: peak_rss
+        finally:
+            stop_event.set()
+            sampler.join()
+
+
+    @classmethod
+    def _write_plugin(cls, mpf_home: str) -> None:
+        descriptor_dir = os.path.join(mpf_home, 'plugins', 'BenchmarkStub', 'descriptor')
+        os.makedirs(descriptor_dir)
+        with open(os.path.join(descriptor_dir, 'descriptor.json'), 'w') as f:
+            json.dump(cls._DESCRIPTOR, f)
+
+        # The Python runner finds components using their distribution's entry points.
+        dist_info_dir = os.path.join(mpf_home, 'site', 'mpf_cli_benchmark_stub-1.0.dist-info')
+        os.makedirs(dist_info_dir)
+        with open(os.path.join(dist_info_dir, 'METADATA'), 'w') as f:
+            f.write('Metadata-Version: 2.1\nName: mpf_cli_benchmark_stub\nVersion: 1.0\n')
+        with open(os.path.join(dist_info_dir, 'entry_points.txt'), 'w') as f:
+            f.write('[mpf.exported_component]\n'
+                    'component = mpf_cli_benchmark_stub:BenchmarkStubComponent\n')
+
+
+    def _wait_until_listening(self, address: bytes) -> None:
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f'The component server exited with code '
+                                   f'{self._process.returncode}. See {self._get_log_path()}.')
+            with socket.socket(socket.AF_UNIX) as sock:
+                if sock.connect_ex(address) == 0:
+                    return
+            time.sleep(0.05)
+        raise RuntimeError('Timed out waiting for the component server to start.')
+
+
+    def _stop(self) -> None:
+        descendant_pids = get_descendant_pids(self._process.pid)
+        self._process.terminate()
+        try:
+            self._process.wait(10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        # Executor processes exit once they notice the component server is gone. Wait for them
+        # so that they are not using the temporary MPF_HOME when it is deleted.
+        for _ in range(100):
+            if not any(is_running(p) for p in descendant_pids):
+                break
+            time.sleep(0.05)
+
+
+    def _get_log_path(self) -> str:
+        return os.environ['COMPONENT_SERVER_LOG']
+
+
+def is_running(pid: int) -> bool:
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            # Zombie processes have already exited. When the benchmark runs as pid 1, nothing
+            # reaps the orphaned executor processes.
+            return stat_file.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return False
+
+
+def get_descendant_pids(root_pid: int) -> List[int]:
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat_file:
+                # The process name is in parentheses and may contain spaces.
+                parent_pid = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent_pid, []).append(int(entry))
+
+    descendants = []
+    pending = [root_pid]
+    while pending:
+        pid_children = children.get(pending.pop(), ())
+        descendants.extend(pid_children)
+        pending.extend(pid_children)
+    return descendants
+
+
+if __name__ == '__main__':
+    main()
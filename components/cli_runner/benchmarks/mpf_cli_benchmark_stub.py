@@ -0,0 +1,90 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+"""
+A Python component that returns configurable numbers of tracks without reading the media. Used by
+benchmark_cli_runner.py to measure the overhead of the CLI runner itself.
+
+The number of results is controlled with the NUM_TRACKS and DETECTIONS_PER_TRACK job properties.
+SLEEP_MS can be used to simulate time spent processing the media.
+"""
+
+import random
+import time
+from typing import Any, List, Mapping, Tuple
+
+import mpf_component_api as mpf
+
+
+class BenchmarkStubComponent:
+    def get_detections_from_image(self, image_job: mpf.ImageJob) -> List[mpf.ImageLocation]:
+        num_tracks, _ = _process_job(image_job.job_properties)
+        return create_image_locations(num_tracks)
+
+
+    def get_detections_from_video(self, video_job: mpf.VideoJob) -> List[mpf.VideoTrack]:
+        num_tracks, detections_per_track = _process_job(video_job.job_properties)
+        return create_video_tracks(num_tracks, detections_per_track, max(video_job.start_frame, 0))
+
+
+    def get_detections_from_generic(self, generic_job: mpf.GenericJob) -> List[mpf.GenericTrack]:
+        num_tracks, _ = _process_job(generic_job.job_properties)
+        return [mpf.GenericTrack(0.5 + i / (2 * num_tracks), {'TEXT': f'track {i}'})
+                for i in range(num_tracks)]
+
+
+def create_image_locations(num_locations: int) -> List[mpf.ImageLocation]:
+    # A fixed seed makes the results the same for every run, but not already in sorted order.
+    rand = random.Random(num_locations)
+    return [_create_image_location(rand, i) for i in range(num_locations)]
+
+
+def create_video_tracks(num_tracks: int, detections_per_track: int,
+                        start_frame: int = 0) -> List[mpf.VideoTrack]:
+    rand = random.Random(num_tracks * detections_per_track)
+    tracks = []
+    for i in range(num_tracks):
+        track_start = start_frame + rand.randrange(1000)
+        frame_locations = {track_start + frame: _create_image_location(rand, frame)
+                           for frame in range(detections_per_track)}
+        tracks.append(mpf.VideoTrack(
+            track_start, track_start + max(detections_per_track - 1, 0), rand.random(),
+            frame_locations, {'TRACK_NUMBER': str(i)}))
+    return tracks
+
+
+def _create_image_location(rand: random.Random, index: int) -> mpf.ImageLocation:
+    return mpf.ImageLocation(rand.randrange(1920), rand.randrange(1080), 64, 64, rand.random(),
+                             {'CLASSIFICATION': rand.choice(('face', 'person', 'car')),
+                              'INDEX': str(index)})
+
+
+def _process_job(job_properties: Mapping[str, Any]) -> Tuple[int, int]:
+    sleep_ms = int(job_properties.get('SLEEP_MS', 0))
+    if sleep_ms > 0:
+        time.sleep(sleep_ms / 1000)
+    return (int(job_properties.get('NUM_TRACKS', 10)),
+            int(job_properties.get('DETECTIONS_PER_TRACK', 10)))
@@ -26,13 +26,23 @@
 # limitations under the License.                                            #
 #############################################################################
 
+from __future__ import annotations
+
+import contextlib
 import os
-import pickle
 import socket
 import sys
+import threading
+from typing import Any, Callable, Dict, IO, List, NamedTuple, Optional, Sequence, TYPE_CHECKING, \
+    Union
 
+import mpf_cli_fast_client
+import mpf_cli_protocol as protocol
 import mpf_cli_runner_util as util
 
+if TYPE_CHECKING:
+    import concurrent.futures
+
 
 def main():
     if len(sys.argv) == 2 and sys.argv[1] in ('-d', '--daemon'):
@@ -40,27 +50,331 @@ def main():
         mpf_cli_server.main()
         return
 
+    if len(sys.argv) == 2 and sys.argv[1] == '--server-stats':
+        sys.exit(print_server_stats())
+
+    if mpf_cli_fast_client.is_parallel_job(sys.argv):
+        # Only import when needed, because the parallel job code has a lot more dependencies.
+        import mpf_cli_parallel_job
+        exit_code = mpf_cli_parallel_job.run_parallel_job(sys.argv)
+        if exit_code is not None:
+            sys.exit(exit_code)
+
     with socket.socket(socket.AF_UNIX) as sock:
-        try:
-            sock.connect(util.SOCKET_ADDRESS)
-        except ConnectionRefusedError:
-            import mpf_cli_server
-            # Fork a server process.
-            mpf_cli_server.start_from_client(sock)
-            sock.connect(util.SOCKET_ADDRESS)
-
-        util.send_fds(sock, sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno())
-        with sock.makefile('rwb') as sf:
-            pickle.dump(sys.argv, sf)
-            pickle.dump(os.getcwd(), sf)
-            pickle.dump(dict(util.get_job_props_from_env(os.environ)), sf)
-            sf.flush()
-            response = sf.read(1)
-    if response == b'':
+        connect_to_server(sock)
+        exit_code = submit_job(
+            sock, sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno(), sys.argv)
+    sys.exit(exit_code)
+
+
+class JobSubmission(NamedTuple):
+    argv: List[str]
+    stdin_fd: int
+    stdout_fd: int
+    stderr_fd: int
+
+
+def submit_job(sock: socket.socket, stdin_fd: int, stdout_fd: int, stderr_fd: int,
+               argv: List[str]) -> int:
+    """
+    Submits a job to the component server and waits for it to complete.
+    :param sock: A socket that is already connected to the component server.
+    :return: The exit code for the job.
+    """
+    job_status, = submit_jobs(sock, [JobSubmission(argv, stdin_fd, stdout_fd, stderr_fd)])
+    return job_status['exit_code']
+
+
+def submit_jobs(sock: socket.socket, jobs: Sequence[JobSubmission]) -> List[Dict[str, Any]]:
+    """
+    Submits jobs to the component server and waits for them to complete. All of the job requests
+    are sent without waiting for the previous job to complete. The jobs run one at a time on the
+    same executor process.
+    :param sock: A socket that is already connected to the component server.
+    :return: The JOB_STATUS payload for each job, in the same order as jobs. When a job did not
+             complete, only "exit_code" is present.
+    """
+    if len(jobs) == 1:
+        _send_job_requests(sock, jobs)
+    else:
+        # Send from a separate thread so that the executor never blocks writing a job status
+        # while this thread is blocked writing a job request.
+        threading.Thread(target=_send_job_requests, args=(sock, jobs), daemon=True).start()
+
+    job_statuses = []
+    exit_code = _recv_session_start(sock)
+    if exit_code is None:
+        job_statuses = _recv_job_statuses(sock, jobs)
+        # Only used for jobs that did not receive a status.
+        exit_code = 6
+    return job_statuses + [{'exit_code': exit_code}] * (len(jobs) - len(job_statuses))
+
+
+def _send_job_requests(sock: socket.socket, jobs: Sequence[JobSubmission]) -> None:
+    try:
+        protocol.send_message(
+            sock, protocol.MessageType.HELLO,
+            protocol.create_hello(mpf_cli_fast_client.get_descriptor_path(jobs[0].argv)))
+        cwd = os.getcwd()
+        env_props = dict(util.get_job_props_from_env(os.environ))
+        for job_id, job in enumerate(jobs):
+            protocol.send_message(
+                sock, protocol.MessageType.JOB_REQUEST,
+                {'job_id': job_id, 'argv': job.argv, 'cwd': cwd, 'env_props': env_props},
+                (job.stdin_fd, job.stdout_fd, job.stderr_fd))
+        protocol.send_message(sock, protocol.MessageType.END)
+    except (BrokenPipeError, ConnectionResetError):
+        # The server may reject the job without reading the job request. In that case, the
+        # response has already been sent.
+        pass
+    except BaseException:
+        # Unblock the thread waiting for job statuses.
+        sock.shutdown(socket.SHUT_RDWR)
+        raise
+
+
+def _recv_session_start(sock: socket.socket) -> Optional[int]:
+    """
+    :return: None when the executor accepted the session, or the exit code to use when it did
+             not.
+    """
+    message = _recv_message(sock)
+    if message is None:
         print('ERROR: Server closed connection before completing the job.', file=sys.stderr)
-        sys.exit(6)
+        return 6
+    elif message.type == protocol.MessageType.HELLO_ACK:
+        return None
+    elif message.type == protocol.MessageType.REJECTED:
+        print('ERROR: The job was rejected because the server has too many queued jobs.',
+              file=sys.stderr)
+        return message.payload.get('exit_code', util.SERVER_BUSY_EXIT_CODE)
     else:
-        sys.exit(response[0])
+        print(f'ERROR: The server did not accept the job: {message.payload}', file=sys.stderr)
+        return 6
+
+
+def _recv_job_statuses(sock: socket.socket,
+                       jobs: Sequence[JobSubmission]) -> List[Dict[str, Any]]:
+    job_statuses = []
+    progress_formats = [mpf_cli_fast_client.get_progress_format(j.argv) for j in jobs]
+    while len(job_statuses) < len(jobs):
+        message = _recv_message(sock)
+        if message is None:
+            print('ERROR: Server closed connection before completing the job.', file=sys.stderr)
+            break
+        if message.type == protocol.MessageType.PROGRESS:
+            job_id = message.payload.get('job_id')
+            if isinstance(job_id, int) and 0 <= job_id < len(jobs) and progress_formats[job_id]:
+                mpf_cli_fast_client.write_progress(progress_formats[job_id], message.payload)
+            continue
+        if message.type != protocol.MessageType.JOB_STATUS:
+            print(f'ERROR: Received unexpected {message.type.name} message from the server: '
+                  f'{message.payload}', file=sys.stderr)
+            break
+        job_statuses.append(message.payload)
+    return job_statuses
+
+
+def _recv_message(sock: socket.socket) -> Optional[protocol.Message]:
+    try:
+        message = protocol.recv_message(sock)
+    except ConnectionResetError:
+        return None
+    if message is not None:
+        # The server never sends file descriptors to the client.
+        protocol.close_fds(message.fds)
+    return message
+
+
+class JobResult(NamedTuple):
+    exit_code: int
+    # The job's output when the caller did not provide a stdout for the job.
+    output: Optional[bytes]
+    # The JOB_STATUS payload. Only contains "exit_code" when the job did not complete.
+    status: Dict[str, Any]
+
+
+class Session(contextlib.AbstractContextManager):
+    """
+    Submits many jobs over a single connection to the component server, so that scripts do not
+    need to start a new client process for each job. The jobs run one at a time, in the order
+    they were submitted, on the same executor process. That executor process is not available
+    to other clients until the session is closed.
+
+    Example:
+        with mpf_cli_client.Session() as session:
+            result = session.run(['image.jpg', '-P', 'MIN_HEIGHT=10'])
+            futures = [session.submit([path, '--brief']) for path in paths]
+    """
+    def __init__(self):
+        with contextlib.ExitStack() as exit_stack:
+            self._sock = exit_stack.enter_context(socket.socket(socket.AF_UNIX))
+            connect_to_server(self._sock)
+            # The send lock is separate from the pending jobs lock so that the thread receiving
+            # job statuses never waits on a thread that is blocked sending a job request.
+            self._send_lock = threading.Lock()
+            self._pending_lock = threading.Lock()
+            self._pending_jobs: Dict[int, _PendingJob] = {}
+            self._next_job_id = 0
+            # Set once the connection can no longer be used to run jobs.
+            self._failure_exit_code: Optional[int] = None
+
+            protocol.send_message(self._sock, protocol.MessageType.HELLO, protocol.create_hello())
+            self._receiver = threading.Thread(target=self._recv_responses, daemon=True)
+            self._receiver.start()
+            self._exit_stack = exit_stack.pop_all()
+
+
+    def run(self, args: Sequence[str], stdin: Union[IO, int, None] = None,
+            stdout: Union[IO, int, None] = None,
+            stderr: Union[IO, int, None] = None,
+            on_progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> JobResult:
+        """ Runs a job and waits for it to complete. See submit. """
+        return self.submit(args, stdin, stdout, stderr, on_progress).result()
+
+
+    def submit(self, args: Sequence[str], stdin: Union[IO, int, None] = None,
+               stdout: Union[IO, int, None] = None,
+               stderr: Union[IO, int, None] = None,
+               on_progress: Optional[Callable[[Dict[str, Any]], None]] = None
+               ) -> concurrent.futures.Future[JobResult]:
+        """
+        Submits a job without waiting for the previous jobs to complete.
+        :param args: The same command line arguments that would be passed to runner, excluding
+                     the program name.
+        :param stdin: The job's standard in. Defaults to /dev/null.
+        :param stdout: The job's standard out. When omitted, the output is returned in
+                       JobResult.output.
+        :param stderr: The job's standard error. Defaults to this process' standard error.
+        :param on_progress: Called from a background thread with the payload of each PROGRESS
+                            message when args includes --progress.
+        :return: A future that completes with the JobResult once the job completes.
+        """
+        # Only import when needed, because importing concurrent.futures noticeably increases the
+        # command line client's start up time.
+        import concurrent.futures
+        import tempfile
+
+        future = concurrent.futures.Future()
+        with contextlib.ExitStack() as exit_stack:
+            if stdin is None:
+                stdin = exit_stack.enter_context(open(os.devnull))
+            captured_output = None
+            if stdout is None:
+                captured_output = tempfile.TemporaryFile()
+                stdout = captured_output
+            if stderr is None:
+                stderr = sys.stderr
+
+            with self._pending_lock:
+                if self._failure_exit_code is not None:
+                    future.set_result(JobResult(
+                        self._failure_exit_code, None, {'exit_code': self._failure_exit_code}))
+                    if captured_output is not None:
+                        captured_output.close()
+                    return future
+                job_id = self._next_job_id
+                self._next_job_id += 1
+                self._pending_jobs[job_id] = _PendingJob(future, captured_output, on_progress)
+
+            payload = {'job_id': job_id, 'argv': ['runner', *args], 'cwd': os.getcwd(),
+                       'env_props': dict(util.get_job_props_from_env(os.environ))}
+            fds = tuple(f if isinstance(f, int) else f.fileno() for f in (stdin, stdout, stderr))
+            try:
+                with self._send_lock:
+                    protocol.send_message(
+                        self._sock, protocol.MessageType.JOB_REQUEST, payload, fds)
+            except OSError:
+                # The receiver thread may have already stopped, so it can not be relied on to
+                # complete the future.
+                self._complete_job(job_id, {'exit_code': 6})
+        return future
+
+
+    def close(self) -> None:
+        """ Waits for the submitted jobs to complete and then closes the connection. """
+        with self._send_lock, contextlib.suppress(OSError):
+            protocol.send_message(self._sock, protocol.MessageType.END)
+        self._receiver.join()
+        self._exit_stack.close()
+
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+
+    def _recv_responses(self) -> None:
+        exit_code = 6
+        try:
+            message = _recv_message(self._sock)
+            if message is None:
+                return
+            if message.type == protocol.MessageType.REJECTED:
+                exit_code = message.payload.get('exit_code', util.SERVER_BUSY_EXIT_CODE)
+                return
+            if message.type != protocol.MessageType.HELLO_ACK:
+                return
+            for message in iter(lambda: _recv_message(self._sock), None):
+                if message.type == protocol.MessageType.PROGRESS:
+                    self._report_progress(message.payload)
+                    continue
+                if message.type != protocol.MessageType.JOB_STATUS:
+                    return
+                self._complete_job(message.payload['job_id'], message.payload)
+        finally:
+            with self._pending_lock:
+                self._failure_exit_code = exit_code
+                unfinished_job_ids = list(self._pending_jobs)
+            for job_id in unfinished_job_ids:
+                self._complete_job(job_id, {'exit_code': exit_code})
+
+
+    def _report_progress(self, progress: Dict[str, Any]) -> None:
+        with self._pending_lock:
+            pending_job = self._pending_jobs.get(progress.get('job_id'))
+        if pending_job is not None and pending_job.on_progress is not None:
+            pending_job.on_progress(progress)
+
+
+    def _complete_job(self, job_id: int, status: Dict[str, Any]) -> None:
+        with self._pending_lock:
+            pending_job = self._pending_jobs.pop(job_id, None)
+        if pending_job is None:
+            return
+        output = None
+        if pending_job.captured_output is not None:
+            with pending_job.captured_output:
+                pending_job.captured_output.seek(0)
+                output = pending_job.captured_output.read()
+        pending_job.future.set_result(JobResult(status['exit_code'], output, status))
+
+
+class _PendingJob(NamedTuple):
+    future: concurrent.futures.Future[JobResult]
+    captured_output: Optional[IO[bytes]]
+    on_progress: Optional[Callable[[Dict[str, Any]], None]]
+
+
+def print_server_stats() -> int:
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(util.STATS_SOCKET_ADDRESS)
+        except ConnectionRefusedError:
+            print('ERROR: The component server is not running.', file=sys.stderr)
+            return 1
+        with sock.makefile('rb') as sock_file:
+            sys.stdout.buffer.write(sock_file.readline())
+    return 0
+
+
+def connect_to_server(sock: socket.socket) -> None:
+    try:
+        sock.connect(util.SOCKET_ADDRESS)
+    except ConnectionRefusedError:
+        import mpf_cli_server
+        # Fork a server process.
+        mpf_cli_server.start_from_client(sock)
+        sock.connect(util.SOCKET_ADDRESS)
 
 
 if __name__ == '__main__':
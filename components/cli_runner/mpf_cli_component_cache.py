@@ -0,0 +1,235 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+"""
+Keeps the components an executor process has initialized, so that images that contain more than
+one component can run jobs for each of them, selected with --descriptor, without starting a new
+executor process for each component.
+"""
+
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import os
+import threading
+from typing import Callable, Dict, Iterator, Optional
+
+import mpf_cli_descriptors
+import mpf_cli_job_runner
+import mpf_cli_metrics
+import mpf_cli_runner_util as util
+
+log = logging.getLogger('org.mitre.mpf.cli')
+
+
+class CachedComponent:
+    def __init__(self, descriptor: mpf_cli_descriptors.Descriptor, handle: util.ComponentHandle,
+                 job_property_defaults: mpf_cli_job_runner.JobPropertyDefaults):
+        self.key = descriptor.key
+        self.descriptor = descriptor
+        self.handle = handle
+        self.job_property_defaults = job_property_defaults
+        # Set with the COMPONENT_MAX_CONCURRENT_JOBS environment variable in the descriptor.
+        self.max_concurrent_jobs = util.get_max_concurrent_jobs(descriptor.env_vars)
+        # Each running job holds one slot, so that a component that did not declare that it can
+        # run multiple jobs at once never does, even when jobs for other components are running
+        # in the same process.
+        self.job_slots = threading.BoundedSemaphore(self.max_concurrent_jobs)
+        # The number of jobs currently using the component. Components are not closed while
+        # they are in use.
+        self.num_jobs = 0
+
+
+    def close(self) -> None:
+        # Only the C++ component handle needs to be closed.
+        if isinstance(self.handle, contextlib.AbstractContextManager):
+            self.handle.__exit__(None, None, None)
+
+
+class ComponentCache(contextlib.AbstractContextManager):
+    """
+    A least recently used cache of initialized components, keyed by descriptor. The cache size
+    is limited by the COMPONENT_CACHE_SIZE environment variable. When the
+    COMPONENT_CACHE_MAX_MEMORY_MB environment variable is set and the executor process's resident
+    memory exceeds it after a component is initialized, the least recently used components are
+    closed until the process is under the limit or only the components that are running jobs
+    remain. Memory that a component does not return to the operating system when it is closed is
+    still counted.
+
+    Initializing a component sets the descriptor's environment variables in os.environ, which
+    affects every thread in the process. A component is only initialized once no jobs are using
+    components, and jobs that need a component wait until the initialization completes, so
+    running jobs never see the environment change.
+    """
+    def __init__(self, max_size: int = 1, max_memory_bytes: Optional[int] = None):
+        self._max_size = max_size
+        self._max_memory_bytes = max_memory_bytes
+        self._components: collections.OrderedDict[
+            mpf_cli_descriptors.DescriptorKey, CachedComponent] = collections.OrderedDict()
+        # Components that are waiting to be initialized or are being initialized. A job that
+        # needs one of them waits for the future, so that concurrent jobs never initialize the
+        # same component twice. The lock is not held during initialization.
+        self._initializing: Dict[mpf_cli_descriptors.DescriptorKey,
+                                 concurrent.futures.Future[CachedComponent]] = {}
+        # True while a component's create function is running.
+        self._is_creating = False
+        # The number of jobs that are currently using a component.
+        self._num_active_jobs = 0
+        self._lock = threading.Lock()
+        # Notified when a job stops using a component and when an initialization completes.
+        self._condition = threading.Condition(self._lock)
+
+
+    @classmethod
+    def from_env(cls) -> ComponentCache:
+        max_memory_mb = util.get_component_cache_max_memory_mb()
+        return cls(util.get_component_cache_size(),
+                   max_memory_mb * 1024 * 1024 if max_memory_mb is not None else None)
+
+
+    def __contains__(self, key: mpf_cli_descriptors.DescriptorKey) -> bool:
+        return key in self._components
+
+
+    def __len__(self) -> int:
+        return len(self._components)
+
+
+    def get_max_concurrent_jobs(self) -> Dict[str, int]:
+        """ :return: Each component's maximum number of concurrent jobs, by descriptor path. """
+        with self._lock:
+            return {key.path: component.max_concurrent_jobs
+                    for key, component in self._components.items()}
+
+
+    @contextlib.contextmanager
+    def use(self, key: mpf_cli_descriptors.DescriptorKey,
+            create: Callable[[], CachedComponent]) -> Iterator[CachedComponent]:
+        """
+        Provides the component for key, calling create to initialize it when it is not in the
+        cache. The component will not be closed until the with statement exits. When the
+        component is already running its maximum number of concurrent jobs, waits for one of them
+        to complete.
+        """
+        component = self._acquire(key, create)
+        try:
+            with component.job_slots:
+                yield component
+        finally:
+            with self._lock:
+                component.num_jobs -= 1
+                self._num_active_jobs -= 1
+                self._condition.notify_all()
+
+
+    def _acquire(self, key: mpf_cli_descriptors.DescriptorKey,
+                 create: Callable[[], CachedComponent]) -> CachedComponent:
+        while True:
+            with self._lock:
+                future = self._initializing.get(key)
+                if future is None:
+                    component = self._components.get(key)
+                    if component is None:
+                        future = self._initializing[key] = concurrent.futures.Future()
+                        # Wait for the jobs that are using components and for other
+                        # initializations to complete. Jobs that arrive in the meantime wait
+                        # for this initialization.
+                        self._condition.wait_for(
+                            lambda: self._num_active_jobs == 0 and not self._is_creating)
+                        self._is_creating = True
+                        break
+                    if not self._initializing:
+                        self._components.move_to_end(key)
+                        component.num_jobs += 1
+                        self._num_active_jobs += 1
+                        return component
+                    # The component is looked up again once the other components are
+                    # initialized, because it may have been evicted.
+                    self._condition.wait_for(lambda: not self._initializing)
+                    continue
+            # Another job is initializing the component. When initialization fails, this job
+            # fails with the same exception. Otherwise, the component is looked up again, because
+            # it may have been evicted once the other job completed.
+            future.result()
+
+        try:
+            component = create()
+        except BaseException as e:
+            with self._lock:
+                del self._initializing[key]
+                self._is_creating = False
+                self._condition.notify_all()
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._initializing[key]
+            self._is_creating = False
+            self._components[key] = component
+            component.num_jobs += 1
+            self._num_active_jobs += 1
+            self._evict()
+            self._condition.notify_all()
+        future.set_result(component)
+        return component
+
+
+    def _evict(self) -> None:
+        # The most recently added component is never evicted, because the caller is about to
+        # use it.
+        for key, component in list(self._components.items())[:-1]:
+            if not self._is_over_limit():
+                return
+            if component.num_jobs > 0:
+                continue
+            log.info(f'Closing the component for {key.path} because the component cache is '
+                     'full.')
+            del self._components[key]
+            try:
+                component.close()
+            except Exception:
+                log.exception(f'An error occurred while closing the component for {key.path}.')
+
+
+    def _is_over_limit(self) -> bool:
+        if len(self._components) > self._max_size:
+            return True
+        if self._max_memory_bytes is None:
+            return False
+        memory_bytes = mpf_cli_metrics.get_resident_memory_bytes(os.getpid())
+        return memory_bytes is not None and memory_bytes > self._max_memory_bytes
+
+
+    def __exit__(self, *exc_details):
+        with self._lock:
+            components = list(self._components.values())
+            self._components.clear()
+        # Closed in the reverse order they were used, like an ExitStack.
+        for component in reversed(components):
+            component.close()
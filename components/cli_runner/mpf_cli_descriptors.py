@@ -0,0 +1,275 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+"""
+Finds and parses component descriptors. Parsed descriptors are kept until the descriptor file
+changes, so that starting executor processes and running jobs do not repeatedly search the plugins
+directory and parse the same descriptors. The component server loads the plugin descriptors
+before starting any executor processes, so executor processes inherit them.
+
+Descriptors are expanded using the environment the process started with, rather than the current
+os.environ, so that when an executor process initializes more than one component, the
+environment variables of one component do not end up in another component's environment.
+"""
+
+from __future__ import annotations
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import types
+from typing import Any, Dict, FrozenSet, List, Mapping, NamedTuple, Optional, Tuple
+
+import mpf_cli_runner_util as util
+
+log = logging.getLogger('org.mitre.mpf.cli')
+
+
+_registry: Optional[DescriptorRegistry] = None
+_registry_lock = threading.Lock()
+
+# The environment before any descriptor's environment variables were set. The component server
+# imports this module before starting any executor processes, so executor processes inherit the
+# server's environment rather than one modified by a component.
+_BASE_ENV: Mapping[str, str] = types.MappingProxyType(dict(os.environ))
+
+# The names of the environment variables that Descriptor.set_env_vars last set in os.environ.
+_applied_env_var_names: FrozenSet[str] = frozenset()
+_applied_env_lock = threading.Lock()
+
+
+def get_descriptor(descriptor_path: str) -> Descriptor:
+    """
+    Gets the descriptor at descriptor_path. The file is only parsed again when it changes.
+    :raises OSError: When the descriptor can not be read.
+    :raises ValueError: When the descriptor is not valid JSON.
+    """
+    return _get_registry().get(descriptor_path)
+
+
+def get_plugin_descriptor() -> Descriptor:
+    """
+    Gets the descriptor of the only component in $MPF_HOME/plugins.
+    :raises RuntimeError: When there is not exactly one plugin descriptor.
+    """
+    return _get_registry().get_plugin_descriptor()
+
+
+def find_plugin_descriptors() -> List[str]:
+    """ :return: The resolved paths of the descriptors in $MPF_HOME/plugins. """
+    return _get_registry().find_plugin_descriptors()
+
+
+def preload_plugin_descriptors() -> None:
+    """
+    Parses all of the plugin descriptors. Errors are logged, and reported again when the
+    descriptor is used.
+    """
+    for descriptor_path in find_plugin_descriptors():
+        try:
+            get_descriptor(descriptor_path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning(f'Failed to load the descriptor at {descriptor_path}: {e}')
+
+
+def _get_registry() -> DescriptorRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = DescriptorRegistry(util.get_plugin_descriptor_pattern())
+        return _registry
+
+
+class DescriptorKey(NamedTuple):
+    # The absolute path to the descriptor, with symbolic links resolved.
+    path: str
+    # The SHA-256 digest of the descriptor's contents, so that a descriptor that was modified
+    # after its component was initialized results in a new component instance.
+    digest: str
+
+
+# (st_dev, st_ino, st_size, st_mtime_ns)
+_FileVersion = Tuple[int, int, int, int]
+
+
+class Descriptor:
+    """
+    A parsed descriptor along with the values derived from it that are needed to initialize the
+    component and to run each job.
+    """
+    def __init__(self, path: str, contents: bytes,
+                 base_env: Mapping[str, str] = _BASE_ENV):
+        self.key = DescriptorKey(path, hashlib.sha256(contents).hexdigest())
+        self.json: Dict[str, Any] = json.loads(contents)
+        self.track_type: str = self.json['algorithm']['trackType']
+        self.property_defaults: Mapping[str, str] = types.MappingProxyType({
+            p['name']: p['defaultValue']
+            for p in self.json['algorithm']['providesCollection']['properties']
+            if p.get('defaultValue') is not None})
+        # The values of the environment variables from the descriptor's "environmentVariables"
+        # section, already expanded using base_env.
+        self.env_vars: Mapping[str, str] = types.MappingProxyType(
+            self._expand_env_vars(self.json, base_env))
+        # The complete environment the component runs with.
+        self.env: Mapping[str, str] = types.MappingProxyType({**base_env, **self.env_vars})
+
+
+    def set_env_vars(self) -> None:
+        """
+        Makes os.environ match this descriptor's environment. Variables that were set for a
+        previously initialized component, but are not set by this descriptor, are restored to
+        their original values. Setting them more than once does not append to variables that have
+        a separator again.
+        """
+        global _applied_env_var_names
+        with _applied_env_lock:
+            for var_name in _applied_env_var_names - self.env_vars.keys():
+                original_value = _BASE_ENV.get(var_name)
+                if original_value is None:
+                    os.environ.pop(var_name, None)
+                else:
+                    os.environ[var_name] = original_value
+            os.environ.update(self.env_vars)
+            _applied_env_var_names = frozenset(self.env_vars)
+
+
+    @staticmethod
+    def _expand_env_vars(descriptor: Mapping[str, Any],
+                         base_env: Mapping[str, str]) -> Dict[str, str]:
+        env = dict(base_env)
+        expanded = {}
+        for json_env_var in descriptor.get('environmentVariables', ()):
+            var_name = json_env_var['name']
+            var_value = util.expand_env_vars(json_env_var['value'], env)
+            sep = json_env_var.get('sep')
+
+            existing_val = env.get(var_name) if sep else None
+            if sep and existing_val:
+                env[var_name] = existing_val + sep + var_value
+            else:
+                env[var_name] = var_value
+            expanded[var_name] = env[var_name]
+        return expanded
+
+
+class DescriptorRegistry:
+    """
+    Caches parsed descriptors keyed by their resolved path. Each time a descriptor is requested,
+    the file is checked with os.stat, and it is parsed again when its size or modification time
+    changed. The list of plugin descriptors is searched for again when the modification time of
+    any of the directories the previous search looked in changes. For the default pattern, those
+    are the plugins directory, each plugin's directory, and each plugin's descriptor directory,
+    so adding or removing a plugin, or a plugin's descriptor, is noticed. It is safe to use from
+    multiple threads.
+    """
+    def __init__(self, plugin_descriptor_pattern: str):
+        self._plugin_descriptor_pattern = plugin_descriptor_pattern
+        # Patterns for the directories that are listed when searching for plugin descriptors.
+        # For "plugins/*/descriptor/descriptor.json", they are "plugins", "plugins/*", and
+        # "plugins/*/descriptor".
+        pattern_parts = plugin_descriptor_pattern.split(os.sep)
+        first_wildcard = next(
+            (i for i, part in enumerate(pattern_parts) if glob.has_magic(part)),
+            len(pattern_parts) - 1)
+        self._search_dir_patterns = [os.sep.join(pattern_parts[:i]) or os.sep
+                                     for i in range(first_wildcard, len(pattern_parts))]
+        # The modification times of the directories the last search looked in.
+        self._search_dir_versions: Dict[str, Optional[int]] = {}
+        self._plugin_descriptor_paths: List[str] = []
+        self._descriptors: Dict[str, Tuple[_FileVersion, Descriptor]] = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, descriptor_path: str) -> Descriptor:
+        resolved_path = os.path.realpath(descriptor_path)
+        stat = os.stat(resolved_path)
+        version = stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+        with self._lock:
+            cached = self._descriptors.get(resolved_path)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        log.info(f'Loading descriptor from {resolved_path}')
+        with open(resolved_path, 'rb') as f:
+            descriptor = Descriptor(resolved_path, f.read())
+        with self._lock:
+            self._descriptors[resolved_path] = (version, descriptor)
+        return descriptor
+
+
+    def get_plugin_descriptor(self) -> Descriptor:
+        descriptor_paths = self.find_plugin_descriptors()
+        if len(descriptor_paths) == 1:
+            return self.get(descriptor_paths[0])
+
+        if len(descriptor_paths) == 0:
+            raise RuntimeError(
+                f'Expecting to find a descriptor file at "{self._plugin_descriptor_pattern}", '
+                'but it was not there.')
+        else:
+            raise RuntimeError(
+                f'Expected to find one descriptor matching "{self._plugin_descriptor_pattern}", '
+                f'but the following descriptors were found: {descriptor_paths}. '
+                'Use --descriptor to select one.')
+
+
+    def find_plugin_descriptors(self) -> List[str]:
+        with self._lock:
+            if self._search_dirs_changed():
+                self._search_dir_versions = self._get_search_dir_versions()
+                # Like component-executor.py, links to the same descriptor are only counted once.
+                self._plugin_descriptor_paths = sorted(set(
+                    os.path.realpath(p) for p in glob.glob(self._plugin_descriptor_pattern)))
+            return list(self._plugin_descriptor_paths)
+
+
+    def _search_dirs_changed(self) -> bool:
+        # When the plugins directory does not exist, there are no versions to compare, so the
+        # search is always repeated.
+        return (not self._search_dir_versions
+                or any(_get_mtime(d) != version
+                       for d, version in self._search_dir_versions.items()))
+
+
+    def _get_search_dir_versions(self) -> Dict[str, Optional[int]]:
+        # Each directory's modification time is recorded before the next level is listed, so a
+        # change made during the search is noticed by the next call.
+        versions = {}
+        for dir_pattern in self._search_dir_patterns:
+            for dir_path in glob.glob(dir_pattern):
+                if os.path.isdir(dir_path):
+                    versions[dir_path] = _get_mtime(dir_path)
+        return versions
+
+
+def _get_mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
@@ -29,209 +29,400 @@ from __future__ import annotations
 import argparse
 import array
 import contextlib
+import cProfile
 from enum import EnumMeta
-import glob
+import functools
 import json
 import logging
-import operator
 import os
-import pickle
-import selectors
+import select
 import socket
+import struct
 import sys
 import threading
-from typing import Any, ContextManager, Dict, List, Mapping, NoReturn, Optional, TextIO, Tuple, \
-    Union
+import time
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Mapping, Optional, TextIO, \
+    Tuple, Union
 
+import mpf_cli_component_cache
+import mpf_cli_descriptors
 import mpf_cli_job_runner
+import mpf_cli_media_info
+import mpf_cli_metrics
+import mpf_cli_output_encoders
+import mpf_cli_protocol as protocol
 import mpf_cli_runner_util as util
 
 log = logging.getLogger('org.mitre.mpf.cli')
 
 
+# The regular data the component server sends along with each client socket. It identifies the
+# client's session in the message the executor process sends when the session is complete.
+SESSION_ID = struct.Struct('!I')
+
+
 class ExecutorProcess(contextlib.AbstractContextManager):
     """
     Waits for new jobs from the component server and starts them. Also manages resources that
-    should persist between jobs, like the component instance and the connection the component
-    server.
+    should persist between jobs, like the component instances and the connection the component
+    server. When the image contains more than one component, jobs select one with --descriptor.
+    See mpf_cli_component_cache.ComponentCache.
+
+    By default, one job runs at a time. Components that can safely run multiple jobs at the same
+    time on a single component instance can set the COMPONENT_MAX_CONCURRENT_JOBS environment
+    variable in their descriptor. Once such a component is initialized and the job that
+    initialized it is complete, the executor informs the component server how many jobs the
+    component can run at once. After that, each client connection runs on its own thread. The
+    limit is per component: the component cache makes jobs for a component that did not set
+    the variable run one at a time. See the ExecutorProcessManager in mpf_cli_server for the
+    messages exchanged with the component server.
     """
-    def __init__(self, parent_socket: socket.socket):
-        log.info(f'Executor process started with pid {os.getpid()}.')
+    def __init__(self, parent_socket: socket.socket, init_component_on_start: bool = False,
+                 metrics_socket: Optional[socket.socket] = None):
         with contextlib.ExitStack() as exit_stack:
             self._from_parent_socket = exit_stack.enter_context(parent_socket)
-
-            self._selector = exit_stack.enter_context(selectors.DefaultSelector())
-            self._selector.register(parent_socket, selectors.EVENT_READ)
-
-            self._component = None
-            self._descriptor = None
-            self._job_sync = JobSync()
-            self._idle_timeout = util.get_idle_timeout()
+            # Used to report job timings to the component server when metrics are enabled.
+            self._metrics_socket = metrics_socket
+            self._parent_socket_lock = threading.Lock()
+            self._init_component_on_start = init_component_on_start
+            self._components = exit_stack.enter_context(
+                mpf_cli_component_cache.ComponentCache.from_env())
+            # The limits that have been sent to the component server, by descriptor path. Only
+            # components that can run more than one job at a time are included.
+            self._reported_max_concurrent_jobs: Dict[str, int] = {}
+            # Set once a limit has been sent. The component server may then send a client while
+            # other clients are being handled.
+            self._run_sessions_on_threads = False
+            # Created when jobs start running, so that executor processes forked from the
+            # executor template do not share the template's pipe.
+            self._abort_watcher: Optional[AbortWatcher] = None
+            self._thread_exception: Optional[BaseException] = None
+            self._thread_exception_lock = threading.Lock()
             self._exit_stack = exit_stack.pop_all()
 
 
     def run_jobs(self) -> None:
-        runner_exception = None
-
-        def _run_jobs_in_thread():
-            nonlocal runner_exception
-            try:
-                self._run_jobs()
-            except BaseException as thread_exception:
-                runner_exception = thread_exception
-                raise
-
         # Watching for close was chosen to run on the main thread and running the job is done on
         # another thread because only the main thread can handle signals. If a C++ component is
         # running on the main thread, the program wouldn't respond to signals until it finished the
         # job.
-        runner_thread = threading.Thread(target=_run_jobs_in_thread, daemon=True)
+        self._abort_watcher = AbortWatcher()
+        runner_thread = threading.Thread(
+            target=self._run_in_thread, args=(self._run_jobs,), daemon=True)
         runner_thread.start()
 
         try:
-            self._check_close(self._job_sync)
-        except threading.BrokenBarrierError:
-            # Runner thread closed self._job_sync. If it was due to an error, the exception will be
-            # stored in the runner_exception variable.
-            pass
+            # Returns once the runner thread exits or a thread fails.
+            self._abort_watcher.run()
         except JobAbortedException:
             sys.exit(3)
-        except BaseException as e:
-            runner_thread.join()
-            if runner_exception is not None:
-                # Prefer reporting runner thread's exception over the watcher thread's exception.
-                raise runner_exception
-            else:
-                raise e
 
+        if self._thread_exception is not None:
+            raise self._thread_exception
         runner_thread.join()
-        if runner_exception is not None:
-            raise runner_exception
 
 
-    @staticmethod
-    def _check_close(job_sync: JobSync) -> NoReturn:
-        with contextlib.closing(job_sync):
-            while True:
-                with job_sync.begin_watch_job_abort() as client_sock:
-                    # Will unblock if either we close the connection because the job is done or if
-                    # the client closed the connection before the job was completed.
-                    client_sock.recv(1)
-                    if job_sync.is_active():
-                        log.warning('Client closed connection before job could complete.')
-                        raise JobAbortedException()
+    def init_component_in_template(self) -> bool:
+        """
+        Initializes the component in the executor template process, so that the executor
+        processes forked from the template start with the component already initialized.
+        :return: True if the component was initialized.
+        """
+        try:
+            self._init_default_component()
+            return True
+        except Exception:
+            log.exception('Failed to initialize the component in the executor template process.')
+            return False
+
+
+    def attach_to_server(self, parent_socket: socket.socket,
+                         init_component_on_start: bool) -> None:
+        """
+        Called in an executor process that was just forked from the executor template to replace
+        the template's connection to the component server with the new executor's connection.
+        """
+        self._from_parent_socket.close()
+        self._from_parent_socket = self._exit_stack.enter_context(parent_socket)
+        self._init_component_on_start = init_component_on_start
+
+
+    def _run_in_thread(self, target: Callable[..., None], *args: Any) -> None:
+        try:
+            target(*args)
+        except BaseException as thread_exception:
+            with self._thread_exception_lock:
+                if self._thread_exception is None:
+                    self._thread_exception = thread_exception
+            self._abort_watcher.close()
+            raise
 
 
     def _run_jobs(self) -> None:
-        with contextlib.closing(self._job_sync):
+        with contextlib.closing(self._abort_watcher):
+            if self._init_component_on_start:
+                self._init_component_before_first_job()
             while True:
-                ready_list = self._selector.select(self._idle_timeout)
-                job_received = len(ready_list) > 0
-                if job_received:
-                    self._run_job()
-                else:
-                    log.info('Executor process exiting due to idle timeout.')
+                # The component server handles the idle timeout. When it wants this process to
+                # exit, it will send a message that does not contain a file descriptor. The
+                # component server only stops idle processes, so no jobs are running at that point.
+                data, client_sock_fds = recv_fds(self._from_parent_socket, 1, SESSION_ID.size)
+                if not client_sock_fds:
+                    log.info('Executor process exiting because it was stopped by the component '
+                             'server.')
                     return
+                session_id = SESSION_ID.unpack(data)[0]
+                if self._run_sessions_on_threads:
+                    threading.Thread(target=self._run_in_thread,
+                                     args=(self._run_session, client_sock_fds[0], session_id),
+                                     daemon=True).start()
+                else:
+                    self._run_session(client_sock_fds[0], session_id)
 
 
-    def _run_job(self) -> None:
-        with self._recv_client_socket() as client_sock, \
-                JobRequest(client_sock) as job_request, \
-                self._job_sync.begin_process_job(client_sock):
+    def _init_component_before_first_job(self) -> None:
+        try:
+            self._init_default_component()
+        except Exception:
+            log.exception('Failed to initialize the component before receiving a job. '
+                          'Initialization will be attempted again when a job is received.')
+        # Inform the component server that this process is ready to receive a job.
+        self._notify_idle()
 
-            self._init_component(job_request.cmd_line_args)
-            with mpf_cli_job_runner.JobRunner(
-                    job_request.cmd_line_args, job_request.env_props, job_request.stdin,
-                    self._component, self._descriptor) as runner:
-                runner.run_job()
-        self._from_parent_socket.send(b'\x00')
 
+    def _notify_idle(self, session_id: Optional[int] = None) -> None:
+        """
+        Informs the component server that this process is ready to receive a job, or that the
+        client with session_id is done.
+        """
+        if session_id is None:
+            message: Dict[str, Any] = {'event': 'ready'}
+        else:
+            message = {'event': 'session_done', 'session_id': session_id}
+        with self._parent_socket_lock:
+            # The first job's standard streams are not released until it completes, so
+            # concurrent jobs are not allowed until after the job that initialized the component.
+            new_limits = {
+                path: max_jobs
+                for path, max_jobs in self._components.get_max_concurrent_jobs().items()
+                if max_jobs > 1 and self._reported_max_concurrent_jobs.get(path) != max_jobs}
+            if new_limits:
+                for path, max_jobs in new_limits.items():
+                    log.info(f'This executor process will run up to {max_jobs} jobs at the same '
+                             f'time for the component described by {path}.')
+                self._reported_max_concurrent_jobs.update(new_limits)
+                self._run_sessions_on_threads = True
+                message['max_concurrent_jobs'] = new_limits
+            self._from_parent_socket.sendall(json.dumps(message).encode() + b'\n')
+
+
+    def _run_session(self, client_sock_fd: int, session_id: int) -> None:
+        """
+        Runs each of the jobs the client sends over the connection, in order. See
+        mpf_cli_protocol for a description of the messages.
+        """
+        with self._wrap_client_socket(client_sock_fd) as client_sock:
+            try:
+                capabilities = self._begin_session(client_sock)
+                if capabilities is not None:
+                    while self._run_next_job(client_sock, capabilities):
+                        pass
+            except protocol.ProtocolError as e:
+                log.error(f'Received an invalid message from the client: {e}')
+                with contextlib.suppress(OSError):
+                    protocol.send_message(
+                        client_sock, protocol.MessageType.ERROR, {'message': str(e)})
+        # Inform the component server that this process is ready to receive another client.
+        self._notify_idle(session_id)
 
-    @contextlib.contextmanager
-    def _recv_client_socket(self) -> ContextManager[socket.socket]:
-        client_sock_fd = recv_fds(self._from_parent_socket, 1)[0]
+
+    @classmethod
+    def _begin_session(cls, client_sock: socket.socket) -> Optional[List[str]]:
+        """
+        :return: The capabilities both sides support, or None if the client closed the connection
+                 without starting a session.
+        """
+        message = cls._recv_from_client(client_sock)
+        if message is None:
+            return None
+        protocol.close_fds(message.fds)
+        if message.type != protocol.MessageType.HELLO:
+            raise protocol.ProtocolError(f'Expected HELLO, but received {message.type.name}.')
+        version, capabilities = protocol.negotiate(message.payload)
+        protocol.send_message(client_sock, protocol.MessageType.HELLO_ACK,
+                              {'version': version, 'capabilities': capabilities})
+        return capabilities
+
+
+    def _run_next_job(self, client_sock: socket.socket, capabilities: List[str]) -> bool:
+        message = self._recv_from_client(client_sock)
+        if message is None:
+            return False
+        if message.type == protocol.MessageType.JOB_REQUEST:
+            self._run_job(client_sock, message, capabilities)
+            return True
+        protocol.close_fds(message.fds)
+        if message.type == protocol.MessageType.END:
+            return False
+        raise protocol.ProtocolError(
+            f'Expected JOB_REQUEST or END, but received {message.type.name}.')
+
+
+    @staticmethod
+    def _recv_from_client(client_sock: socket.socket) -> Optional[protocol.Message]:
+        try:
+            return protocol.recv_message(client_sock)
+        except ConnectionError:
+            log.warning('Client closed connection before sending all of its messages.')
+            return None
+
+
+    def _run_job(self, client_sock: socket.socket, message: protocol.Message,
+                 capabilities: List[str]) -> None:
+        job_id = message.payload.get('job_id')
+        job_status = JobStatus(job_id, self._metrics_socket)
         try:
-            client_sock = socket.socket(fileno=client_sock_fd)
+            with JobRequest(message, self._run_sessions_on_threads) as job_request, \
+                    self._abort_watcher.watch_job(client_sock), \
+                    contextlib.ExitStack() as exit_stack:
+                job_status.end_phase('parse')
+                if job_request.cmd_line_args.profile_output:
+                    exit_stack.enter_context(
+                        profile_job(job_request.cmd_line_args.profile_output))
+
+                descriptor = self._get_descriptor(job_request.cmd_line_args.descriptor_file)
+                stdin_spool = None
+                if descriptor.key not in self._components:
+                    # Initializing the component can take a long time, so prepare the media at
+                    # the same time.
+                    self._prefetch_video_info(job_request.cmd_line_args)
+                    stdin_spool = self._start_stdin_spool(job_request, exit_stack)
+                component = exit_stack.enter_context(self._components.use(
+                    descriptor.key, lambda: self._create_component(descriptor)))
+                job_status.end_phase('init_component')
+
+                progress_listener = None
+                if (job_request.cmd_line_args.progress
+                        and protocol.PROGRESS_CAPABILITY in capabilities):
+                    progress_listener = functools.partial(
+                        self._send_progress, client_sock, job_id)
+
+                with mpf_cli_job_runner.JobRunner(
+                        job_request.cmd_line_args, job_request.env_props, job_request.stdin,
+                        component.handle, component.descriptor,
+                        component.job_property_defaults, stdin_spool,
+                        job_status.timing_ms, progress_listener) as runner:
+                    try:
+                        runner.run_job()
+                    finally:
+                        job_status.counts = runner.result_counts
+                        job_status.add_timing(runner.phase_times_ms)
+                job_status.end_phase('run')
+                if job_request.cmd_line_args.profile:
+                    # Logged while the client's standard error is still connected. Unlike the
+                    # timing block in the output, this includes the serialization time.
+                    log.info(f'Job timing: {json.dumps(job_status.timing_ms)}')
+        except (Exception, SystemExit) as e:
+            # The error has already been reported to the client, either by the argument parser or
+            # by LogConfig.config_job_logging. The component stays loaded for the next job.
+            exit_code = JobStatus.get_exit_code(e)
+            if exit_code != 0:
+                log.warning(f'Job failed due to: {e!r}')
+            # The status is sent after JobRequest closes the client's streams, so that the client
+            # does not attempt to access the results before they are completely written out.
+            job_status.send(client_sock, exit_code)
+        except BaseException:
+            job_status.send(client_sock, 1)
+            raise
+        else:
+            job_status.send(client_sock, 0)
+
+
+    @staticmethod
+    def _send_progress(client_sock: socket.socket, job_id: Optional[int],
+                       progress: Mapping[str, Any]) -> None:
+        try:
+            protocol.send_message(client_sock, protocol.MessageType.PROGRESS,
+                                  {'job_id': job_id, **progress})
+        except OSError:
+            # The client closed the connection. The abort watcher handles that.
+            pass
+
+
+    @staticmethod
+    def _prefetch_video_info(cmd_line_args: argparse.Namespace) -> None:
+        if 'FPS' in cmd_line_args.media_metadata or not cmd_line_args.media_paths:
+            return
+        media_path = cmd_line_args.media_paths[0]
+        if (media_path != '-'
+                and os.path.isfile(media_path)
+                and mpf_cli_job_runner.is_video_path(media_path, cmd_line_args)):
+            mpf_cli_media_info.prefetch_video_info(media_path)
+
+
+    @staticmethod
+    def _start_stdin_spool(
+            job_request: JobRequest,
+            exit_stack: contextlib.ExitStack) -> Optional[mpf_cli_job_runner.StdinVideoSpool]:
+        cmd_line_args = job_request.cmd_line_args
+        if ('-' in cmd_line_args.media_paths
+                and mpf_cli_job_runner.StdinVideoSpool.is_needed(cmd_line_args.media_type,
+                                                                 job_request.stdin)):
+            return exit_stack.enter_context(
+                mpf_cli_job_runner.StdinVideoSpool(job_request.stdin))
+        return None
+
+
+    @staticmethod
+    def _wrap_client_socket(client_sock_fd: int) -> socket.socket:
+        try:
+            return socket.socket(fileno=client_sock_fd)
         except Exception:
             os.close(client_sock_fd)
             raise
 
-        with client_sock:
-            try:
-                yield client_sock
-                client_sock.send(b'\x00')
-            except BaseException:
-                # Send response in a context manager so that once a job has been received, we are
-                # guaranteed to respond to client preventing it from blocking indefinitely while
-                # waiting for a response.
-                # It also helps to ensure that responding to the client is very last thing that
-                # can be done with the client socket.
-                client_sock.send(b'\x01')
-                raise
 
+    def _init_default_component(self) -> None:
+        descriptor = mpf_cli_descriptors.get_plugin_descriptor()
+        with self._components.use(descriptor.key, lambda: self._create_component(descriptor)):
+            pass
 
-    def _init_component(self, cmd_args) -> None:
-        if self._component:
-            return
 
-        self._descriptor = self._load_descriptor(cmd_args.descriptor_file)
-        lang = self._descriptor['sourceLanguage'].lower()
+    @staticmethod
+    def _create_component(descriptor: mpf_cli_descriptors.Descriptor
+                          ) -> mpf_cli_component_cache.CachedComponent:
+        log.info(f'Initializing the component described by {descriptor.key.path}')
+        descriptor.set_env_vars()
+        lang = descriptor.json['sourceLanguage'].lower()
         if lang == 'c++':
             # Need to conditionally import because the C++ SDK won't be installed in Python
             # component images.
             import mpf_cpp_runner
-            self._component = mpf_cpp_runner.CppComponentHandle(self._descriptor)
-            self._exit_stack.enter_context(self._component)
+            handle = mpf_cpp_runner.CppComponentHandle(descriptor.json)
         elif lang == 'python':
             # Need to conditionally import because the Python SDK won't be installed in C++
             # component images.
             import mpf_python_runner
-            self._component = mpf_python_runner.PythonComponentHandle(self._descriptor)
+            handle = mpf_python_runner.PythonComponentHandle(descriptor.json)
         else:
             raise NotImplementedError(f'{lang} components are not supported.')
+        # Uses the descriptor's environment rather than os.environ, so that the defaults only
+        # depend on the descriptor and the environment the process started with.
+        job_property_defaults = mpf_cli_job_runner.JobPropertyDefaults(
+            descriptor.env, descriptor.property_defaults)
+        return mpf_cli_component_cache.CachedComponent(descriptor, handle, job_property_defaults)
 
 
-    @classmethod
-    def _load_descriptor(cls, descriptor_file: Optional[TextIO]) -> Dict[str, Any]:
-        if descriptor_file:
-            log.info(f'Loading descriptor from {descriptor_file.name}')
-            descriptor = json.load(descriptor_file)
-            descriptor_file.close()
-            cls._set_env_vars_from_descriptor(descriptor)
-            return descriptor
-
-        mpf_home = os.getenv('MPF_HOME', '/opt/mpf')
-        glob_pattern = os.path.join(mpf_home, 'plugins/*/descriptor/descriptor.json')
-        glob_matches = glob.glob(glob_pattern)
-
-        if len(glob_matches) == 1:
-            descriptor_path = glob_matches[0]
-            log.info(f'Loading descriptor from {descriptor_path}')
-            with open(descriptor_path) as f:
-                descriptor = json.load(f)
-            cls._set_env_vars_from_descriptor(descriptor)
-            return descriptor
-
-        if len(glob_matches) == 0:
-            raise RuntimeError(f'Expecting to find a descriptor file at "{glob_pattern}", '
-                               'but it was not there.')
-        else:
-            raise RuntimeError(f'Expected to find one descriptor matching "{glob_pattern}", '
-                               f'but the following descriptors were found: {glob_matches}')
-
     @staticmethod
-    def _set_env_vars_from_descriptor(descriptor: Dict[str, Any]) -> None:
-        env = os.environ
-        for json_env_var in descriptor.get('environmentVariables', ()):
-            var_name = json_env_var['name']
-            var_value = util.expand_env_vars(json_env_var['value'], env)
-            sep = json_env_var.get('sep')
-
-            existing_val = env.get(var_name) if sep else None
-            if sep and existing_val:
-                env[var_name] = existing_val + sep + var_value
-            else:
-                env[var_name] = var_value
+    def _get_descriptor(descriptor_file: Optional[TextIO]) -> mpf_cli_descriptors.Descriptor:
+        if not descriptor_file:
+            return mpf_cli_descriptors.get_plugin_descriptor()
+        with descriptor_file:
+            if descriptor_file is not sys.stdin:
+                return mpf_cli_descriptors.get_descriptor(descriptor_file.name)
+            # A descriptor read from standard in can not be cached.
+            log.info('Loading descriptor from standard in')
+            return mpf_cli_descriptors.Descriptor('<stdin>', descriptor_file.buffer.read())
 
     def __exit__(self, *exc_details):
         return self._exit_stack.__exit__(*exc_details)
@@ -247,55 +438,67 @@ class JobRequest(contextlib.AbstractContextManager):
     know if these file descriptors refer to something like a pipe that may not exist after
     responding to the client.
 
-    A job request is sent from the client to the executor process using a Unix socket.
-    The request includes four messages:
-      1. 1 byte of regular data and ancillary data containing three file descriptors. The byte of
-         regular data is ignored. The three file descriptors are the client's standard in,
-         standard out, and standard error.
-      2. A message containing the client's command line arguments encoded as a pickled list of
-         strings.
-      3. A message containing the client's working directory encoded as a pickled string.
-      4. A message containing the client's environment variables that were used to provide job
-         properties encoded as a pickled dictionary with string keys and values.
+    A job request is sent from the client to the executor process as a JOB_REQUEST message (see
+    mpf_cli_protocol). The message has three file descriptors attached, the client's standard in,
+    standard out, and standard error, in that order. The payload contains:
+      - "job_id": An identifier chosen by the client that is included in the job's status.
+      - "argv": The client's command line arguments.
+      - "cwd": The client's working directory.
+      - "env_props": The client's environment variables that were used to provide job properties.
     The executor will write log messages to the received standard error. It will also interact
     with the client's standard in and standard out if the command line arguments indicate that
     it should.
-    After all job related information is written to the client's standard streams, a single
-    byte will be written to the client socket. The byte contains the exit code the client should
-    use when it exits. A zero byte is written for success and a non-zero for an error. The byte is
-    unsigned since Linux exit codes must be positive.
+    After all job related information is written to the client's standard streams, a JOB_STATUS
+    message is sent to the client. It contains the exit code the client should use when it exits.
     """
     stdin: TextIO
     cmd_line_args: argparse.Namespace
     env_props: Mapping[str, str]
 
-    def __init__(self, client_sock: socket.socket):
+    def __init__(self, message: protocol.Message, is_concurrent: bool = False):
         with contextlib.ExitStack() as exit_stack:
-            self.stdin, stdout, stderr = self._get_job_streams(client_sock)
+            argv, client_cwd, self.env_props = self._get_job_fields(message)
+            self.stdin, stdout, stderr = self._get_job_streams(message.fds)
             exit_stack.callback(self.stdin.close)
             exit_stack.callback(stdout.close)
             exit_stack.callback(stderr.close)
 
-            # Make diagnostic message go to the client's standard error.
-            exit_stack.enter_context(replace_fd_temp(sys.stdout, stderr))
-            exit_stack.enter_context(replace_fd_temp(sys.stderr, stderr))
-
-            with client_sock.makefile('rb') as sf:
-                argv: List[str] = pickle.load(sf)
-                client_cwd: str = pickle.load(sf)
-                self.env_props = pickle.load(sf)
+            if not is_concurrent:
+                # Make diagnostic message go to the client's standard error. When other jobs are
+                # running at the same time, the process's standard streams can not be given to a
+                # single client, so diagnostic messages go to the component server's log.
+                exit_stack.enter_context(replace_fd_temp(sys.stdout, stderr))
+                exit_stack.enter_context(replace_fd_temp(sys.stderr, stderr))
 
             self.cmd_line_args = ArgumentParser.parse(argv, client_cwd, stdout, stderr)
 
             # This must be added to the stack last so that during clean up it is called before
             # closing the client's streams.
-            exit_stack.enter_context(LogConfig.config_job_logging(stderr, self.cmd_line_args))
+            exit_stack.enter_context(LogConfig.config_job_logging(
+                stderr, self.cmd_line_args, current_thread_only=is_concurrent))
 
             self._exit_stack = exit_stack.pop_all()
 
     @staticmethod
-    def _get_job_streams(client_sock: socket.socket) -> Tuple[TextIO, TextIO, TextIO]:
-        stdin_fd, stdout_fd, stderr_fd = recv_fds(client_sock, 3)
+    def _get_job_fields(message: protocol.Message) -> Tuple[List[str], str, Dict[str, str]]:
+        try:
+            payload = message.payload
+            argv = payload['argv']
+            client_cwd = payload['cwd']
+            env_props = payload['env_props']
+            if (len(message.fds) == 3
+                    and argv and all(isinstance(a, str) for a in argv)
+                    and isinstance(client_cwd, str)
+                    and all(isinstance(v, str) for v in env_props.values())):
+                return argv, client_cwd, env_props
+        except (KeyError, TypeError, AttributeError):
+            pass
+        protocol.close_fds(message.fds)
+        raise protocol.ProtocolError('Received an invalid job request.')
+
+    @staticmethod
+    def _get_job_streams(fds: List[int]) -> Tuple[TextIO, TextIO, TextIO]:
+        stdin_fd, stdout_fd, stderr_fd = fds
         try:
             return os.fdopen(stdin_fd, 'r'), os.fdopen(stdout_fd, 'w'), os.fdopen(stderr_fd, 'w')
         except Exception:
@@ -310,61 +513,144 @@ class JobRequest(contextlib.AbstractContextManager):
         return self._exit_stack.__exit__(*exc_info)
 
 
-class JobSync:
+class JobStatus:
+    """
+    Collects the information that is sent to the client in the JOB_STATUS message once a job
+    completes.
+    """
+    def __init__(self, job_id: Optional[int], metrics_socket: Optional[socket.socket] = None):
+        self._job_id = job_id
+        self._metrics_socket = metrics_socket
+        self._start_time = time.perf_counter()
+        self._phase_start_time = self._start_time
+        self._timing: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+    def end_phase(self, phase_name: str) -> None:
+        now = time.perf_counter()
+        self._timing[f'{phase_name}_ms'] = round((now - self._phase_start_time) * 1000, 3)
+        self._phase_start_time = now
+
+    @property
+    def timing_ms(self) -> Mapping[str, float]:
+        return self._timing
+
+    def add_timing(self, timing_ms: Mapping[str, float]) -> None:
+        self._timing.update(timing_ms)
+
+    def send(self, client_sock: socket.socket, exit_code: int) -> None:
+        self._timing['total_ms'] = round((time.perf_counter() - self._start_time) * 1000, 3)
+        mpf_cli_metrics.report_job(self._metrics_socket, exit_code, self._timing)
+        try:
+            protocol.send_message(client_sock, protocol.MessageType.JOB_STATUS, {
+                'job_id': self._job_id,
+                'exit_code': exit_code,
+                'timing': self._timing,
+                'counts': self.counts
+            })
+        except OSError:
+            log.warning('Unable to send job status because the client closed the connection.')
+
+    @staticmethod
+    def get_exit_code(error: BaseException) -> int:
+        # ArgumentParser exits with code 2 when the command line arguments are invalid.
+        if isinstance(error, SystemExit) and isinstance(error.code, int):
+            return error.code
+        return 1
+
+
+class AbortWatcher:
     """
-    Manages synchronization between the thread that watches for job cancellation and the thread
-    executing the job.
+    Runs on the main thread and watches the client sockets of the jobs that are currently running.
+    There is no way to stop a component in the middle of a job, so when a client closes its
+    connection before its job completes and no other jobs are running, the executor process exits.
+    When other jobs are running on the same component instance, the abandoned job is allowed to
+    complete so that the other jobs are not lost.
     """
     def __init__(self):
-        self._client_socket: Optional[socket.socket] = None
-        self._is_job_active = False
-        self._begin_job_barrier = threading.Barrier(2)
-        self._end_job_barrier = threading.Barrier(2)
         self._lock = threading.Lock()
+        self._watched_sockets: Dict[int, socket.socket] = {}
+        self._num_active_jobs = 0
+        self._is_closed = False
+        # Used to wake up the watcher when the set of jobs changes. The client socket can not be
+        # used for this because the connection stays open for the client's next job request.
+        self._wake_read_fd, self._wake_write_fd = os.pipe()
+        os.set_blocking(self._wake_read_fd, False)
+        os.set_blocking(self._wake_write_fd, False)
 
     @contextlib.contextmanager
-    def begin_process_job(self, client_socket) -> ContextManager[None]:
+    def watch_job(self, client_socket: socket.socket) -> ContextManager[None]:
+        fd = client_socket.fileno()
         with self._lock:
-            self._client_socket = client_socket
-            self._is_job_active = True
-        # Inform the watcher thread that a new job is being processed.
-        self._begin_job_barrier.wait()
-
-        yield
-        with self._lock:
-            self._is_job_active = False
-            # Call socket.shutdown to unblock the watcher's socket.recv. Normally socket.recv will
-            # only unblock when the remote side of the socket is closed.
-            # The call to shutdown also must occur after `self._is_job_active = False` so the
-            # watcher doesn't think the client prematurely closed the connection.
-            self._client_socket.shutdown(socket.SHUT_RD)
-        # Wait until the watcher is no longer watching the socket to ensure the watcher is always
-        # watching the current job's socket and not one from a previous job.
-        self._end_job_barrier.wait()
-        with self._lock:
-            self._client_socket = None
+            self._watched_sockets[fd] = client_socket
+            self._num_active_jobs += 1
+        self._wake()
+        try:
+            yield
+        finally:
+            with self._lock:
+                # The socket will have already been removed if the client closed the connection.
+                if self._watched_sockets.get(fd) is client_socket:
+                    del self._watched_sockets[fd]
+                self._num_active_jobs -= 1
+            # The wake up must occur after the socket is removed so the watcher doesn't think
+            # the client prematurely closed the connection.
+            self._wake()
+
+    def run(self) -> None:
+        """
+        Blocks until close is called.
+        :raises JobAbortedException: When a client closes the connection before its job completes
+                                     and no other jobs are running.
+        """
+        while True:
+            with self._lock:
+                if self._is_closed:
+                    return
+                watched_sockets = dict(self._watched_sockets)
+
+            poller = select.poll()
+            poller.register(self._wake_read_fd, select.POLLIN)
+            # Only POLLHUP is used because data from pipelined job requests may already be
+            # waiting to be read. POLLHUP does not need to be requested, but it is included for
+            # clarity.
+            for fd in watched_sockets:
+                poller.register(fd, select.POLLHUP)
+
+            for fd, _ in poller.poll():
+                if fd == self._wake_read_fd:
+                    with contextlib.suppress(BlockingIOError):
+                        os.read(self._wake_read_fd, 4096)
+                else:
+                    self._on_client_closed(fd, watched_sockets[fd])
 
-    @contextlib.contextmanager
-    def begin_watch_job_abort(self) -> ContextManager[socket.socket]:
-        # Wait until the executor thread gets a new job and begins running it.
-        self._begin_job_barrier.wait()
-        # Expose the socket to the watcher.
-        yield self._client_socket
-        # Inform executor that the watcher is no longer using the socket.
-        self._end_job_barrier.wait()
-
-    def is_active(self) -> bool:
+    def _on_client_closed(self, fd: int, client_socket: socket.socket) -> None:
         with self._lock:
-            is_active = self._is_job_active
-        return is_active
+            if self._watched_sockets.get(fd) is not client_socket:
+                # The job completed while the watcher was waking up.
+                return
+            del self._watched_sockets[fd]
+            num_other_jobs = self._num_active_jobs - 1
+
+        if num_other_jobs == 0:
+            log.warning('Client closed connection before job could complete.')
+            raise JobAbortedException()
+        log.warning('Client closed connection before job could complete. The job will continue '
+                    f'to run because {num_other_jobs} other job(s) are running in this process.')
+
+    def _wake(self) -> None:
+        # When the pipe is full, the watcher already has a pending wake up.
+        with contextlib.suppress(BlockingIOError):
+            os.write(self._wake_write_fd, b'\x00')
 
     def close(self) -> None:
         """
-        Used to signal to the other thread that it should exit. It may be done because the process
+        Used to signal to the watcher that it should exit. It may be done because the process
         is exiting because it has been idle for long enough or if an error occurs.
         """
-        self._begin_job_barrier.abort()
-        self._end_job_barrier.abort()
+        with self._lock:
+            self._is_closed = True
+        self._wake()
 
 
 class JobAbortedException(Exception):
@@ -372,20 +658,19 @@ class JobAbortedException(Exception):
 
 
 # From https://docs.python.org/3/library/socket.html#socket.socket.recvmsg
-def recv_fds(sock: socket.socket, max_fds: int) -> List[int]:
+def recv_fds(sock: socket.socket, max_fds: int,
+             regular_data_size: int = 1) -> Tuple[bytes, List[int]]:
     fds = array.array("i")   # Array of ints
     try:
         # At least one byte of regular data needs to be sent with the ancillary data, so the
-        # sender will send one byte of regular data.
-        # The receiver reads the byte from the socket, then ignores it.
-        regular_data_size = 1
+        # sender will send at least one byte of regular data.
         msg, ancillary_data, flags, addr = sock.recvmsg(
             regular_data_size, socket.CMSG_LEN(max_fds * fds.itemsize))
         for cmsg_level, cmsg_type, cmsg_data in ancillary_data:
             if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
                 # Append data, ignoring any truncated integers at the end.
                 fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
-        return list(fds)
+        return msg, list(fds)
     except Exception:
         for fd in fds:
             os.close(fd)
@@ -409,9 +694,95 @@ def replace_fd_temp(fd_to_replace: TextIO, replacement: TextIO) -> ContextManage
         os.close(stashed_fd)
 
 
+# cProfile can only profile one thread at a time in Python 3.12 and later.
+_profiler_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def profile_job(output_path: str) -> Iterator[None]:
+    """
+    Writes cProfile statistics for the code run inside the with block to output_path. The file can
+    be loaded with the pstats module or converted to a flame graph with tools like flameprof.
+    """
+    if not _profiler_lock.acquire(blocking=False):
+        log.warning(f'Not writing profile to {output_path} because another job in the same '
+                    'executor process is being profiled.')
+        yield
+        return
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_path)
+            log.info(f'Wrote profile to {output_path}.')
+    finally:
+        _profiler_lock.release()
+
+
+class ActiveJobLogLevels:
+    """
+    Tracks the log levels requested by the jobs that are currently running. While jobs are
+    running, the loggers use the most verbose of those levels. The original levels are restored
+    once no jobs are running.
+    """
+    _LEVELS_BY_VERBOSITY = ('TRACE', 'DEBUG', 'INFO', 'WARN', 'ERROR', 'FATAL')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active_levels: List[str] = []
+        self._prev_log_level_env: Optional[str] = None
+        self._prev_root_level = logging.NOTSET
+        self._prev_cli_level = logging.NOTSET
+
+    @contextlib.contextmanager
+    def use_level(self, level: str) -> ContextManager[None]:
+        with self._lock:
+            if not self._active_levels:
+                self._prev_log_level_env = os.getenv('LOG_LEVEL')
+                self._prev_root_level = logging.getLogger().getEffectiveLevel()
+                self._prev_cli_level = log.getEffectiveLevel()
+            self._active_levels.append(level)
+            self._apply_levels()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active_levels.remove(level)
+                if self._active_levels:
+                    self._apply_levels()
+                else:
+                    self._restore_levels()
+
+    def _apply_levels(self) -> None:
+        level = min(self._active_levels, key=self._LEVELS_BY_VERBOSITY.index)
+        # Log4cxxConfig.xml checks the $LOG_LEVEL environment variable
+        os.environ['LOG_LEVEL'] = level
+
+        # The log level needs to be temporarily changed because the client may request a more
+        # verbose logging level than the level the server was originally started with.
+        # This only affects the client's log output because the server's log output is further
+        # filtered by the handler added in configure_server_logging.
+        level_int = LogConfig._get_level_int(level)
+        logging.getLogger().setLevel(min(self._prev_root_level, level_int))
+        log.setLevel(min(self._prev_cli_level, level_int))
+
+    def _restore_levels(self) -> None:
+        if self._prev_log_level_env is None:
+            os.environ.pop('LOG_LEVEL', None)
+        else:
+            os.environ['LOG_LEVEL'] = self._prev_log_level_env
+        logging.getLogger().setLevel(self._prev_root_level)
+        log.setLevel(self._prev_cli_level)
+
+
 class LogConfig:
     FORMAT = '%(levelname)-5s %(process)d [%(filename)s:%(lineno)d] - %(message)s'
 
+    _active_job_levels = ActiveJobLogLevels()
+
     @classmethod
     def configure_server_logging(cls) -> None:
         level = cls._get_level_from_env('DEBUG')
@@ -425,7 +796,8 @@ class LogConfig:
 
     @classmethod
     @contextlib.contextmanager
-    def config_job_logging(cls, stream: TextIO, cmd_line_args) -> ContextManager[None]:
+    def config_job_logging(cls, stream: TextIO, cmd_line_args,
+                           current_thread_only: bool = False) -> ContextManager[None]:
         if cmd_line_args.verbose == 1:
             level_for_job = 'DEBUG'
         elif cmd_line_args.verbose >= 2:
@@ -433,34 +805,21 @@ class LogConfig:
         else:
             level_for_job = cls._get_level_from_env('INFO')
 
-        prev_log_level_env = os.getenv('LOG_LEVEL')
         with contextlib.ExitStack() as exit_stack:
-            # Log4cxxConfig.xml checks the $LOG_LEVEL environment variable
-            os.environ['LOG_LEVEL'] = level_for_job
-            if prev_log_level_env is None:
-                exit_stack.callback(operator.delitem, os.environ, 'LOG_LEVEL')
-            else:
-                exit_stack.callback(operator.setitem, os.environ, 'LOG_LEVEL', prev_log_level_env)
+            exit_stack.enter_context(cls._active_job_levels.use_level(level_for_job))
 
-            # The log level needs to be temporarily changed because the client may request a more
-            # verbose logging level than the level the server was originally started with.
-            # This only affects the client's log output because the server's log output is further
-            # filtered by the handler added in configure_server_logging.
             root_logger = logging.getLogger()
-            prev_root_level = root_logger.getEffectiveLevel()
-            level_int_for_job = cls._get_level_int(level_for_job)
-            root_logger.setLevel(min(prev_root_level, level_int_for_job))
-            exit_stack.callback(root_logger.setLevel, prev_root_level)
-
             handler = cls._create_handler(stream, level_for_job)
+            if current_thread_only:
+                # Other jobs are running in this process at the same time, so only this job's
+                # log messages should be sent to this client.
+                job_thread_id = threading.get_ident()
+                # Threads the job starts, like the progress heartbeat, set job_thread_id.
+                handler.addFilter(lambda record: getattr(record, 'job_thread_id', record.thread)
+                                  == job_thread_id)
             root_logger.addHandler(handler)
             exit_stack.callback(handler.flush)
             exit_stack.callback(root_logger.removeHandler, handler)
-
-            cli_log = log
-            prev_cli_level = cli_log.getEffectiveLevel()
-            cli_log.setLevel(min(prev_cli_level, level_int_for_job))
-            exit_stack.callback(cli_log.setLevel, prev_cli_level)
             try:
                 yield
             except BaseException as e:
@@ -470,6 +829,7 @@ class LogConfig:
                     log.exception(f'Job failed due to: {e}')
                 else:
                     log.error(f'Job failed due to: {e}')
+                raise
 
 
     @classmethod
@@ -510,21 +870,65 @@ class LogConfig:
 
 
 class ArgumentParser(argparse.ArgumentParser):
+    # Creating the parser takes much longer than parsing a typical command line, so a single
+    # parser is created per process. The client specific parts are set before each parse.
+    _instance: Optional[ArgumentParser] = None
+    _instance_lock = threading.Lock()
+
     @classmethod
-    def parse(cls, argv: List[str], client_cwd: str, client_std_out: TextIO, job_stderr: TextIO):
-        parser = cls(argv[0], client_cwd, client_std_out, job_stderr)
-        args = parser.parse_args(argv[1:])
-        if args.media_type is None and args.media_path == '-':
-            parser.error('When reading from standard in --media-type/-t must be provided.')
-        return args
+    def parse(cls, argv: List[str], client_cwd: str, client_std_out: TextIO, job_stderr: TextIO,
+              open_files: bool = True):
+        """
+        :param open_files: When false, --output and --descriptor are set to the path of the file
+                           instead of an open file, so that parsing does not create or truncate
+                           the output file.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            parser = cls._instance
+            parser._set_client_context(argv[0], client_cwd, client_std_out, job_stderr)
+            parser._open_files = open_files
+            args = parser.parse_args(argv[1:])
+            if not args.media_paths and args.media_list is None:
+                parser.error('At least one media path or --media-list must be provided.')
+            if '-' in args.media_paths:
+                if args.media_type is None:
+                    parser.error('When reading from standard in --media-type/-t must be provided.')
+                if len(args.media_paths) > 1 or args.media_list is not None:
+                    parser.error('When reading media from standard in, no other media can be '
+                                 'provided.')
+            return args
+
+
+    def _set_client_context(self, exe_name: str, client_cwd: str, client_std_out: TextIO,
+                            job_stderr: TextIO) -> None:
+        self.prog = exe_name
+        self._client_cwd = client_cwd
+        self._job_stderr = job_stderr
+        # client_cwd is used to resolve relative paths in media lists. The property dictionaries
+        # are replaced so that values from a previous job are not carried over.
+        self.set_defaults(client_cwd=client_cwd, output=client_std_out, job_props={},
+                          media_metadata={})
 
 
-    def __init__(self, exe_name: str, client_cwd: str, client_std_out: TextIO, job_stderr: TextIO):
-        super().__init__(prog=exe_name)
-        self._job_stderr = job_stderr
+    def __init__(self):
+        super().__init__()
+        self._client_cwd = ''
+        self._job_stderr = sys.stderr
+        self._open_files = True
+
+        self.add_argument(
+            'media_paths', nargs='*', metavar='media_path',
+            type=lambda p: self.get_path(p, self._client_cwd),
+            help='Path to media to process. To read from standard in use "-". When more than one '
+                 'path is provided or a path is a directory, a single JSON output object '
+                 'containing the results for all of the media will be created.')
 
-        self.add_argument('media_path', type=lambda p: self.get_path(p, client_cwd),
-                          help='Path to media to process. To read from standard in use "-"')
+        self.add_argument(
+            '--media-list', '-L', type=lambda p: self.get_path(p, self._client_cwd),
+            help='Path to a file containing the paths of the media to process, one per line. '
+                 'To read the list from standard in use "-".')
         self.add_argument(
             '--media-type', '-t', enum=util.MediaType, action=self.ParseEnumAction,
             help='Specify type of media. Required when reading media from standard in. When not '
@@ -556,23 +960,46 @@ class ArgumentParser(argparse.ArgumentParser):
                  'processed. For audio, the time (0-based index, in milliseconds) to stop '
                  'processing the audio file.')
 
+        self.add_argument(
+            '--parallel', '-j', type=int, default=1, metavar='NUM_PARTS',
+            help='Split the job in to NUM_PARTS parts that run at the same time on separate '
+                 'executor processes. The results are merged in to a single output object. '
+                 'Batch jobs are split by media. Jobs with a single video are split in to frame '
+                 'ranges.')
+
         self.add_argument(
             '--daemon', '-d', action='store_true',
             help='Start up and sleep forever. This can be used to keep the Docker container alive '
                  'so that jobs can be started with `docker exec <container-id> runner ...` .')
 
+        self.add_argument(
+            '--server-stats', action='store_true',
+            help='Print the component server\'s statistics as JSON and exit. Must be the only '
+                 'argument.')
+
         self.add_argument('--pretty', '-p', action='store_true', help='Pretty print JSON output.')
 
         self.add_argument('--brief', action='store_true', help='Only output tracks.')
 
         self.add_argument(
-            '--output', '-o', type=self.FileTypeWithCustomDirectory(client_cwd, mode='w'),
-            default=client_std_out,
+            '--output-format', choices=mpf_cli_output_encoders.OUTPUT_FORMATS, default='json',
+            help='"json" writes a single JSON object once the job is complete. "msgpack" and '
+                 '"cbor" write the same object using MessagePack or CBOR. "ndjson" writes one '
+                 'track per line as soon as the component produces it. "ndjson-sorted" writes '
+                 'one track per line in the same order as the "json" format. '
+                 'Defaults to "json".')
+
+        self.add_argument(
+            '--output', '-o',
+            type=self.FileTypeWithCustomDirectory(lambda: self._client_cwd,
+                                                  lambda: self._open_files, mode='w'),
             help='The path where the JSON output should written. '
                  'When omitted, JSON output is written to standard out.')
 
         self.add_argument(
-            '--descriptor', type=self.FileTypeWithCustomDirectory(client_cwd),
+            '--descriptor',
+            type=self.FileTypeWithCustomDirectory(lambda: self._client_cwd,
+                                                  lambda: self._open_files),
             dest='descriptor_file',
             help='Specifies which descriptor to use when multiple descriptors are present. '
                  'Usually only needed when running outside of docker.')
@@ -582,11 +1009,35 @@ class ArgumentParser(argparse.ArgumentParser):
             help='When provided once, set the log level to DEBUG. '
                  'When provided twice (e.g. "-vv"), set the log level to TRACE')
 
+        self.add_argument(
+            '--progress', choices=('line', 'json'),
+            help='Report the job\'s progress to standard error while it is running. "line" '
+                 'writes a line of text for each update. "json" writes each update as a JSON '
+                 'object on its own line.')
+
+        self.add_argument(
+            '--profile', action='store_true', default=util.profile_jobs(),
+            help='Add the time spent in each phase of the job to the JSON output and log it. '
+                 'Enabled for all jobs when the CLI_RUNNER_PROFILE environment variable is '
+                 'set to "true".')
+
+        self.add_argument(
+            '--profile-output', type=lambda p: self.get_path(p, self._client_cwd, 'w'),
+            metavar='PSTATS_PATH',
+            help='Profile the job with cProfile and write the statistics to PSTATS_PATH. '
+                 'The statistics can be loaded with Python\'s pstats module.')
+
 
     def print_help(self, file=None) -> None:
         super().print_help(file or self._job_stderr)
 
 
+    def _print_message(self, message: str, file=None) -> None:
+        # Usage errors must go to the client, even when sys.stderr was not redirected because
+        # other jobs are running in this process.
+        super()._print_message(message, self._job_stderr)
+
+
     class ParseEnumAction(argparse.Action):
         def __init__(self, enum: EnumMeta, **kwargs):
             kwargs['choices'] = [e.name.lower() for e in enum]
@@ -611,13 +1062,18 @@ class ArgumentParser(argparse.ArgumentParser):
 
 
     class FileTypeWithCustomDirectory(argparse.FileType):
-        def __init__(self, cwd, **kwargs):
+        def __init__(self, get_cwd: Callable[[], str], should_open: Callable[[], bool],
+                     **kwargs):
             super().__init__(**kwargs)
-            self.__cwd = cwd
+            self.__get_cwd = get_cwd
+            self.__should_open = should_open
             self.__mode = kwargs.get('mode', 'r')
 
         def __call__(self, path):
-            return super().__call__(ArgumentParser.get_path(path, self.__cwd, self.__mode))
+            client_path = ArgumentParser.get_path(path, self.__get_cwd(), self.__mode)
+            if self.__should_open():
+                return super().__call__(client_path)
+            return client_path
 
 
     @staticmethod
@@ -625,14 +1081,11 @@ class ArgumentParser(argparse.ArgumentParser):
         if path == '-':
             return path
 
-        # If path is an absolute path, join does nothing.
-        client_path = os.path.join(client_cwd, path)
         if mode == 'r':
-            if os.path.exists(client_path) or not os.path.exists(path):
-                return client_path
-            else:
-                return path
+            return mpf_cli_job_runner.get_client_path(path, client_cwd)
         else:
+            # If path is an absolute path, join does nothing.
+            client_path = os.path.join(client_cwd, path)
             client_dir_name = os.path.dirname(client_path)
             provided_dir_name = os.path.dirname(path)
             if os.path.isdir(client_dir_name) or not os.path.isdir(provided_dir_name):
@@ -0,0 +1,315 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+from __future__ import annotations
+
+import array
+import contextlib
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import traceback
+from typing import Dict, Iterable, List, NoReturn, Optional, Tuple
+
+import mpf_cli_executor_process
+import mpf_cli_runner_util as util
+
+log = logging.getLogger('org.mitre.mpf.cli')
+
+
+# Used for the pid of a new executor process and for its exit code.
+_INT_STRUCT = struct.Struct('!i')
+
+
+class ExecutorTemplate(contextlib.AbstractContextManager):
+    """
+    Starts the executor template process. The template process initializes the component once.
+    New executor processes are then forked from the template instead of from the component server,
+    so they start with the component already initialized. Memory pages that are not modified after
+    the fork, like most of a model's weights, are shared between all of the executor processes.
+
+    The protocol between ComponentServer and the template process is as follows:
+    1. The template process initializes the component and then sends a 1 byte message to indicate
+       that it is ready. If initialization fails, the template process exits instead.
+    2. To start an executor process, ComponentServer sends a message containing two file
+       descriptors. The first is the executor's end of the socket pair that the executor uses to
+       communicate with ComponentServer. The second is the write end of a pipe. The one byte of
+       regular data is 1 when the executor should report when it is ready for a job, or 0 when a
+       job will be submitted immediately.
+    3. The template process forks, and then replies with the pid of the new executor process.
+    4. When the executor process exits, the template process writes its exit code to the pipe and
+       closes it. ComponentServer uses the read end of the pipe in the same way it uses the
+       sentinel of an executor process started with multiprocessing.
+    5. When ComponentServer closes its end of the socket pair, the template process exits.
+    """
+    def __init__(self, sockets_to_close: Iterable[socket.socket],
+                 metrics_socket: Optional[socket.socket] = None):
+        self._template_sock, from_server = socket.socketpair(socket.AF_UNIX)
+        with from_server, contextlib.ExitStack() as exit_stack:
+            exit_stack.enter_context(self._template_sock)
+            self._process = multiprocessing.Process(
+                target=_run_template_in_subprocess,
+                args=(from_server, [*sockets_to_close, self._template_sock], metrics_socket),
+                daemon=True)
+            self._process.start()
+            self.pid = self._process.pid
+            exit_stack.callback(self._stop_process)
+            self._exit_stack = exit_stack.pop_all()
+
+
+    def wait_until_ready(self) -> bool:
+        """
+        Blocks until the template process has initialized the component.
+        :return: True if the template process is ready to fork executor processes.
+        """
+        if self._template_sock.recv(1):
+            log.info(f'Executor template process {self._process.pid} is ready.')
+            return True
+        log.error('The executor template process exited before initializing the component. '
+                  'Executor processes will initialize the component separately.')
+        return False
+
+
+    def fork_executor(self, from_parent_socket: socket.socket,
+                      init_component_on_start: bool) -> ForkedExecutorProcess:
+        """
+        Forks a new executor process from the template process. This blocks the component server
+        while the template process forks, which takes milliseconds.
+        :raises OSError: When the template process has exited.
+        """
+        exit_status_read_fd, exit_status_write_fd = os.pipe()
+        try:
+            util.send_fds(self._template_sock, from_parent_socket.fileno(), exit_status_write_fd,
+                          data=bytes((init_component_on_start,)))
+            pid_bytes = self._template_sock.recv(_INT_STRUCT.size, socket.MSG_WAITALL)
+            if len(pid_bytes) != _INT_STRUCT.size:
+                raise BrokenPipeError('The executor template process exited.')
+        except BaseException:
+            os.close(exit_status_read_fd)
+            raise
+        finally:
+            os.close(exit_status_write_fd)
+        return ForkedExecutorProcess(_INT_STRUCT.unpack(pid_bytes)[0], exit_status_read_fd)
+
+
+    def is_alive(self) -> bool:
+        return self._process.is_alive()
+
+    def get_socket(self) -> socket.socket:
+        return self._template_sock
+
+    def terminate(self) -> None:
+        self._process.terminate()
+
+    def _stop_process(self) -> None:
+        # Closing the socket tells the template process to exit.
+        self._template_sock.close()
+        self._process.join(0.5)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._process.close()
+
+    def __exit__(self, *exc_details):
+        return self._exit_stack.__exit__(*exc_details)
+
+
+
+class ForkedExecutorProcess:
+    """
+    Used in place of multiprocessing.Process for executor processes that were forked from the
+    executor template. They are children of the template process rather than the component server,
+    so the template process reports their exit codes through a pipe.
+    """
+    def __init__(self, pid: int, exit_status_fd: int):
+        self.pid = pid
+        self.sentinel = exit_status_fd
+        self.exitcode: Optional[int] = None
+
+    def is_alive(self) -> bool:
+        self.join(0)
+        return self.exitcode is None
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        if self.exitcode is not None or not select.select([self.sentinel], [], [], timeout)[0]:
+            return
+        exit_status = os.read(self.sentinel, _INT_STRUCT.size)
+        if len(exit_status) == _INT_STRUCT.size:
+            self.exitcode = _INT_STRUCT.unpack(exit_status)[0]
+        else:
+            # The template process exited without reporting the executor's exit code, so there is
+            # no longer a way to tell when the executor exits.
+            log.error(f'Killing executor process {self.pid} because the executor template '
+                      'process exited.')
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(self.pid, signal.SIGKILL)
+            self.exitcode = -signal.SIGKILL
+
+    def terminate(self) -> None:
+        if self.exitcode is None:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(self.pid, signal.SIGTERM)
+
+    def close(self) -> None:
+        os.close(self.sentinel)
+
+
+
+def _run_template_in_subprocess(from_server_socket: socket.socket,
+                                sockets_to_close: Iterable[socket.socket],
+                                metrics_socket: Optional[socket.socket]) -> None:
+    for s in sockets_to_close:
+        s.close()
+    log.info(f'Executor template process started with pid {os.getpid()}.')
+    with mpf_cli_executor_process.ExecutorProcess(
+            from_server_socket, metrics_socket=metrics_socket) as executor:
+        if executor.init_component_in_template():
+            _ExecutorForker(from_server_socket, executor).run()
+
+
+class _ExecutorForker:
+    """
+    Runs in the template process. Forks new executor processes when requested by the component
+    server and reports their exit codes.
+    """
+    def __init__(self, from_server_socket: socket.socket,
+                 executor: mpf_cli_executor_process.ExecutorProcess):
+        self._from_server_socket = from_server_socket
+        self._executor = executor
+        # Maps the pid of each running executor process to the pipe used to report its exit code.
+        self._exit_status_fds: Dict[int, int] = {}
+        # Written to by the SIGCHLD handler when an executor process exits.
+        self._wakeup_read_fd, self._wakeup_write_fd = os.pipe()
+        os.set_blocking(self._wakeup_read_fd, False)
+        os.set_blocking(self._wakeup_write_fd, False)
+
+
+    def run(self) -> None:
+        signal.set_wakeup_fd(self._wakeup_write_fd)
+        # A Python handler must be installed for the wakeup file descriptor to be written to.
+        signal.signal(signal.SIGCHLD, lambda sig_num, frame: None)
+        self._from_server_socket.send(b'\x00')
+
+        poller = select.poll()
+        poller.register(self._from_server_socket, select.POLLIN)
+        poller.register(self._wakeup_read_fd, select.POLLIN)
+        while True:
+            for fd, _ in poller.poll():
+                if fd == self._wakeup_read_fd:
+                    with contextlib.suppress(BlockingIOError):
+                        os.read(self._wakeup_read_fd, 4096)
+                    self._reap_executors()
+                elif not self._fork_executor():
+                    log.info('Executor template process exiting because it was stopped by the '
+                             'component server.')
+                    return
+
+
+    def _fork_executor(self) -> bool:
+        init_component_on_start, fds = self._recv_fork_request()
+        if len(fds) != 2:
+            for fd in fds:
+                os.close(fd)
+            return False
+        from_parent_fd, exit_status_fd = fds
+
+        pid = os.fork()
+        if pid == 0:
+            os.close(exit_status_fd)
+            self._run_forked_executor(from_parent_fd, init_component_on_start)
+
+        os.close(from_parent_fd)
+        self._exit_status_fds[pid] = exit_status_fd
+        self._from_server_socket.sendall(_INT_STRUCT.pack(pid))
+        return True
+
+
+    def _recv_fork_request(self) -> Tuple[bool, List[int]]:
+        fds = array.array('i')
+        data, ancillary_data, _, _ = self._from_server_socket.recvmsg(
+            1, socket.CMSG_LEN(2 * fds.itemsize))
+        for cmsg_level, cmsg_type, cmsg_data in ancillary_data:
+            if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+        return data == b'\x01', list(fds)
+
+
+    def _run_forked_executor(self, from_parent_fd: int, init_component_on_start: bool) -> NoReturn:
+        exit_code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # The new executor process must not hold on to the template's resources. If it kept
+            # the other executors' exit status pipes open, the component server would not be able
+            # to tell that the template process exited.
+            os.close(self._wakeup_read_fd)
+            os.close(self._wakeup_write_fd)
+            for fd in self._exit_status_fds.values():
+                os.close(fd)
+
+            log.info(f'Executor process started with pid {os.getpid()} from the executor '
+                     'template process.')
+            self._executor.attach_to_server(socket.socket(fileno=from_parent_fd),
+                                            init_component_on_start)
+            with self._executor:
+                self._executor.run_jobs()
+            exit_code = 0
+        except SystemExit as e:
+            # Matches how multiprocessing determines the exit code.
+            if e.code is None:
+                exit_code = 0
+            elif isinstance(e.code, int):
+                exit_code = e.code
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            # The executor process must not return to the template's loop or run the template's
+            # clean up code.
+            with contextlib.suppress(Exception):
+                sys.stdout.flush()
+                sys.stderr.flush()
+            os._exit(exit_code)
+
+
+    def _reap_executors(self) -> None:
+        while self._exit_status_fds:
+            try:
+                pid, wait_status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            exit_status_fd = self._exit_status_fds.pop(pid, None)
+            if exit_status_fd is None:
+                continue
+            with contextlib.suppress(OSError):
+                os.write(exit_status_fd, _INT_STRUCT.pack(os.waitstatus_to_exitcode(wait_status)))
+            os.close(exit_status_fd)
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+
+"""
+The command line client that runs for each job. Starting the client is part of the time it takes
+to run every job, so it only imports modules that are built in to the interpreter. When the
+component server is not running, or the arguments require more than submitting a single job, the
+full client in mpf_cli_client is used instead.
+
+See mpf_cli_protocol for a description of the messages.
+"""
+
+import os
+import sys
+
+import _json
+import _socket
+
+# The following must match mpf_cli_runner_util and mpf_cli_protocol. They are copied so that
+# those modules and their dependencies are not imported.
+_SOCKET_ADDRESS = b'\x00mpf_cli_runner.sock'
+_SERVER_BUSY_EXIT_CODE = 7
+_JOB_PROP_ENV_PREFIX = 'MPF_PROP_'
+
+_MAGIC = b'MP'
+_PROTOCOL_VERSION = 1
+_HEADER_SIZE = 8
+_MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+_HELLO_PAYLOAD = b'{"versions":[1],"capabilities":["pipelining","job-status","progress"]}'
+
+_MESSAGE_TYPE_NAMES = ('HELLO', 'HELLO_ACK', 'JOB_REQUEST', 'JOB_STATUS', 'END', 'REJECTED',
+                       'ERROR', 'PROGRESS')
+# The following must match the options in mpf_cli_executor_process.ArgumentParser. They are used
+# to find options without importing argparse.
+_OPTIONS_WITH_VALUES = ('--media-list', '--media-type', '--job-prop', '--media-metadata',
+                        '--begin', '--end', '--parallel', '--output-format', '--output',
+                        '--descriptor', '--progress', '--profile-output')
+_FLAG_OPTIONS = ('--help', '--daemon', '--server-stats', '--pretty', '--brief', '--verbose',
+                 '--profile')
+_SHORT_OPTIONS = {'-h': '--help', '-L': '--media-list', '-t': '--media-type', '-P': '--job-prop',
+                  '-M': '--media-metadata', '-b': '--begin', '-e': '--end', '-j': '--parallel',
+                  '-d': '--daemon', '-p': '--pretty', '-o': '--output', '-v': '--verbose'}
+
+_HELLO = 1
+_HELLO_ACK = 2
+_JOB_REQUEST = 3
+_JOB_STATUS = 4
+_END = 5
+_REJECTED = 6
+_PROGRESS = 8
+
+
+def main():
+    if not _is_single_job(sys.argv):
+        _run_full_client()
+        return
+
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(_SOCKET_ADDRESS)
+        except ConnectionRefusedError:
+            # The full client starts the component server.
+            sock.close()
+            _run_full_client()
+            return
+        exit_code = _submit_job(sock)
+    finally:
+        sock.close()
+    sys.exit(exit_code)
+
+
+def _is_single_job(argv):
+    args = argv[1:]
+    if len(args) == 1 and args[0] in ('-d', '--daemon', '--server-stats'):
+        return False
+    return not is_parallel_job(argv)
+
+
+def is_parallel_job(argv):
+    """ :return: Whether the --parallel argument is present. """
+    return any(option == '--parallel' for option, _, _ in iter_args(argv))
+
+
+def _run_full_client():
+    import mpf_cli_client
+    mpf_cli_client.main()
+
+
+def _submit_job(sock):
+    try:
+        _send_frame(sock, _HELLO, create_hello_payload(get_descriptor_path(sys.argv)))
+        _send_frame(sock, _JOB_REQUEST, _encode_job_request(sys.argv), (0, 1, 2))
+        _send_frame(sock, _END, b'{}')
+    except (BrokenPipeError, ConnectionResetError):
+        # The server may reject the job without reading the job request. In that case, the
+        # response has already been sent.
+        pass
+
+    message_type, payload = _recv_message(sock)
+    if message_type is None:
+        print('ERROR: Server closed connection before completing the job.', file=sys.stderr)
+        return 6
+    if message_type == _REJECTED:
+        print('ERROR: The job was rejected because the server has too many queued jobs.',
+              file=sys.stderr)
+        return payload.get('exit_code', _SERVER_BUSY_EXIT_CODE)
+    if message_type != _HELLO_ACK:
+        print(f'ERROR: The server did not accept the job: {payload}', file=sys.stderr)
+        return 6
+
+    progress_format = get_progress_format(sys.argv)
+    message_type, payload = _recv_message(sock)
+    while message_type == _PROGRESS:
+        if progress_format:
+            write_progress(progress_format, payload)
+        message_type, payload = _recv_message(sock)
+    if message_type is None:
+        print('ERROR: Server closed connection before completing the job.', file=sys.stderr)
+        return 6
+    if message_type != _JOB_STATUS:
+        print(f'ERROR: Received unexpected {_get_type_name(message_type)} message from the '
+              f'server: {payload}', file=sys.stderr)
+        return 6
+    return payload['exit_code']
+
+
+def get_progress_format(argv):
+    """ :return: The value of the --progress argument, or None when it is not present. """
+    return _get_option_value(argv, '--progress')
+
+
+def get_descriptor_path(argv):
+    """
+    :return: The absolute path of the --descriptor argument, or None when it is not present.
+    """
+    descriptor_path = _get_option_value(argv, '--descriptor')
+    if descriptor_path is None or descriptor_path == '-':
+        return None
+    return os.path.realpath(descriptor_path)
+
+
+def create_hello_payload(descriptor_path=None):
+    """
+    The component server uses the descriptor path in the HELLO message to send the job to an
+    executor process that already initialized that component.
+    """
+    if descriptor_path is None:
+        return _HELLO_PAYLOAD
+    return (_HELLO_PAYLOAD[:-1] + b',"descriptor":'
+            + _json.encode_basestring_ascii(descriptor_path).encode() + b'}')
+
+
+def _get_option_value(argv, option):
+    # Like argparse, the last occurrence of an option is used.
+    value = None
+    for arg_option, arg_value, _ in iter_args(argv):
+        if arg_option == option:
+            value = arg_value
+    return value
+
+
+def iter_args(argv):
+    """
+    Splits the command line arguments in the same way as the executor's ArgumentParser, so that
+    an option's value, like a media path or job property that starts with "-j", is never mistaken
+    for an option.
+    :return: An (option, value, args) tuple for each option and positional argument. option is the
+             option's long name, or None for positional arguments. value is None for options that
+             do not take a value. args holds the command line arguments that make up the option,
+             so that it can be passed on to another job.
+    """
+    remaining_args = iter(argv[1:])
+    for arg in remaining_args:
+        if arg == '--':
+            for positional_arg in remaining_args:
+                yield None, positional_arg, (positional_arg,)
+            return
+        if arg.startswith('--'):
+            name, has_value, value = arg.partition('=')
+            option = _resolve_long_option(name)
+            if has_value or option not in _OPTIONS_WITH_VALUES:
+                yield option, value if has_value else None, (arg,)
+            else:
+                value = next(remaining_args, None)
+                yield option, value, (arg,) if value is None else (arg, value)
+        elif arg.startswith('-') and len(arg) > 1:
+            yield from _iter_short_options(arg, remaining_args)
+        else:
+            yield None, arg, (arg,)
+
+
+def _resolve_long_option(name):
+    if name in _OPTIONS_WITH_VALUES or name in _FLAG_OPTIONS:
+        return name
+    # Like argparse, accept unambiguous abbreviations.
+    matches = [o for o in (*_OPTIONS_WITH_VALUES, *_FLAG_OPTIONS) if o.startswith(name)]
+    return matches[0] if len(matches) == 1 else name
+
+
+def _iter_short_options(arg, remaining_args):
+    # Short options can be combined, like "-vv" or "-pj4".
+    for i in range(1, len(arg)):
+        short_option = '-' + arg[i]
+        option = _SHORT_OPTIONS.get(short_option, short_option)
+        if option not in _OPTIONS_WITH_VALUES:
+            yield option, None, (short_option,)
+            continue
+
+        value = arg[i + 1:]
+        if value:
+            if value.startswith('='):
+                value = value[1:]
+            # The "=" keeps argparse from treating a value that starts with "-" as an option.
+            yield option, value, (f'{short_option}={value}',)
+        else:
+            value = next(remaining_args, None)
+            yield option, value, (short_option,) if value is None else (short_option, value)
+        return
+
+
+def write_progress(progress_format, progress, file=None):
+    """ Writes the payload of a PROGRESS message in the format given by --progress. """
+    file = file or sys.stderr
+    if progress_format == 'json':
+        file.write(_encode_flat_json(progress) + '\n')
+    else:
+        file.write(_describe_progress(progress) + '\n')
+    file.flush()
+
+
+def _describe_progress(progress):
+    parts = []
+    if progress.get('num_media', 1) > 1:
+        parts.append(f'media {progress.get("media_number")} of {progress["num_media"]}')
+    frames_processed = progress.get('frames_processed')
+    total_frames = progress.get('total_frames')
+    if frames_processed is not None:
+        if total_frames:
+            percent = min(100 * frames_processed / total_frames, 100)
+            parts.append(f'frame {frames_processed} of {total_frames} ({percent:.1f}%)')
+        else:
+            parts.append(f'frame {frames_processed}')
+    parts.append(f'{progress.get("tracks", 0)} tracks')
+    parts.append(f'{progress.get("detections", 0)} detections')
+    parts.append(f'{progress.get("elapsed_ms", 0) / 1000:.0f} s elapsed')
+    return 'Progress: ' + ', '.join(parts)
+
+
+def _encode_flat_json(obj):
+    # PROGRESS payloads only contain numbers, strings, and nulls.
+    encode = _json.encode_basestring_ascii
+    items = []
+    for key, value in obj.items():
+        if value is None:
+            encoded_value = 'null'
+        elif isinstance(value, bool):
+            encoded_value = 'true' if value else 'false'
+        elif isinstance(value, (int, float)):
+            encoded_value = repr(value)
+        else:
+            encoded_value = encode(str(value))
+        items.append(f'{encode(key)}:{encoded_value}')
+    return '{' + ','.join(items) + '}'
+
+
+def _encode_job_request(argv):
+    # The payload only contains strings and a job id, so it is encoded using the C string
+    # encoder instead of importing the json module.
+    encode = _json.encode_basestring_ascii
+    env_props = ','.join(
+        f'{encode(name[len(_JOB_PROP_ENV_PREFIX):])}:{encode(value)}'
+        for name, value in os.environ.items()
+        if len(name) > len(_JOB_PROP_ENV_PREFIX) and name.startswith(_JOB_PROP_ENV_PREFIX))
+    return (f'{{"job_id":0,"argv":[{",".join(map(encode, argv))}],'
+            f'"cwd":{encode(os.getcwd())},"env_props":{{{env_props}}}}}').encode()
+
+
+def _send_frame(sock, message_type, payload, fds=()):
+    frame = (_MAGIC + bytes((_PROTOCOL_VERSION, message_type))
+             + len(payload).to_bytes(4, 'big') + payload)
+    if fds:
+        fd_bytes = b''.join(fd.to_bytes(4, sys.byteorder, signed=True) for fd in fds)
+        num_sent = sock.sendmsg([frame], [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS, fd_bytes)])
+        frame = frame[num_sent:]
+    if frame:
+        sock.sendall(frame)
+
+
+def _recv_message(sock):
+    """
+    :return: The message type and payload, or (None, None) if the connection was closed.
+    """
+    try:
+        header = _recv_exactly(sock, _HEADER_SIZE)
+        if header is None:
+            return None, None
+        payload_size = int.from_bytes(header[4:], 'big')
+        if (header[:2] != _MAGIC or header[2] != _PROTOCOL_VERSION
+                or payload_size > _MAX_PAYLOAD_SIZE):
+            raise RuntimeError('Received an invalid message from the server.')
+        payload = _recv_exactly(sock, payload_size) if payload_size > 0 else b'{}'
+        if payload is None:
+            raise RuntimeError('Connection closed in the middle of a message.')
+        return header[3], _loads_json(payload.decode())
+    except ConnectionResetError:
+        return None, None
+
+
+def _recv_exactly(sock, num_bytes):
+    chunks = []
+    num_received = 0
+    while num_received < num_bytes:
+        data = sock.recv(num_bytes - num_received)
+        if not data:
+            if num_received == 0:
+                return None
+            raise RuntimeError('Connection closed in the middle of a message.')
+        chunks.append(data)
+        num_received += len(data)
+    return b''.join(chunks)
+
+
+class _JsonScannerContext:
+    # The attributes the C JSON scanner reads. Using the scanner directly avoids importing
+    # json.decoder, which imports and compiles regular expressions.
+    strict = True
+    object_hook = None
+    object_pairs_hook = None
+    parse_float = float
+    parse_int = int
+    parse_constant = float
+
+
+_scan_json = _json.make_scanner(_JsonScannerContext())
+
+
+def _loads_json(json_str):
+    try:
+        value, end = _scan_json(json_str, 0)
+    except StopIteration:
+        value, end = None, -1
+    if end != len(json_str) or not isinstance(value, dict):
+        raise RuntimeError(f'Received an invalid message payload from the server: {json_str}')
+    return value
+
+
+def _get_type_name(message_type):
+    if 0 < message_type <= len(_MESSAGE_TYPE_NAMES):
+        return _MESSAGE_TYPE_NAMES[message_type - 1]
+    return str(message_type)
+
+
+if __name__ == '__main__':
+    main()
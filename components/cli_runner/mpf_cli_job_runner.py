@@ -24,23 +24,44 @@
 # limitations under the License.                                            #
 #############################################################################
 
+from __future__ import annotations
+
 import argparse
 import contextlib
 import datetime
-import json
+import errno
+import heapq
 import logging
 import mimetypes
 import os
-import shutil
-import subprocess
+import select
 import tempfile
-from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, \
-    TextIO, Union
-
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, \
+    TextIO, Tuple, Union
+
+import mpf_cli_descriptors
+import mpf_cli_media_info
+import mpf_cli_metrics
+import mpf_cli_output_encoders as encoders
 import mpf_cli_runner_util as util
 
 log = logging.getLogger('org.mitre.mpf.cli')
 
+# Maximum number of tracks held in memory when sorting NDJSON output. When a job produces more
+# tracks than this, sorted runs are written to temporary files and then merged.
+NDJSON_SORT_BUFFER_SIZE = 10_000
+
+
+class Media(NamedTuple):
+    path: str
+    mime_type: str
+    media_type: util.MediaType
+    # Media metadata provided on the command line. Additional metadata, like FPS, is added when the
+    # job for the media is about to run.
+    provided_metadata: Dict[str, str]
+
 
 class JobRunner(contextlib.AbstractContextManager):
     def __init__(self,
@@ -48,90 +69,214 @@ class JobRunner(contextlib.AbstractContextManager):
                  env_props: Mapping[str, str],
                  job_stdin: TextIO,
                  component,
-                 descriptor):
+                 descriptor: mpf_cli_descriptors.Descriptor,
+                 job_property_defaults: JobPropertyDefaults,
+                 stdin_spool: Optional[StdinVideoSpool] = None,
+                 prior_phase_times_ms: Optional[Mapping[str, float]] = None,
+                 progress_listener: Optional[Callable[[Dict[str, Any]], None]] = None):
         with contextlib.ExitStack() as exit_stack:
+            self._phase_timer = mpf_cli_metrics.PhaseTimer()
+            # Phases that completed before the JobRunner was created, like argument parsing.
+            self._prior_phase_times_ms = prior_phase_times_ms or {}
             self._output_dest = cmd_line_args.output
             exit_stack.push(self._output_dest)
 
             self._component_handle = component
             self._sdk_module = component.sdk_module
 
-            self._mime_type = self._get_mime_type(
-                cmd_line_args.media_type, cmd_line_args.media_path, cmd_line_args.media_metadata)
-
-            self._media_type = self._get_media_type(
-                cmd_line_args.media_type, self._mime_type)
+            media_paths = get_media_paths(cmd_line_args, job_stdin)
+            self._is_batch = is_batch_job(cmd_line_args)
+            if self._is_batch:
+                log.info(f'Found {len(media_paths)} media files to process.')
 
-            if not self._component_handle.supports(self._media_type):
-                raise RuntimeError(
-                    f'The component does not support {self._media_type.name.lower()} jobs.')
+            with self._phase_timer.phase('media_resolution'):
+                self._media = [
+                    self._get_media(p, cmd_line_args, job_stdin, stdin_spool, exit_stack)
+                    for p in media_paths]
 
-            self._media_path = self._get_media_path(
-                cmd_line_args.media_path, self._media_type, job_stdin, exit_stack)
-
-            self._media_metadata = self._get_media_metadata(
-                self._media_path, self._media_type, cmd_line_args.media_metadata)
-
-            self._job_props = self._get_combined_job_props(
-                cmd_line_args.job_props, env_props, descriptor)
-            self._track_type = descriptor['algorithm']['trackType']
+            # Properties from the command line take precedence over the client's MPF_PROP_
+            # environment variables.
+            self._job_props = job_property_defaults.overlay({**env_props,
+                                                             **cmd_line_args.job_props})
+            self._track_type = descriptor.track_type
 
             self._begin = cmd_line_args.begin
             self._end = cmd_line_args.end
             self._pretty_print_results = cmd_line_args.pretty
             self._brief_output = cmd_line_args.brief
+            self._output_format = cmd_line_args.output_format
+            self._include_timing = cmd_line_args.profile
+            if self._output_format in ('msgpack', 'cbor'):
+                # Fail before running the component when the encoder's package is missing.
+                encoders.get_binary_encoder(self._output_format)
+            self._progress = JobProgress(len(self._media))
+            # Called periodically with the job's progress when the client requested it.
+            self._progress_listener = progress_listener
             self._exit_stack = exit_stack.pop_all()
 
 
     def __exit__(self, *exc_details):
         return self._exit_stack.__exit__(*exc_details)
 
+
+    @property
+    def result_counts(self) -> Dict[str, int]:
+        """ Counts for the media that have been processed so far. Reported in the job status. """
+        return {'media': len(self._media), 'tracks': self._progress.num_tracks,
+                'detections': self._progress.num_detections}
+
+
+    @property
+    def phase_times_ms(self) -> Dict[str, float]:
+        """
+        Time spent resolving and probing media, running the component, converting and sorting the
+        component's results, and serializing the output. Reported in the job status and the
+        component server's metrics.
+        """
+        return self._phase_timer.get_times_ms()
+
+
     def run_job(self):
-        job = self._create_job()
-        start_time = datetime.datetime.now()
-        component_results = self._component_handle.run_job(job)
+        with self._progress.run_heartbeats(util.get_progress_interval(),
+                                           self._progress_listener):
+            if self._output_format in encoders.NDJSON_OUTPUT_FORMATS:
+                for media in self._media:
+                    self._stream_media_job(media)
+                return
+
+            start_time = datetime.datetime.now()
+            media_results = [(media, self._run_media_job(media)) for media in self._media]
+            wrapped_results = self._wrap_component_results(media_results, start_time)
+            with self._phase_timer.phase('serialization'):
+                encoders.write_document(wrapped_results, self._output_format,
+                                        self._pretty_print_results, self._output_dest)
+
+
+    def _run_media_job(self, media: Media) -> Tuple[Dict[str, str], List[Dict[str, Any]]]:
+        media_metadata, track_dicts = self._start_media_job(media)
+        # The document output formats need every track before any output can be written, so the
+        # tracks are kept in memory. The NDJSON output formats do not keep them.
+        result_dicts = list(track_dicts)
+        with self._phase_timer.phase('sort'):
+            ComponentResultToDictConverter.sort_track_dicts(result_dicts)
+        self._log_result_counts(media)
+        return media_metadata, result_dicts
+
+
+    def _stream_media_job(self, media: Media) -> None:
+        """
+        Writes each track to the output as its own line of JSON. When the output format is
+        "ndjson", tracks are written as soon as the component produces them. When the output
+        format is "ndjson-sorted", tracks are written in the same order as the "json" format,
+        but at most NDJSON_SORT_BUFFER_SIZE tracks are held in memory.
+        """
+        _, track_dicts = self._start_media_job(media)
+        if self._output_format == 'ndjson-sorted':
+            # Producing the first sorted line consumes all of the tracks, but the nested component
+            # and conversion phases are still counted separately.
+            track_lines = self._phase_timer.iterate('sort', sort_track_lines(track_dicts))
+        else:
+            track_lines = map(encoders.dumps_json, track_dicts)
 
-        if self._media_type == util.MediaType.VIDEO:
-            fps = float(self._media_metadata['FPS'])
+        if self._brief_output:
+            line_prefix = ''
+            line_suffix = '\n'
+        else:
+            # The track JSON is inserted as a string so that sorted lines do not need to be
+            # parsed again.
+            line_prefix = f'{{"path":{encoders.dumps_json(media.path)},"track":'
+            line_suffix = '}\n'
+
+        # Time spent producing and converting the component's results is counted separately
+        # because they are nested phases.
+        with self._phase_timer.phase('serialization'):
+            for line in track_lines:
+                self._output_dest.write(line_prefix)
+                self._output_dest.write(line)
+                self._output_dest.write(line_suffix)
+                # Flush each line so that consumers can start processing before the job completes.
+                self._output_dest.flush()
+        self._log_result_counts(media)
+
+
+    def _start_media_job(self, media: Media) -> Tuple[Dict[str, str], Iterator[Dict[str, Any]]]:
+        is_video = media.media_type == util.MediaType.VIDEO
+        self._progress.start_media(is_video, self._begin if is_video else 0)
+        with self._phase_timer.phase('media_probe'):
+            media_metadata = self._get_media_metadata(
+                media.path, media.media_type, media.provided_metadata)
+            if is_video and self._progress_listener is not None:
+                # Only needed to report the progress, so the frame count is not probed otherwise.
+                self._progress.total_frames = self._get_num_frames_to_process(media.path)
+        job = self._create_job(media, media_metadata)
+        with self._phase_timer.phase('component'):
+            component_results = self._component_handle.run_job(job)
+        # Components may produce their results lazily, so the time spent producing each result is
+        # also counted as component time.
+        component_results = self._phase_timer.iterate('component', component_results)
+
+        if media.media_type == util.MediaType.VIDEO:
+            fps = float(media_metadata['FPS'])
         else:
             fps = 0
 
-        result_dicts = ComponentResultToDictConverter.convert(
-            fps, self._component_handle.track_type, component_results)
-
-        if self._media_type == util.MediaType.IMAGE:
-            log.info(f'Found {len(result_dicts)} detections.\n')
-        elif self._media_type == util.MediaType.VIDEO:
-            num_detections = sum(len(t['detections']) for t in result_dicts)
-            log.info(f'Found {len(result_dicts)} tracks containing a total of '
+        track_dicts = ComponentResultToDictConverter.convert_lazily(
+            fps, self._track_type, component_results)
+        # Tracks are counted as they are produced, so that the heartbeat reports the progress of
+        # components that yield their results.
+        return media_metadata, self._progress.count_tracks(
+            self._phase_timer.iterate('conversion', track_dicts))
+
+
+    def _log_result_counts(self, media: Media) -> None:
+        num_tracks = self._progress.media_tracks
+        num_detections = self._progress.media_detections
+        log_prefix = f'{media.path}: ' if self._is_batch else ''
+        if media.media_type == util.MediaType.IMAGE:
+            log.info(f'{log_prefix}Found {num_tracks} detections.\n')
+        elif media.media_type == util.MediaType.VIDEO:
+            log.info(f'{log_prefix}Found {num_tracks} tracks containing a total of '
                      f'{num_detections} detections.\n')
         else:
-            log.info(f'Found {len(result_dicts)} tracks.\n')
+            log.info(f'{log_prefix}Found {num_tracks} tracks.\n')
+
+
+    def _get_media(self, media_path: str, cmd_line_args: argparse.Namespace, job_stdin: TextIO,
+                   stdin_spool: Optional[StdinVideoSpool],
+                   exit_stack: contextlib.ExitStack) -> Media:
+        # Each piece of media gets its own copy, because _get_mime_type adds MIME_TYPE to it.
+        media_metadata = dict(cmd_line_args.media_metadata)
+        mime_type = self._get_mime_type(cmd_line_args.media_type, media_path, media_metadata)
+        media_type = self._get_media_type(cmd_line_args.media_type, mime_type)
+
+        if not self._component_handle.supports(media_type):
+            error_prefix = f'{media_path}: ' if self._is_batch else ''
+            raise RuntimeError(
+                f'{error_prefix}The component does not support {media_type.name.lower()} jobs.')
 
-        wrapped_results = self._wrap_component_results(result_dicts, start_time)
-        indent = 4 if self._pretty_print_results else None
-        json.dump(wrapped_results, self._output_dest, ensure_ascii=False, indent=indent)
+        path = self._get_media_path(media_path, media_type, job_stdin, stdin_spool, exit_stack)
+        return Media(path, mime_type, media_type, media_metadata)
 
 
-    def _create_job(self) -> Any:
-        job_name = os.path.basename(self._media_path)
-        media_type = self._media_type
+    def _create_job(self, media: Media, media_metadata: Dict[str, str]) -> Any:
+        job_name = os.path.basename(media.path)
+        media_type = media.media_type
 
         if media_type == util.MediaType.IMAGE:
-            return self._sdk_module.ImageJob(job_name, self._media_path, self._job_props,
-                                             self._media_metadata)
+            return self._sdk_module.ImageJob(job_name, media.path, self._job_props,
+                                             media_metadata)
 
         if media_type == util.MediaType.VIDEO:
-            return self._sdk_module.VideoJob(job_name, self._media_path, self._begin, self._end,
-                                             self._job_props, self._media_metadata)
+            return self._sdk_module.VideoJob(job_name, media.path, self._begin, self._end,
+                                             self._job_props, media_metadata)
 
         if media_type == util.MediaType.AUDIO:
-            return self._sdk_module.AudioJob(job_name, self._media_path, self._begin, self._end,
-                                             self._job_props, self._media_metadata)
+            return self._sdk_module.AudioJob(job_name, media.path, self._begin, self._end,
+                                             self._job_props, media_metadata)
 
         if media_type == util.MediaType.GENERIC:
-            return self._sdk_module.GenericJob(job_name, self._media_path, self._job_props,
-                                               self._media_metadata)
+            return self._sdk_module.GenericJob(job_name, media.path, self._job_props,
+                                               media_metadata)
 
         raise RuntimeError(f'Unknown media type: {media_type}')
 
@@ -141,12 +286,7 @@ class JobRunner(contextlib.AbstractContextManager):
                        media_path: str,
                        media_metadata: Dict[str, str]) -> str:
 
-        mime_type = media_metadata.get('MIME_TYPE')
-        if not mime_type:
-            # Known to be missing mime types
-            mimetypes.add_type('video/x-matroska', '.mkv')
-            mimetypes.add_type('video/ogg', '.ogg')
-            mime_type = mimetypes.guess_type(media_path, strict=False)[0]
+        mime_type = media_metadata.get('MIME_TYPE') or _guess_mime_type(media_path)
 
         if mime_type:
             media_metadata['MIME_TYPE'] = mime_type
@@ -194,9 +334,10 @@ class JobRunner(contextlib.AbstractContextManager):
 
     @classmethod
     def _get_media_metadata(cls, media_path: str, media_type: util.MediaType,
-                            media_metadata: Dict[str, str]) -> Dict[str, str]:
+                            provided_metadata: Dict[str, str]) -> Dict[str, str]:
+        media_metadata = dict(provided_metadata)
         if media_type == util.MediaType.VIDEO and 'FPS' not in media_metadata:
-            log.info('FPS was not provided in the media metadata. Checking FPS with ffprobe...')
+            log.info('FPS was not provided in the media metadata. Checking FPS...')
             fps = cls._get_fps(media_path)
             log.info(f'Determined FPS to be {fps}.')
             media_metadata['FPS'] = str(fps)
@@ -204,76 +345,73 @@ class JobRunner(contextlib.AbstractContextManager):
         return sort_property_dict(media_metadata)
 
 
-    @staticmethod
-    def _get_fps(media_path: str) -> float:
+    def _get_num_frames_to_process(self, media_path: str) -> Optional[int]:
+        if self._end >= 0:
+            return self._end - self._begin + 1
         try:
-            # Output is like 2997/100 or 1/1
-            completed_proc = subprocess.run(
-                ('ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
-                 'stream=avg_frame_rate', '-of', 'default=noprint_wrappers=1:nokey=1', media_path),
-                capture_output=True, text=True, check=True)
-
-            numerator, denominator = completed_proc.stdout.split('/')
-            return float(numerator) / float(denominator)
-
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f'Unable to determine FPS with ffprobe. Please set it on the '
-                               f'command line using "-M FPS=x". ffprobe stderr: {e.stderr}') from e
-
-
-    @classmethod
-    def _get_combined_job_props(cls,
-                                job_properties: Dict[str, str],
-                                client_env_props: Mapping[str, str],
-                                descriptor: Dict[str, Any]) -> Dict[str, str]:
-        for pair in client_env_props.items():
-            job_properties.setdefault(*pair)
-
-        for pair in util.get_job_props_from_env(os.environ):
-            job_properties.setdefault(*pair)
+            frame_count = mpf_cli_media_info.get_video_info(media_path).frame_count
+        except RuntimeError as e:
+            log.debug(f'Unable to determine the frame count: {e}')
+            return None
+        return None if frame_count is None else max(frame_count - self._begin, 0)
 
-        descriptor_props_field = descriptor['algorithm']['providesCollection']['properties']
-        for prop in descriptor_props_field:
-            default_value = prop.get('defaultValue')
-            if default_value is not None:
-                job_properties.setdefault(prop['name'], default_value)
 
-        return sort_property_dict(job_properties)
+    @staticmethod
+    def _get_fps(media_path: str) -> float:
+        try:
+            return mpf_cli_media_info.get_video_info(media_path).fps
+        except RuntimeError as e:
+            raise RuntimeError(f'Unable to determine FPS. Please set it on the command line '
+                               f'using "-M FPS=x". {e}') from e
 
 
     def _wrap_component_results(
             self,
-            result_dicts: List[Dict[str, Any]],
-            start_time: datetime.datetime) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+            media_results: List[Tuple[Media, Tuple[Dict[str, str], List[Dict[str, Any]]]]],
+            start_time: datetime.datetime) -> Union[List[Any], Dict[str, Any]]:
         if self._brief_output:
-            return result_dicts
-        track_type = self._component_handle.track_type
+            if self._is_batch:
+                return [result_dicts for _, (_, result_dicts) in media_results]
+            else:
+                return media_results[0][1][1]
 
         # Create a structure that will be parsable by the mpf-interop package. Some fields
-        # don't exactly make sense, but are necessary for compatibility. For example, the media
-        # field is a list even though the CLI runner only operates on a single piece of media.
-        return {
+        # don't exactly make sense, but are necessary for compatibility.
+        output = {
             'timeStart': start_time.astimezone().isoformat(),
             'timeStop': datetime.datetime.now().astimezone().isoformat(),
             'jobProperties': self._job_props,
             'media': [
-                {
-                    'path': self._media_path,
-                    'mimeType': self._mime_type,
-                    'mediaMetadata': self._media_metadata,
-                    'output': {
-                        track_type: [
-                            {
-                                'tracks': result_dicts
-                            }
-                        ]
-                    }
-                }
+                self._create_media_entry(media, media_metadata, result_dicts)
+                for media, (media_metadata, result_dicts) in media_results
             ]
         }
+        if self._include_timing:
+            # The output is serialized after this, so the serialization time can only be reported
+            # in the job status and the log.
+            output['timing'] = {**self._prior_phase_times_ms, **self.phase_times_ms}
+        return output
+
+
+    def _create_media_entry(self, media: Media, media_metadata: Dict[str, str],
+                            result_dicts: List[Dict[str, Any]]) -> Dict[str, Any]:
+        track_type = self._track_type
+        return {
+            'path': media.path,
+            'mimeType': media.mime_type,
+            'mediaMetadata': media_metadata,
+            'output': {
+                track_type: [
+                    {
+                        'tracks': result_dicts
+                    }
+                ]
+            }
+        }
 
     @staticmethod
     def _get_media_path(media_path: str, media_type: util.MediaType, job_stdin: TextIO,
+                        stdin_spool: Optional[StdinVideoSpool],
                         exit_stack: contextlib.ExitStack) -> str:
         if media_path != '-':
             if not os.path.exists(media_path):
@@ -281,22 +419,321 @@ class JobRunner(contextlib.AbstractContextManager):
                     f'The provided media path, "{media_path}", does not exist.')
             return media_path
 
+        if not StdinVideoSpool.is_needed(media_type, job_stdin):
+            return f'/proc/{os.getpid()}/fd/{job_stdin.fileno()}'
+
+        if stdin_spool is None:
+            stdin_spool = exit_stack.enter_context(StdinVideoSpool(job_stdin))
+        return stdin_spool.wait()
+
+
+
+class JobPropertyDefaults:
+    """
+    The job properties that every job for a component starts with: the defaults from the
+    component's descriptor, overridden by the MPF_PROP_ environment variables of the component's
+    environment.
+    They are combined and sorted once per component, so each job only needs to merge in its own
+    properties. The result is in the same order as sort_property_dict.
+    """
+    # Sorts by the sort key, and then puts the job's own properties after the defaults with the
+    # same name, so that the job's value is the one kept.
+    _DEFAULT = 0
+    _OVERRIDE = 1
+
+    def __init__(self, env: Mapping[str, str], property_defaults: Mapping[str, str]):
+        combined = dict(property_defaults)
+        combined.update(util.get_job_props_from_env(env))
+        self._entries = tuple(sorted(
+            (_property_sort_key(name), self._DEFAULT, name, value)
+            for name, value in combined.items()))
+
+
+    def overlay(self, job_properties: Mapping[str, str]) -> Dict[str, str]:
+        """ :return: A new dict containing the defaults updated with job_properties. """
+        if not job_properties:
+            return {name: value for _, _, name, value in self._entries}
+        overrides = sorted((_property_sort_key(name), self._OVERRIDE, name, value)
+                           for name, value in job_properties.items())
+        return {name: value
+                for _, _, name, value in heapq.merge(self._entries, overrides)}
+
+
+class StdinVideoSpool(contextlib.AbstractContextManager):
+    """
+    Copies a video from standard in to a file, because videos can not be read directly from
+    standard in. The copy is done in a background thread, so it can happen while the component
+    is initializing. When the STDIN_VIDEO_SPOOL environment variable is set to "memory", the
+    video is copied to an anonymous in-memory file. Otherwise, it is copied to a temporary file
+    in the directory specified by STDIN_VIDEO_SPOOL, or the default temporary directory.
+    """
+
+    @staticmethod
+    def is_needed(media_type: Optional[util.MediaType], job_stdin: TextIO) -> bool:
         client_std_in_path = f'/proc/{os.getpid()}/fd/{job_stdin.fileno()}'
-        if media_type != util.MediaType.VIDEO or os.path.isfile(client_std_in_path):
-            return client_std_in_path
+        return media_type == util.MediaType.VIDEO and not os.path.isfile(client_std_in_path)
+
+
+    def __init__(self, job_stdin: TextIO):
+        with contextlib.ExitStack() as exit_stack:
+            spool_location = util.get_stdin_video_spool()
+            if spool_location == 'memory':
+                spool_fd = os.memfd_create('mpf-stdin-video', os.MFD_CLOEXEC)
+                self._spool_file = exit_stack.enter_context(open(spool_fd, 'wb', buffering=0))
+                self._path = f'/proc/{os.getpid()}/fd/{spool_fd}'
+            else:
+                # Closing the file causes the file to be deleted, so it must remain open until the
+                # job is complete.
+                self._spool_file = exit_stack.enter_context(
+                    tempfile.NamedTemporaryFile(dir=spool_location, buffering=0))
+                self._path = self._spool_file.name
+
+            log.warning(f'Warning: Copying video to {self._path} '
+                        'because videos can not be read directly from standard in.')
+            self._copy_error: Optional[BaseException] = None
+            # The copy thread stops when the write end of the pipe is closed.
+            cancel_read_fd, self._cancel_write_fd = os.pipe()
+            # The copy thread gets its own file descriptors, so that if the job fails before the
+            # copy is complete, closing the spool file can not cause the thread to write to an
+            # unrelated file that reused the file descriptor number.
+            self._copy_thread = threading.Thread(
+                target=self._copy,
+                args=(os.dup(job_stdin.fileno()), os.dup(self._spool_file.fileno()),
+                      cancel_read_fd),
+                name='stdin-video-spool', daemon=True)
+            self._copy_thread.start()
+            exit_stack.callback(self._stop_copy)
+            self._exit_stack = exit_stack.pop_all()
+
+
+    def __exit__(self, *exc_details):
+        return self._exit_stack.__exit__(*exc_details)
+
+
+    def wait(self) -> str:
+        """
+        Waits for the entire video to be copied.
+        :return: The path to the copy of the video.
+        """
+        self._copy_thread.join()
+        if self._copy_error is not None:
+            raise self._copy_error
+        return self._path
+
+
+    def _stop_copy(self) -> None:
+        # When the job ends before the copy is complete, the copy is stopped, so that the
+        # executor process does not keep reading from, or holding open, the client's standard in.
+        os.close(self._cancel_write_fd)
+        self._copy_thread.join()
+
+
+    def _copy(self, stdin_fd: int, spool_fd: int, cancel_fd: int) -> None:
+        try:
+            num_bytes = copy_fd(stdin_fd, spool_fd, cancel_fd)
+            log.info(f'Finished copying {num_bytes} bytes from standard in to {self._path}.')
+        except CopyCancelledError:
+            log.info('Stopped copying standard in because the job ended.')
+        except BaseException as e:
+            self._copy_error = e
+        finally:
+            os.close(stdin_fd)
+            os.close(spool_fd)
+            os.close(cancel_fd)
+
+
+class CopyCancelledError(Exception):
+    """ Raised by copy_fd when its cancel_fd becomes readable or is closed. """
+
+
+def copy_fd(src_fd: int, dest_fd: int, cancel_fd: Optional[int] = None) -> int:
+    """
+    Copies everything from src_fd to dest_fd. When src_fd is a pipe, splice is used so that the
+    data is moved within the kernel instead of being copied in to and out of user space.
+    :param cancel_fd: When provided, the copy stops with CopyCancelledError once cancel_fd is
+                      readable, which includes when it is the read end of a pipe whose write end
+                      was closed.
+    :return: The number of bytes copied.
+    """
+    if cancel_fd is None:
+        wait_for_input: Callable[[], None] = lambda: None
+    else:
+        poller = select.poll()
+        poller.register(src_fd, select.POLLIN)
+        poller.register(cancel_fd, select.POLLIN)
+
+        def wait_for_input() -> None:
+            if any(fd == cancel_fd for fd, _ in poller.poll()):
+                raise CopyCancelledError()
+
+    num_bytes = 0
+    chunk_size = 1 << 20
+    if hasattr(os, 'splice'):
+        try:
+            while True:
+                wait_for_input()
+                num_spliced = os.splice(src_fd, dest_fd, chunk_size)
+                if num_spliced == 0:
+                    return num_bytes
+                num_bytes += num_spliced
+        except OSError as e:
+            # EINVAL indicates that splice is not supported for the file descriptors, for example
+            # when neither of them is a pipe.
+            if e.errno != errno.EINVAL or num_bytes > 0:
+                raise
+
+    while True:
+        wait_for_input()
+        if not (chunk := os.read(src_fd, chunk_size)):
+            return num_bytes
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dest_fd, view):]
+        num_bytes += len(chunk)
+
+
+
+_current_job_progress = threading.local()
+
+
+def report_progress(frames_processed: int, total_frames: Optional[int] = None) -> None:
+    """
+    Python components can call this to report how many frames of the current video they have
+    processed. It must be called from the thread that called the component. Does nothing when the
+    component is not running in the CLI runner.
+    """
+    progress: Optional[JobProgress] = getattr(_current_job_progress, 'progress', None)
+    if progress is not None:
+        progress.frames_processed = frames_processed
+        if total_frames is not None:
+            progress.total_frames = total_frames
+
+
+class JobProgress:
+    """
+    Counts the tracks and detections a job has produced so far. While the job runs, a heartbeat
+    containing the counts is periodically logged to the client, so that long jobs show that they
+    are still making progress. When the client requests it, the progress is also sent to the
+    client more frequently.
+    """
+    # Seconds between the progress updates sent to the client.
+    UPDATE_INTERVAL = 1
+
+    def __init__(self, num_media: int):
+        self.num_media = num_media
+        self.media_number = 0
+        self.num_tracks = 0
+        self.num_detections = 0
+        self.media_tracks = 0
+        self.media_detections = 0
+        # The highest frame number seen in the current media's tracks. None when the current
+        # media is not a video.
+        self.latest_frame: Optional[int] = None
+        # Reported by the component through report_progress.
+        self.frames_processed: Optional[int] = None
+        self.total_frames: Optional[int] = None
+        self._begin_frame = 0
+        self._start_time = time.monotonic()
+
+
+    def start_media(self, is_video: bool, begin_frame: int) -> None:
+        self.media_number += 1
+        self.media_tracks = 0
+        self.media_detections = 0
+        self.latest_frame = -1 if is_video else None
+        self.frames_processed = None
+        self.total_frames = None
+        self._begin_frame = begin_frame
+
+
+    def count_tracks(self, track_dicts: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        for track_dict in track_dicts:
+            num_detections = len(track_dict['detections'])
+            self.num_tracks += 1
+            self.num_detections += num_detections
+            self.media_tracks += 1
+            self.media_detections += num_detections
+            if self.latest_frame is not None:
+                self.latest_frame = max(self.latest_frame, track_dict['stopOffsetFrame'])
+            yield track_dict
+
+
+    @property
+    def elapsed_seconds(self) -> float:
+        return time.monotonic() - self._start_time
+
+
+    @contextlib.contextmanager
+    def run_heartbeats(self, log_interval: Optional[int],
+                       listener: Optional[Callable[[Dict[str, Any]], None]] = None
+                       ) -> Iterator[None]:
+        """
+        Until the with block exits, logs a heartbeat every log_interval seconds and passes the
+        progress to listener every UPDATE_INTERVAL seconds.
+        """
+        _current_job_progress.progress = self
+        if not log_interval and listener is None:
+            try:
+                yield
+            finally:
+                _current_job_progress.progress = None
+            return
+
+        stop_event = threading.Event()
+        # Lets the heartbeat through the filter that is used when other jobs are running in the
+        # same process.
+        log_extra = {'job_thread_id': threading.get_ident()}
+
+        def run_heartbeats() -> None:
+            next_log_time = log_interval
+            while not stop_event.wait(log_interval if listener is None else self.UPDATE_INTERVAL):
+                if listener is not None:
+                    listener(self.get_update())
+                if log_interval and self.elapsed_seconds >= next_log_time:
+                    log.info(self.describe(), extra=log_extra)
+                    next_log_time += log_interval
+
+        heartbeat_thread = threading.Thread(target=run_heartbeats, daemon=True)
+        heartbeat_thread.start()
+        try:
+            yield
+        finally:
+            stop_event.set()
+            heartbeat_thread.join()
+            _current_job_progress.progress = None
+
+
+    def get_frames_processed(self) -> Optional[int]:
+        if self.frames_processed is not None:
+            return self.frames_processed
+        if self.latest_frame is None:
+            return None
+        # Components generally report a track once it ends, so the latest frame in the tracks
+        # reported so far is a lower bound on the number of frames that have been processed.
+        return max(self.latest_frame + 1 - self._begin_frame, 0)
+
+
+    def get_update(self) -> Dict[str, Any]:
+        return {
+            'elapsed_ms': round(self.elapsed_seconds * 1000),
+            'media_number': self.media_number,
+            'num_media': self.num_media,
+            'frames_processed': self.get_frames_processed(),
+            'total_frames': self.total_frames,
+            'tracks': self.num_tracks,
+            'detections': self.num_detections,
+        }
 
-        # if media_type != util.MediaType.VIDEO:
-        #     return f'/proc/{os.getpid()}/fd/{job_request.stdin.fileno()}'
 
-        tmp_file = exit_stack.enter_context(tempfile.NamedTemporaryFile())
-        log.warning(f'Warning: Copying video to {tmp_file.name} '
-                    'because videos can not be read directly from standard in.')
-        shutil.copyfileobj(job_stdin.buffer, tmp_file)
-        # Closing tmp_file causes the file to be deleted, so we can't close it here.
-        # Since we can't close it, we need to flush here, otherwise the file will be partially
-        # written.
-        tmp_file.flush()
-        return tmp_file.name
+    def describe(self) -> str:
+        description = f'Still running after {self.elapsed_seconds:.0f} seconds. '
+        if self.num_media > 1:
+            description += f'Processing media {self.media_number} of {self.num_media}. '
+        description += (f'Found {self.num_tracks} tracks containing {self.num_detections} '
+                        'detections so far.')
+        if self.latest_frame is not None and self.latest_frame >= 0:
+            description += f' Latest frame: {self.latest_frame}.'
+        return description
 
 
 
@@ -315,8 +752,23 @@ class ComponentResultToDictConverter:
         return cls(fps, track_type).to_dict_list(component_results)
 
 
+    @classmethod
+    def convert_lazily(cls, fps: float, track_type: str,
+                       component_results: Iterable) -> Iterator[Dict[str, Any]]:
+        """
+        Like convert, but each result is converted when it is requested from the returned
+        iterator, and the results are not sorted.
+        """
+        converter = cls(fps, track_type)
+        return (converter._create_track_dict(obj) for obj in component_results)
+
+
     _convert_frame_to_time: Callable[[int], float]
     _track_type: str
+    _property_dicts: Dict[Tuple, Dict[str, str]]
+
+    # Maximum number of distinct property dicts that will be shared between detections.
+    _MAX_SHARED_PROPERTY_DICTS = 4096
 
     def __init__(self, fps: float, track_type: str):
         if fps == 0:
@@ -326,10 +778,16 @@ class ComponentResultToDictConverter:
             self._convert_frame_to_time = lambda fr: round(fr * ms_per_frame)
 
         self._track_type = track_type
+        self._property_dicts = {}
+
+    @classmethod
+    def sort_track_dicts(cls, track_dicts: List[Dict[str, Any]]) -> None:
+        track_dicts.sort(key=cls.track_dict_compare_key)
+
 
     def to_dict_list(self, component_results: Iterable) -> List[Dict[str, Any]]:
         result_dicts = [self._create_track_dict(obj) for obj in component_results]
-        result_dicts.sort(key=self._track_dict_compare_key)
+        self.sort_track_dicts(result_dicts)
         return result_dicts
 
 
@@ -338,9 +796,10 @@ class ComponentResultToDictConverter:
         if frame_locations is None:
             frame_locations = {0: obj}
 
+        # Frame numbers are unique within a track, so sorting by frame number produces the same
+        # order as comparing every field of the detections.
         serialized_detections = [self._create_detection_dict(frame_locations[i], i)
-                                 for i in frame_locations]
-        serialized_detections.sort(key=self._detection_dict_compare_key)
+                                 for i in sorted(frame_locations)]
 
         serialized_exemplar = max(serialized_detections, key=lambda x: x['confidence'],
                                   default=None)
@@ -373,12 +832,33 @@ class ComponentResultToDictConverter:
                     width=getattr(detection, 'width', 0),
                     height=getattr(detection, 'height', 0),
                     confidence=detection.confidence,
-                    detectionProperties=sort_property_dict(detection.detection_properties))
+                    detectionProperties=self._get_shared_property_dict(
+                        detection.detection_properties))
+
+
+    def _get_shared_property_dict(self, properties: Mapping[str, str]) -> Dict[str, str]:
+        """
+        Detections in the same job often have identical properties, so the sorted property dicts
+        are shared between detections to reduce memory usage. Callers must not modify the
+        returned dict.
+        """
+        try:
+            key = tuple(properties.items())
+            return self._property_dicts[key]
+        except TypeError:
+            # A property value is not hashable.
+            return sort_property_dict(properties)
+        except KeyError:
+            pass
+        if len(self._property_dicts) >= self._MAX_SHARED_PROPERTY_DICTS:
+            self._property_dicts.clear()
+        sorted_properties = self._property_dicts[key] = sort_property_dict(properties)
+        return sorted_properties
 
 
     @staticmethod
-    def _track_dict_compare_key(track_dict: Dict[str, Any]) -> List:
-        return [
+    def track_dict_compare_key(track_dict: Dict[str, Any]) -> Tuple:
+        return (
             track_dict['startOffsetFrame'],
             track_dict['stopOffsetFrame'],
             track_dict['startOffsetTime'],
@@ -386,22 +866,115 @@ class ComponentResultToDictConverter:
             track_dict['type'],
             track_dict['confidence'],
             *track_dict['trackProperties'].items()
-        ]
+        )
 
 
-    @staticmethod
-    def _detection_dict_compare_key(detection_dict: Dict[str, Any]) -> List:
-        return [
-            detection_dict['offsetFrame'],
-            detection_dict['offsetTime'],
-            detection_dict['confidence'],
-            detection_dict['x'],
-            detection_dict['y'],
-            detection_dict['width'],
-            detection_dict['height'],
-            *detection_dict['detectionProperties'].items()
-        ]
+def sort_track_lines(track_dicts: Iterable[Dict[str, Any]],
+                     buffer_size: int = NDJSON_SORT_BUFFER_SIZE) -> Iterator[str]:
+    """
+    Serializes track_dicts to single-line JSON strings in the same order as
+    ComponentResultToDictConverter.sort_track_dicts, while holding at most buffer_size tracks in
+    memory.
+    """
+    with contextlib.ExitStack() as exit_stack:
+        sorted_runs: List[Iterator[str]] = []
+        buffer: List[Dict[str, Any]] = []
+        for track_dict in track_dicts:
+            buffer.append(track_dict)
+            if len(buffer) >= buffer_size:
+                sorted_runs.append(_write_sorted_run(buffer, exit_stack))
+                buffer = []
+
+        ComponentResultToDictConverter.sort_track_dicts(buffer)
+        last_run = map(encoders.dumps_json, buffer)
+        if not sorted_runs:
+            yield from last_run
+            return
+
+        sorted_runs.append(last_run)
+        # heapq.merge is stable, so tracks that compare equal stay in the order the component
+        # produced them, just like list.sort.
+        yield from heapq.merge(
+            *sorted_runs,
+            key=lambda line: ComponentResultToDictConverter.track_dict_compare_key(
+                encoders.loads_json(line)))
+
+
+def _write_sorted_run(track_dicts: List[Dict[str, Any]],
+                      exit_stack: contextlib.ExitStack) -> Iterator[str]:
+    ComponentResultToDictConverter.sort_track_dicts(track_dicts)
+    run_file = exit_stack.enter_context(tempfile.TemporaryFile('w+', encoding='utf-8'))
+    for track_dict in track_dicts:
+        run_file.write(encoders.dumps_json(track_dict))
+        run_file.write('\n')
+    run_file.seek(0)
+    return (line.rstrip('\n') for line in run_file)
+
+
+def is_video_path(media_path: str, cmd_line_args: argparse.Namespace) -> bool:
+    """
+    Determines whether media_path will be processed as a video without logging the warnings that
+    JobRunner logs when guessing the media type.
+    """
+    if cmd_line_args.media_type is not None:
+        return cmd_line_args.media_type == util.MediaType.VIDEO
+    mime_type = cmd_line_args.media_metadata.get('MIME_TYPE') or _guess_mime_type(media_path)
+    return 'video' in (mime_type or '').lower()
+
+
+def _guess_mime_type(media_path: str) -> Optional[str]:
+    # Known to be missing mime types
+    mimetypes.add_type('video/x-matroska', '.mkv')
+    mimetypes.add_type('video/ogg', '.ogg')
+    return mimetypes.guess_type(media_path, strict=False)[0]
+
+
+def is_batch_job(cmd_line_args: argparse.Namespace) -> bool:
+    # Batch jobs are jobs that could have processed more than one piece of media, regardless of
+    # how many were actually found.
+    return (len(cmd_line_args.media_paths) != 1
+            or cmd_line_args.media_list is not None
+            or os.path.isdir(cmd_line_args.media_paths[0]))
+
+
+def get_media_paths(cmd_line_args: argparse.Namespace, job_stdin: TextIO) -> List[str]:
+    provided_paths = list(cmd_line_args.media_paths)
+    if cmd_line_args.media_list == '-':
+        provided_paths.extend(_read_media_list(job_stdin, cmd_line_args.client_cwd))
+    elif cmd_line_args.media_list is not None:
+        with open(cmd_line_args.media_list) as media_list_file:
+            provided_paths.extend(_read_media_list(media_list_file, cmd_line_args.client_cwd))
+
+    media_paths = []
+    for path in provided_paths:
+        if os.path.isdir(path):
+            # Hidden files are skipped so that files like .DS_Store aren't processed.
+            media_paths.extend(sorted(
+                e.path for e in os.scandir(path) if e.is_file() and e.name[0] != '.'))
+        else:
+            media_paths.append(path)
+    return media_paths
+
+
+def _read_media_list(media_list: TextIO, client_cwd: str) -> Iterator[str]:
+    for line in media_list:
+        path = line.strip()
+        if path:
+            yield get_client_path(path, client_cwd)
+
+
+def get_client_path(path: str, client_cwd: str) -> str:
+    # If path is an absolute path, join does nothing.
+    client_path = os.path.join(client_cwd, path)
+    if os.path.exists(client_path) or not os.path.exists(path):
+        return client_path
+    else:
+        return path
 
 
 def sort_property_dict(unsorted: Dict[str, str]) -> Dict[str, str]:
-    return {k: unsorted[k] for k in sorted(unsorted, key=lambda x: (x.upper(), x))}
+    return {k: unsorted[k] for k in sorted(unsorted, key=_property_sort_key)}
+
+
+def _property_sort_key(name: str) -> Tuple[str, str]:
+    return name.upper(), name
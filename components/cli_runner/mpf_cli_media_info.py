@@ -0,0 +1,286 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import mpf_cli_runner_util as util
+from mpf_cli_video_headers import VideoInfo, read_video_headers
+
+log = logging.getLogger('org.mitre.mpf.cli')
+
+
+_cache: Optional[VideoInfoCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_video_info(media_path: str) -> VideoInfo:
+    """
+    Gets information about the video at media_path. The information is cached, so the video is
+    only probed once for each version of a file.
+    :raises RuntimeError: When the information can not be determined.
+    """
+    return _get_cache().get(media_path)
+
+
+def prefetch_video_info(media_path: str) -> None:
+    """
+    Starts getting the information about the video at media_path in a background thread, so
+    that a later call to get_video_info does not need to wait as long. Errors are ignored here
+    and reported when get_video_info is called.
+    """
+    def prefetch():
+        with contextlib.suppress(Exception):
+            get_video_info(media_path)
+    threading.Thread(target=prefetch, name='prefetch-video-info', daemon=True).start()
+
+
+def _get_cache() -> VideoInfoCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = VideoInfoCache(util.get_media_info_cache_size(),
+                                    util.get_media_info_cache_dir())
+        return _cache
+
+
+# (st_dev, st_ino, st_size, st_mtime_ns)
+_CacheKey = Tuple[int, int, int, int]
+
+
+class VideoInfoCache:
+    """
+    Least recently used cache of VideoInfo keyed on the identity of the file. When a file is
+    modified, its size or modification time changes, so the old entry is no longer used. When
+    cache_dir is provided, entries are also stored on disk so that they can be shared by separate
+    processes. It is safe to use from multiple threads. When a thread requests a file that another
+    thread is already probing, it waits for that result instead of probing the file again.
+    """
+    def __init__(self, max_size: Optional[int], cache_dir: Optional[str]):
+        self._max_size = max_size
+        self._cache_dir = cache_dir
+        self._entries: collections.OrderedDict[_CacheKey, VideoInfo] = collections.OrderedDict()
+        self._in_progress: Dict[_CacheKey, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, media_path: str) -> VideoInfo:
+        key = self._get_key(media_path)
+        with self._lock:
+            cached_info = self._entries.get(key)
+            if cached_info is not None:
+                self._entries.move_to_end(key)
+                log.debug(f'Using cached video information for {media_path}.')
+                return cached_info
+            future = self._in_progress.get(key)
+            if future is None:
+                future = self._in_progress[key] = concurrent.futures.Future()
+                is_owner = True
+            else:
+                is_owner = False
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            video_info = self._load(key, media_path)
+        except BaseException as e:
+            with self._lock:
+                del self._in_progress[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_progress[key]
+            self._add(key, video_info)
+        future.set_result(video_info)
+        return video_info
+
+
+    def _load(self, key: _CacheKey, media_path: str) -> VideoInfo:
+        video_info = self._load_from_disk(key)
+        if video_info is not None:
+            log.debug(f'Using video information for {media_path} from the on-disk cache.')
+            return video_info
+        video_info = probe_video(media_path)
+        self._save_to_disk(key, video_info)
+        return video_info
+
+
+    @staticmethod
+    def _get_key(media_path: str) -> _CacheKey:
+        stat = os.stat(media_path)
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+    def _add(self, key: _CacheKey, video_info: VideoInfo) -> None:
+        if self._max_size == 0:
+            return
+        self._entries[key] = video_info
+        if self._max_size is not None and len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+    def _get_disk_path(self, key: _CacheKey) -> str:
+        assert self._cache_dir is not None
+        return os.path.join(self._cache_dir, '-'.join(map(str, key)) + '.json')
+
+
+    def _load_from_disk(self, key: _CacheKey) -> Optional[VideoInfo]:
+        if self._cache_dir is None:
+            return None
+        try:
+            with open(self._get_disk_path(key)) as f:
+                return VideoInfo(**json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError):
+            log.warning(f'Ignoring invalid media information cache entry: '
+                        f'{self._get_disk_path(key)}', exc_info=True)
+            return None
+
+
+    def _save_to_disk(self, key: _CacheKey, video_info: VideoInfo) -> None:
+        if self._cache_dir is None:
+            return
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            # Write to a temporary file and then rename it, so that other processes never read a
+            # partially written entry.
+            with tempfile.NamedTemporaryFile('w', dir=self._cache_dir, suffix='.tmp',
+                                             delete=False) as tmp_file:
+                try:
+                    json.dump(video_info._asdict(), tmp_file)
+                    tmp_file.close()
+                    os.replace(tmp_file.name, self._get_disk_path(key))
+                except BaseException:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(tmp_file.name)
+                    raise
+        except OSError:
+            log.warning(f'Failed to write media information cache entry to {self._cache_dir}.',
+                        exc_info=True)
+
+
+def probe_video(media_path: str) -> VideoInfo:
+    """
+    Reads the video's container headers to get all of the fields of VideoInfo. When the
+    container format is not supported, ffprobe is used instead.
+    :raises RuntimeError: When ffprobe fails or the file does not contain a video stream.
+    """
+    video_info = read_video_headers(media_path)
+    if video_info is not None:
+        return video_info
+    log.debug(f'Using ffprobe to get video information for {media_path}.')
+    return _probe_video_with_ffprobe(media_path)
+
+
+def _probe_video_with_ffprobe(media_path: str) -> VideoInfo:
+    ffprobe_output = _run_ffprobe(
+        media_path,
+        '-show_entries',
+        'stream=avg_frame_rate,nb_frames,width,height,duration'
+        ':stream_tags=rotate:stream_side_data=rotation:format=duration')
+    streams = ffprobe_output.get('streams')
+    if not streams:
+        raise RuntimeError(f'ffprobe did not find a video stream in {media_path}.')
+    stream = streams[0]
+
+    try:
+        # Output is like 2997/100 or 1/1
+        numerator, denominator = stream['avg_frame_rate'].split('/')
+        fps = float(numerator) / float(denominator)
+    except (KeyError, ValueError, ZeroDivisionError) as e:
+        raise RuntimeError(f'ffprobe did not report a valid frame rate for {media_path}.') from e
+
+    duration_sec = _parse_optional(float, stream.get('duration')) \
+        or _parse_optional(float, ffprobe_output.get('format', {}).get('duration'))
+    return VideoInfo(
+        fps=fps,
+        frame_count=_parse_optional(int, stream.get('nb_frames')),
+        duration_ms=duration_sec * 1000 if duration_sec is not None else None,
+        width=_parse_optional(int, stream.get('width')),
+        height=_parse_optional(int, stream.get('height')),
+        rotation=_get_rotation(stream))
+
+
+def count_video_frames(media_path: str) -> int:
+    """
+    Counts the frames in a video by reading every packet. This is much slower than
+    get_video_info, so it should only be used when VideoInfo.frame_count is None.
+    """
+    ffprobe_output = _run_ffprobe(
+        media_path, '-count_packets', '-show_entries', 'stream=nb_read_packets')
+    try:
+        return int(ffprobe_output['streams'][0]['nb_read_packets'])
+    except (KeyError, IndexError, ValueError) as e:
+        raise RuntimeError(f'ffprobe was unable to count the frames in {media_path}.') from e
+
+
+def _get_rotation(stream: Dict[str, Any]) -> float:
+    # Older versions of ffmpeg report the rotation as a clockwise "rotate" tag. Newer versions
+    # report the display matrix rotation, which is counter-clockwise.
+    rotate_tag = _parse_optional(float, stream.get('tags', {}).get('rotate'))
+    if rotate_tag is not None:
+        return rotate_tag % 360
+    for side_data in stream.get('side_data_list', ()):
+        rotation = _parse_optional(float, side_data.get('rotation'))
+        if rotation is not None:
+            return -rotation % 360
+    return 0.0
+
+
+def _parse_optional(parser, value: Any) -> Any:
+    if value is None or value == 'N/A':
+        return None
+    try:
+        return parser(value)
+    except ValueError:
+        return None
+
+
+def _run_ffprobe(media_path: str, *args: str) -> Dict[str, Any]:
+    try:
+        completed_proc = subprocess.run(
+            ('ffprobe', '-v', 'error', '-select_streams', 'v:0', *args, '-of', 'json',
+             media_path),
+            capture_output=True, text=True, check=True)
+        return json.loads(completed_proc.stdout)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f'ffprobe failed with stderr: {e.stderr}') from e
+    except FileNotFoundError as e:
+        raise RuntimeError('The container format is not supported and ffprobe is not '
+                           'installed.') from e
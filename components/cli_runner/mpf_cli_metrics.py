@@ -0,0 +1,275 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+"""
+Metrics for the component server, executor processes, and job runner.
+
+Executor processes report the phase timings of each job to the component server by sending a
+JSON datagram on a socket they inherit from the component server. The component server
+aggregates the reports into histograms and serves them, along with the state of the executor
+pool, in the Prometheus text exposition format.
+"""
+
+from __future__ import annotations
+
+import bisect
+import contextlib
+import json
+import logging
+import math
+import os
+import socket
+import stat
+import time
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, TypeVar
+
+log = logging.getLogger('org.mitre.mpf.cli')
+
+T = TypeVar('T')
+
+# Upper bounds, in seconds, of the buckets used by all of the histograms.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                   60, 120, 300)
+
+# The datagrams only contain a few numbers, so this is much larger than needed.
+MAX_REPORT_SIZE = 4096
+
+
+class PhaseTimer:
+    """
+    Accumulates the time a job spends in each phase. Phases can be nested. Time spent in a nested
+    phase is only counted towards the nested phase. This makes it possible to separate the time
+    spent in the component from the time spent converting its results when the results are
+    converted as the component produces them.
+    """
+    def __init__(self):
+        self._totals: Dict[str, float] = {}
+        self._active_phases: List[str] = []
+        self._last_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        self._charge_active_phase()
+        self._active_phases.append(name)
+        try:
+            yield
+        finally:
+            self._charge_active_phase()
+            self._active_phases.pop()
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        """ Counts the time spent producing each item towards the named phase. """
+        iterator = iter(iterable)
+        while True:
+            # Equivalent to using self.phase, but this is called for every track, so it avoids
+            # creating a context manager each time.
+            self._charge_active_phase()
+            self._active_phases.append(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._charge_active_phase()
+                self._active_phases.pop()
+            yield item
+
+    def get_times_ms(self) -> Dict[str, float]:
+        return {f'{name}_ms': round(seconds * 1000, 3) for name, seconds in self._totals.items()}
+
+    def _charge_active_phase(self) -> None:
+        now = time.perf_counter()
+        if self._active_phases:
+            name = self._active_phases[-1]
+            self._totals[name] = self._totals.get(name, 0.0) + now - self._last_time
+        self._last_time = now
+
+
+def report_job(metrics_socket: Optional[socket.socket], exit_code: int,
+               timing_ms: Mapping[str, float]) -> None:
+    """
+    Called by executor processes to send a job's phase timings to the component server. Reports
+    are dropped rather than delaying the job when the component server is not reading them.
+    """
+    if metrics_socket is None:
+        return
+    report = json.dumps({'exit_code': exit_code, 'timing': timing_ms}).encode()
+    try:
+        metrics_socket.send(report)
+    except OSError as e:
+        log.debug(f'Unable to report job metrics: {e}')
+
+
+def create_report_sockets() -> Tuple[socket.socket, socket.socket]:
+    """
+    :return: The socket the component server receives reports on and the socket executor
+             processes send reports on.
+    """
+    receive_socket, send_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    # The socket is shared by all executor processes, so non-blocking mode applies to all of them.
+    receive_socket.setblocking(False)
+    send_socket.setblocking(False)
+    return receive_socket, send_socket
+
+
+def create_listen_socket(address: str) -> socket.socket:
+    """
+    Creates the socket that the metrics are served on.
+    :param address: Either a Unix socket path, a Unix socket abstract address prefixed with "@",
+                    "<host>:<port>", or just a port. When the host is not provided, only
+                    connections from the local host are accepted.
+    """
+    if address.startswith('@'):
+        sock = socket.socket(socket.AF_UNIX)
+        bind_address = '\0' + address[1:]
+    elif address.startswith('/'):
+        sock = socket.socket(socket.AF_UNIX)
+        bind_address = address
+        # The component server already bound its own abstract address, so a socket file left at
+        # this path can only be from a server that is no longer running.
+        with contextlib.suppress(FileNotFoundError):
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                os.unlink(address)
+    else:
+        host, _, port = address.rpartition(':')
+        host = host.strip('[]') or 'localhost'
+        family, _, _, _, bind_address = socket.getaddrinfo(
+            host, int(port), type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+        sock = socket.socket(family)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    with contextlib.ExitStack() as exit_stack:
+        exit_stack.enter_context(sock)
+        sock.bind(bind_address)
+        sock.listen(16)
+        sock.setblocking(False)
+        exit_stack.pop_all()
+    return sock
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_name: Optional[str] = None,
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self._label_name = label_name
+        self._buckets = buckets
+        # Maps the label value to the count of observations in each bucket, the sum, and the count.
+        self._series: Dict[str, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, label_value: str = '') -> None:
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = ([0] * len(self._buckets), [0.0, 0])
+        bucket_counts, sum_and_count = series
+        bucket_idx = bisect.bisect_left(self._buckets, value)
+        if bucket_idx < len(bucket_counts):
+            bucket_counts[bucket_idx] += 1
+        sum_and_count[0] += value
+        sum_and_count[1] += 1
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for label_value, (bucket_counts, (total, count)) in sorted(self._series.items()):
+            labels = {self._label_name: label_value} if self._label_name else {}
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self._buckets, bucket_counts):
+                cumulative_count += bucket_count
+                yield (f'{self.name}_bucket{_format_labels({**labels, "le": str(upper_bound)})} '
+                       f'{cumulative_count}')
+            yield f'{self.name}_bucket{_format_labels({**labels, "le": "+Inf"})} {count}'
+            yield f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(labels)} {count}'
+
+
+class ServerMetrics:
+    """ Metrics collected by the component server. """
+    def __init__(self):
+        self.accept_to_dispatch = Histogram(
+            'mpf_cli_accept_to_dispatch_seconds',
+            'Time from when a client connection is accepted until it is sent to an executor '
+            'process.')
+        self.job_phases = Histogram(
+            'mpf_cli_job_phase_seconds',
+            'Time jobs spent in each phase, as reported by the executor processes.',
+            label_name='phase')
+        self._jobs_completed = {'success': 0, 'failure': 0}
+
+    def on_job_report(self, report_bytes: bytes) -> None:
+        try:
+            report = json.loads(report_bytes)
+            exit_code = report['exit_code']
+            timing_ms = report['timing']
+        except (ValueError, KeyError, TypeError):
+            log.warning('Received an invalid job metrics report.')
+            return
+        self._jobs_completed['success' if exit_code == 0 else 'failure'] += 1
+        for key, milliseconds in timing_ms.items():
+            if key.endswith('_ms'):
+                self.job_phases.observe(milliseconds / 1000, key[:-len('_ms')])
+
+    def render(self) -> Iterator[str]:
+        yield from render_samples(
+            'mpf_cli_jobs_completed_total', 'counter', 'Jobs completed by executor processes.',
+            (({'result': result}, count) for result, count in self._jobs_completed.items()))
+        yield from self.accept_to_dispatch.render()
+        yield from self.job_phases.render()
+
+
+def render_samples(name: str, metric_type: str, documentation: str,
+                   samples: Iterable[Tuple[Mapping[str, str], float]]) -> Iterator[str]:
+    yield f'# HELP {name} {documentation}'
+    yield f'# TYPE {name} {metric_type}'
+    for labels, value in samples:
+        yield f'{name}{_format_labels(labels)} {_format_value(value)}'
+
+
+def get_resident_memory_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f'/proc/{pid}/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # The process exited.
+        return None
+
+
+def _format_labels(labels: Mapping[str, str]) -> str:
+    if not labels:
+        return ''
+    label_strs = (f'{k}="{_escape_label_value(v)}"' for k, v in labels.items())
+    return '{' + ','.join(label_strs) + '}'
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
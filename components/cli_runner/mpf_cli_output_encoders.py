@@ -0,0 +1,131 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+import json
+import math
+from typing import Any, Callable, TextIO
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Output formats that produce a single document containing the results for the whole job.
+DOCUMENT_OUTPUT_FORMATS = ('json', 'msgpack', 'cbor')
+NDJSON_OUTPUT_FORMATS = ('ndjson', 'ndjson-sorted')
+OUTPUT_FORMATS = (*DOCUMENT_OUTPUT_FORMATS, *NDJSON_OUTPUT_FORMATS)
+
+
+def dumps_json(obj: Any) -> str:
+    """
+    Serializes obj to single-line JSON without spaces after the separators. Used for NDJSON output.
+    orjson is used when it is installed and can handle obj. Either way, the keys are in the same
+    order and NaN and Infinity are written the same way, but very large or small floats may be
+    written using different notation, like 1e16 instead of 1e+16.
+    """
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(obj)
+        except TypeError:
+            # orjson rejects some things the json module accepts, like integers larger than 64
+            # bits and non-string dictionary keys.
+            encoded = None
+        # orjson writes NaN and Infinity as null, but the json module writes them as NaN and
+        # Infinity. Searching the output is much faster than checking every value, and "null"
+        # almost never appears in a track.
+        if encoded is not None and (b'null' not in encoded or not _has_non_finite_float(obj)):
+            return encoded.decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def _has_non_finite_float(obj: Any) -> bool:
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite_float(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite_float(v) for v in obj)
+    return False
+
+
+def loads_json(json_str: str) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(json_str)
+        except orjson.JSONDecodeError:
+            # orjson does not accept the NaN and Infinity written by dumps_json.
+            pass
+    return json.loads(json_str)
+
+
+def write_document(document: Any, output_format: str, pretty: bool, output: TextIO) -> None:
+    """
+    Writes document to output using output_format. Binary formats are written to the output's
+    underlying binary buffer.
+    """
+    if output_format == 'json':
+        _write_json(document, pretty, output)
+        return
+
+    encoded = get_binary_encoder(output_format)(document)
+    output.flush()
+    output.buffer.write(encoded)
+    output.buffer.flush()
+
+
+def get_binary_encoder(output_format: str) -> Callable[[Any], bytes]:
+    """
+    :return: The function used to encode documents in the given binary output format.
+    :raises RuntimeError: When the package needed for output_format is not installed.
+    """
+    if output_format == 'msgpack':
+        msgpack = _import_optional_package('msgpack', output_format)
+        return lambda doc: msgpack.packb(doc, use_bin_type=True)
+    if output_format == 'cbor':
+        cbor2 = _import_optional_package('cbor2', output_format)
+        return cbor2.dumps
+    raise ValueError(f'Unknown binary output format: {output_format}')
+
+
+def _write_json(document: Any, pretty: bool, output: TextIO) -> None:
+    # The json module is always used for the JSON output format, so that the output does not
+    # depend on which packages are installed. orjson does not put spaces after separators,
+    # only supports 2 space indentation, and writes NaN and Infinity as null.
+    if pretty:
+        json.dump(document, output, ensure_ascii=False, indent=4)
+    else:
+        json.dump(document, output, ensure_ascii=False)
+
+
+def _import_optional_package(package_name: str, output_format: str) -> Any:
+    try:
+        return __import__(package_name)
+    except ImportError as e:
+        raise RuntimeError(
+            f'The "{output_format}" output format requires the "{package_name}" Python package, '
+            f'but it is not installed. It can be installed with "pip3 install {package_name}".'
+        ) from e
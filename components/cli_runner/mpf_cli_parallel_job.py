@@ -0,0 +1,264 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import math
+import os
+import pstats
+import socket
+import sys
+import tempfile
+from typing import Any, ContextManager, Dict, List, Optional, Sequence, TextIO, Tuple
+
+import mpf_cli_client
+import mpf_cli_executor_process
+import mpf_cli_fast_client
+import mpf_cli_job_runner
+import mpf_cli_media_info
+import mpf_cli_output_encoders
+
+
+def run_parallel_job(argv: List[str]) -> Optional[int]:
+    """
+    Splits the job described by argv in to parts that run at the same time on separate executor
+    processes, then merges the results of the parts.
+    :param argv: The client's command line arguments.
+    :return: The exit code for the job, or None when the job should not be split.
+    """
+    # The output file is only opened once the merged output is ready to be written. When the job
+    # is not split, the executor opens it.
+    cmd_line_args = mpf_cli_executor_process.ArgumentParser.parse(
+        argv, os.getcwd(), sys.stdout, sys.stderr, open_files=False)
+    if (cmd_line_args.parallel <= 1
+            or cmd_line_args.output_format != 'json'
+            or '-' in cmd_line_args.media_paths
+            or cmd_line_args.descriptor_file == '-'):
+        return None
+    job = ParallelJob(argv, cmd_line_args)
+    if not job.can_split():
+        return None
+    return job.run()
+
+
+class PartFailedException(Exception):
+    def __init__(self, exit_code: int):
+        super().__init__(f'Part of the job failed with exit code {exit_code}.')
+        self.exit_code = exit_code
+
+
+# Options that are not passed on to the parts. The parts get their own media and range
+# arguments, and the client applies the output options to the merged output.
+_PART_EXCLUDED_OPTIONS = frozenset((
+    None, '--media-list', '--begin', '--end', '--parallel', '--output', '--output-format',
+    '--pretty', '--brief', '--profile-output'))
+
+
+class ParallelJob:
+    def __init__(self, argv: List[str], cmd_line_args: argparse.Namespace):
+        self._exe_name = argv[0]
+        self._cmd_line_args = cmd_line_args
+        self._num_parts = cmd_line_args.parallel
+        self._is_batch = mpf_cli_job_runner.is_batch_job(cmd_line_args)
+        self._common_args = self._get_common_args(argv)
+        self._parts: List[List[str]] = []
+
+
+    def can_split(self) -> bool:
+        if self._is_batch:
+            media_paths = mpf_cli_job_runner.get_media_paths(self._cmd_line_args, sys.stdin)
+            self._parts = self._split_media(media_paths)
+        else:
+            media_path = self._cmd_line_args.media_paths[0]
+            if mpf_cli_job_runner.is_video_path(media_path, self._cmd_line_args):
+                self._parts = self._split_video(media_path)
+        return len(self._parts) > 1
+
+
+    def run(self) -> int:
+        start_time = datetime.datetime.now()
+        print(f'Splitting job in to {len(self._parts)} parts.', file=sys.stderr)
+        try:
+            part_outputs = self._run_parts()
+        except PartFailedException as e:
+            print(f'ERROR: {e}', file=sys.stderr)
+            return e.exit_code
+
+        if self._is_batch:
+            merged_output = self._merge_batch_outputs(part_outputs)
+        else:
+            merged_output = self._merge_video_outputs(part_outputs)
+        # The parts' phase timings can not be meaningfully combined.
+        merged_output.pop('timing', None)
+        merged_output['timeStart'] = start_time.astimezone().isoformat()
+        merged_output['timeStop'] = datetime.datetime.now().astimezone().isoformat()
+
+        if self._cmd_line_args.brief:
+            tracks = [self._get_tracks(m) for m in merged_output['media']]
+            result = tracks if self._is_batch else tracks[0]
+        else:
+            result = merged_output
+        with self._open_output() as output:
+            mpf_cli_output_encoders.write_document(
+                result, 'json', self._cmd_line_args.pretty, output)
+            output.flush()
+        return 0
+
+
+    def _open_output(self) -> ContextManager[TextIO]:
+        output = self._cmd_line_args.output
+        if output is sys.stdout or output == '-':
+            return contextlib.nullcontext(sys.stdout)
+        return open(output, 'w')
+
+
+    def _run_parts(self) -> List[Dict[str, Any]]:
+        profile_output = self._cmd_line_args.profile_output
+        if not profile_output:
+            return self._run_parts_on_executors()
+
+        # Each part writes its own statistics, which are combined once all of the parts complete.
+        with tempfile.TemporaryDirectory() as profile_dir:
+            part_profile_paths = [os.path.join(profile_dir, f'part-{i}.pstats')
+                                  for i in range(len(self._parts))]
+            self._parts = [['--profile-output', path, *p]
+                           for p, path in zip(self._parts, part_profile_paths)]
+            part_outputs = self._run_parts_on_executors()
+            pstats.Stats(*part_profile_paths).dump_stats(profile_output)
+            return part_outputs
+
+
+    def _run_parts_on_executors(self) -> List[Dict[str, Any]]:
+        # Connect the first part from the main thread, so that if the server needs to be started,
+        # the fork happens before any other threads or files are created.
+        first_sock = socket.socket(socket.AF_UNIX)
+        with first_sock:
+            mpf_cli_client.connect_to_server(first_sock)
+            socks = [first_sock, *(None for _ in self._parts[1:])]
+            with concurrent.futures.ThreadPoolExecutor(self._num_parts) as thread_pool:
+                futures = [thread_pool.submit(self._run_part, p, s)
+                           for p, s in zip(self._parts, socks)]
+                try:
+                    # Results are collected in the order the parts were created, so the merged
+                    # output does not depend on the order in which the parts complete.
+                    return [f.result() for f in futures]
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+
+    def _run_part(self, part_args: List[str],
+                  sock: Optional[socket.socket]) -> Dict[str, Any]:
+        argv = [self._exe_name, *self._common_args, *part_args]
+        with contextlib.ExitStack() as exit_stack:
+            if sock is None:
+                sock = exit_stack.enter_context(socket.socket(socket.AF_UNIX))
+                mpf_cli_client.connect_to_server(sock)
+            dev_null = exit_stack.enter_context(open(os.devnull))
+            # A temporary file is used instead of a pipe so that the executor never blocks
+            # because the client has not read the output yet.
+            part_output = exit_stack.enter_context(tempfile.TemporaryFile('w+'))
+            exit_code = mpf_cli_client.submit_job(
+                sock, dev_null.fileno(), part_output.fileno(), sys.stderr.fileno(), argv)
+            if exit_code != 0:
+                raise PartFailedException(exit_code)
+            part_output.seek(0)
+            return json.load(part_output)
+
+
+    def _split_media(self, media_paths: Sequence[str]) -> List[List[str]]:
+        # Use more parts than there are threads so that a part containing slow media does not
+        # leave the other executors idle at the end of the job.
+        part_size = max(1, math.ceil(len(media_paths) / (self._num_parts * 4)))
+        range_args = ['-b', str(self._cmd_line_args.begin), '-e', str(self._cmd_line_args.end)]
+        return [[*range_args, '--', *media_paths[i:i + part_size]]
+                for i in range(0, len(media_paths), part_size)]
+
+
+    def _split_video(self, media_path: str) -> List[List[str]]:
+        fps, frame_count = self._probe_video(media_path)
+        if 'FPS' not in self._cmd_line_args.media_metadata:
+            # Prevent each part from running ffprobe again.
+            self._common_args.extend(('-M', f'FPS={fps}'))
+
+        begin = self._cmd_line_args.begin
+        end = self._cmd_line_args.end
+        if end < 0 or end >= frame_count:
+            end = frame_count - 1
+        part_size = math.ceil((end - begin + 1) / self._num_parts)
+        if part_size < 1:
+            return []
+        return [['-b', str(part_begin), '-e', str(min(part_begin + part_size - 1, end)),
+                 '--', media_path]
+                for part_begin in range(begin, end + 1, part_size)]
+
+
+    @staticmethod
+    def _probe_video(media_path: str) -> Tuple[float, int]:
+        video_info = mpf_cli_media_info.get_video_info(media_path)
+        frame_count = video_info.frame_count
+        if frame_count is None:
+            # Some containers do not store the frame count, so the packets need to be counted.
+            frame_count = mpf_cli_media_info.count_video_frames(media_path)
+        return video_info.fps, frame_count
+
+
+    @staticmethod
+    def _get_common_args(argv: List[str]) -> List[str]:
+        return [arg for option, _, args in mpf_cli_fast_client.iter_args(argv)
+                if option not in _PART_EXCLUDED_OPTIONS
+                for arg in args]
+
+
+    @staticmethod
+    def _merge_batch_outputs(part_outputs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        merged_output = dict(part_outputs[0])
+        merged_output['media'] = [m for o in part_outputs for m in o['media']]
+        return merged_output
+
+
+    @classmethod
+    def _merge_video_outputs(cls, part_outputs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        tracks = [t for o in part_outputs for t in cls._get_tracks(o['media'][0])]
+        mpf_cli_job_runner.ComponentResultToDictConverter.sort_track_dicts(tracks)
+
+        merged_output = dict(part_outputs[0])
+        media_entry = dict(merged_output['media'][0])
+        track_type = next(iter(media_entry['output']))
+        media_entry['output'] = {track_type: [{'tracks': tracks}]}
+        merged_output['media'] = [media_entry]
+        return merged_output
+
+
+    @staticmethod
+    def _get_tracks(media_entry: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return next(iter(media_entry['output'].values()))[0]['tracks']
@@ -0,0 +1,235 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+"""
+Framed binary protocol used between the client and the executor process.
+
+Every message is a frame made up of a fixed size header followed by a payload:
+    - 2 bytes: The magic bytes "MP".
+    - 1 byte: The protocol version the frame was encoded with.
+    - 1 byte: The message type. See MessageType.
+    - 4 bytes: Unsigned big-endian length of the payload.
+    - payload: A UTF-8 encoded JSON object.
+File descriptors are sent as SCM_RIGHTS ancillary data attached to the frame that uses them.
+
+A session looks like:
+    1. The client sends HELLO with the protocol versions and capabilities it supports.
+    2. The client sends one or more JOB_REQUEST messages followed by END. The client does not
+       need to wait for a response before sending the next request.
+    3. The executor sends HELLO_ACK with the selected version and the capabilities both sides
+       support, then a JOB_STATUS message for each job in the order the jobs were received.
+       When both sides support the "progress" capability and a job was started with --progress,
+       the executor also sends PROGRESS messages while that job is running. A PROGRESS payload
+       is a flat JSON object, so that it can be rendered without a full JSON encoder.
+The component server may send REJECTED instead of HELLO_ACK when it has too many queued jobs.
+HELLO may include the absolute path of the descriptor that the jobs use. The component server
+peeks at it, without removing it from the socket, to choose an executor that already initialized
+that component.
+Either side may send ERROR and close the connection when it receives an invalid message.
+"""
+
+import array
+import enum
+import json
+import socket
+import struct
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+PROTOCOL_VERSION = 1
+SUPPORTED_VERSIONS = (1,)
+
+# Capabilities advertised during the handshake.
+PIPELINING_CAPABILITY = 'pipelining'
+JOB_STATUS_CAPABILITY = 'job-status'
+PROGRESS_CAPABILITY = 'progress'
+CAPABILITIES = (PIPELINING_CAPABILITY, JOB_STATUS_CAPABILITY, PROGRESS_CAPABILITY)
+
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+# A job request includes the client's standard in, standard out, and standard error.
+MAX_FDS_PER_MESSAGE = 3
+
+_MAGIC = b'MP'
+_HEADER = struct.Struct('!2sBBI')
+
+# A HELLO message only contains a few fields and a path.
+_MAX_PEEKED_HELLO_SIZE = 8192
+
+
+class MessageType(enum.IntEnum):
+    HELLO = 1
+    HELLO_ACK = 2
+    JOB_REQUEST = 3
+    JOB_STATUS = 4
+    END = 5
+    REJECTED = 6
+    ERROR = 7
+    PROGRESS = 8
+
+
+class Message(NamedTuple):
+    type: MessageType
+    payload: Dict[str, Any]
+    fds: List[int]
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def send_message(sock: socket.socket, message_type: MessageType,
+                 payload: Optional[Mapping[str, Any]] = None, fds: Sequence[int] = ()) -> None:
+    body = json.dumps(payload or {}, separators=(',', ':')).encode()
+    if len(body) > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f'Payload of {len(body)} bytes is larger than the maximum of '
+                            f'{MAX_PAYLOAD_SIZE} bytes.')
+    frame = _HEADER.pack(_MAGIC, PROTOCOL_VERSION, message_type, len(body)) + body
+    if not fds:
+        sock.sendall(frame)
+        return
+    num_sent = sock.sendmsg(
+        [frame], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+    if num_sent < len(frame):
+        sock.sendall(frame[num_sent:])
+
+
+def recv_message(sock: socket.socket) -> Optional[Message]:
+    """
+    Receives the next message. The caller is responsible for closing the returned file
+    descriptors.
+    :return: The message, or None if the connection was closed before a new message started.
+    :raises ProtocolError: When the data received is not a valid frame.
+    """
+    fds: List[int] = []
+    try:
+        header = _recv_exactly(sock, _HEADER.size, fds)
+        if header is None:
+            return None
+        magic, version, raw_type, payload_size = _HEADER.unpack(header)
+        if magic != _MAGIC:
+            raise ProtocolError('Received data that is not part of the protocol.')
+        if version not in SUPPORTED_VERSIONS:
+            raise ProtocolError(f'Unsupported protocol version: {version}')
+        if payload_size > MAX_PAYLOAD_SIZE:
+            raise ProtocolError(f'Payload of {payload_size} bytes is larger than the maximum of '
+                                f'{MAX_PAYLOAD_SIZE} bytes.')
+        try:
+            message_type = MessageType(raw_type)
+        except ValueError:
+            raise ProtocolError(f'Unknown message type: {raw_type}') from None
+
+        body = _recv_exactly(sock, payload_size, fds)
+        if body is None:
+            raise ProtocolError('Connection closed in the middle of a message.')
+        payload = json.loads(body) if body else {}
+        if not isinstance(payload, dict):
+            raise ProtocolError('Message payload is not a JSON object.')
+        return Message(message_type, payload, fds)
+    except BaseException:
+        close_fds(fds)
+        raise
+
+
+def negotiate(client_hello: Mapping[str, Any]) -> Tuple[int, List[str]]:
+    """
+    Used by the receiving side of a HELLO message to pick the protocol version and capabilities
+    for the session.
+    :raises ProtocolError: When there is no protocol version supported by both sides.
+    """
+    common_versions = set(client_hello.get('versions', ())).intersection(SUPPORTED_VERSIONS)
+    if not common_versions:
+        raise ProtocolError(
+            f'The client supports protocol versions {client_hello.get("versions")}, but the '
+            f'executor only supports {list(SUPPORTED_VERSIONS)}.')
+    capabilities = [c for c in client_hello.get('capabilities', ()) if c in CAPABILITIES]
+    return max(common_versions), capabilities
+
+
+def create_hello(descriptor_path: Optional[str] = None) -> Dict[str, Any]:
+    hello = {'versions': list(SUPPORTED_VERSIONS), 'capabilities': list(CAPABILITIES)}
+    if descriptor_path is not None:
+        hello['descriptor'] = descriptor_path
+    return hello
+
+
+def peek_hello(sock: socket.socket) -> Optional[Dict[str, Any]]:
+    """
+    Reads the client's HELLO message without removing it from the socket or waiting for it.
+    :return: The HELLO payload, or None when a complete HELLO message has not been received yet
+             or the client sent something else.
+    """
+    try:
+        data = sock.recv(_HEADER.size + _MAX_PEEKED_HELLO_SIZE,
+                         socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except OSError:
+        return None
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, raw_type, payload_size = _HEADER.unpack_from(data)
+    if (magic != _MAGIC or raw_type != MessageType.HELLO
+            or len(data) < _HEADER.size + payload_size):
+        return None
+    try:
+        payload = json.loads(data[_HEADER.size:_HEADER.size + payload_size])
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def close_fds(fds: Sequence[int]) -> None:
+    for fd in fds:
+        try:
+            socket.close(fd)
+        except OSError:
+            pass
+
+
+def _recv_exactly(sock: socket.socket, num_bytes: int, fds: List[int]) -> Optional[bytes]:
+    """
+    Receives exactly num_bytes bytes. recvmsg is used for every read so that file descriptors
+    attached to any part of the frame are received.
+    :return: The bytes received, or None if the connection was closed before any were received.
+    """
+    chunks = []
+    num_received = 0
+    ancillary_size = socket.CMSG_SPACE(MAX_FDS_PER_MESSAGE * array.array('i').itemsize)
+    while num_received < num_bytes:
+        data, ancillary_data, flags, _ = sock.recvmsg(num_bytes - num_received, ancillary_size)
+        for level, cmsg_type, cmsg_data in ancillary_data:
+            if level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+                received_fds = array.array('i')
+                received_fds.frombytes(
+                    cmsg_data[:len(cmsg_data) - (len(cmsg_data) % received_fds.itemsize)])
+                fds.extend(received_fds)
+        if flags & socket.MSG_CTRUNC:
+            raise ProtocolError('Received too many file descriptors.')
+        if not data:
+            if num_received == 0:
+                return None
+            raise ProtocolError('Connection closed in the middle of a message.')
+        chunks.append(data)
+        num_received += len(data)
+    return b''.join(chunks)
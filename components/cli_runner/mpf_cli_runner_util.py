@@ -42,6 +42,14 @@ from typing import Iterator, Mapping, Optional, Protocol, ClassVar, Iterable, Tu
 # when the process exits.
 SOCKET_ADDRESS = b'\x00mpf_cli_runner.sock'
 
+# When a client connects to this address, the component server writes a single line of JSON
+# containing its statistics and then closes the connection.
+STATS_SOCKET_ADDRESS = b'\x00mpf_cli_runner_stats.sock'
+
+# Exit code used by the client when the component server rejects a job because too many jobs are
+# already waiting for an executor process.
+SERVER_BUSY_EXIT_CODE = 7
+
 
 class MediaType(enum.Enum):
     IMAGE = enum.auto()
@@ -89,10 +97,96 @@ def expand_env_vars(raw_str: str, env: Mapping[str, str]) -> str:
 
 
 def get_idle_timeout() -> Optional[int]:
-    default_idle_timeout = 60
-    env_val_str = os.getenv('COMPONENT_SERVER_IDLE_TIMEOUT')
+    return _get_optional_non_negative_int_env('COMPONENT_SERVER_IDLE_TIMEOUT', 60)
+
+
+def get_min_warm_executors() -> int:
+    return _get_optional_non_negative_int_env('COMPONENT_SERVER_MIN_WARM_EXECUTORS', 0) or 0
+
+
+# Returns None when there is no limit.
+def get_max_warm_executors() -> Optional[int]:
+    return _get_optional_non_negative_int_env('COMPONENT_SERVER_MAX_WARM_EXECUTORS', None)
+
+
+# Returns None when there is no limit.
+def get_max_executors() -> Optional[int]:
+    return _get_optional_non_negative_int_env('COMPONENT_SERVER_MAX_EXECUTORS', None)
+
+
+# Returns None when there is no limit.
+def get_max_queued_jobs() -> Optional[int]:
+    return _get_optional_non_negative_int_env('COMPONENT_SERVER_MAX_QUEUED_JOBS', None)
+
+
+# The number of jobs a single component instance may run at the same time. Components that can
+# safely run multiple jobs at once on the same component instance opt in by setting the
+# environment variable in the "environmentVariables" section of their descriptor, so the value
+# is read from the descriptor's environment variables rather than the process's environment.
+def get_max_concurrent_jobs(descriptor_env_vars: Mapping[str, str]) -> int:
+    try:
+        return max(int(descriptor_env_vars.get('COMPONENT_MAX_CONCURRENT_JOBS', 1)), 1)
+    except ValueError:
+        return 1
+
+
+# When enabled, the component is initialized once in an executor template process and new
+# executor processes are forked from it, so they share the memory used by the component.
+def use_executor_template() -> bool:
+    return os.getenv('COMPONENT_SERVER_EXECUTOR_TEMPLATE', '').lower() in ('1', 'true', 'yes')
+
+
+def profile_jobs() -> bool:
+    return os.getenv('CLI_RUNNER_PROFILE', '').lower() in ('1', 'true', 'yes')
+
+
+# Returns None when metrics should not be served. See mpf_cli_metrics.create_listen_socket for the
+# supported formats.
+def get_metrics_address() -> Optional[str]:
+    return os.getenv('COMPONENT_SERVER_METRICS_ADDRESS') or None
+
+
+# Returns None when there is no limit.
+def get_media_info_cache_size() -> Optional[int]:
+    return _get_optional_non_negative_int_env('MEDIA_INFO_CACHE_SIZE', 256)
+
+
+# Returns None when media information should not be cached on disk.
+def get_media_info_cache_dir() -> Optional[str]:
+    return os.getenv('MEDIA_INFO_CACHE_DIR') or None
+
+
+# Returns "memory", a directory, or None to use the default temporary directory.
+def get_stdin_video_spool() -> Optional[str]:
+    return os.getenv('STDIN_VIDEO_SPOOL') or None
+
+
+def get_plugin_descriptor_pattern() -> str:
+    mpf_home = os.getenv('MPF_HOME', '/opt/mpf')
+    return os.path.join(mpf_home, 'plugins/*/descriptor/descriptor.json')
+
+
+# The number of initialized components each executor process keeps. Only images that contain more
+# than one component need more than one.
+def get_component_cache_size() -> int:
+    return _get_optional_non_negative_int_env('COMPONENT_CACHE_SIZE', 4) or 1
+
+
+# Returns None when there is no limit.
+def get_component_cache_max_memory_mb() -> Optional[int]:
+    return _get_optional_non_negative_int_env('COMPONENT_CACHE_MAX_MEMORY_MB', None)
+
+
+# Returns None when the progress heartbeat is disabled.
+def get_progress_interval() -> Optional[int]:
+    return _get_optional_non_negative_int_env('CLI_RUNNER_PROGRESS_INTERVAL', 30) or None
+
+
+# Returns None when the environment variable is set to a negative number.
+def _get_optional_non_negative_int_env(var_name: str, default: Optional[int]) -> Optional[int]:
+    env_val_str = os.getenv(var_name)
     if not env_val_str:
-        return default_idle_timeout
+        return default
     try:
         env_val_int = int(env_val_str)
         if env_val_int >= 0:
@@ -100,14 +194,14 @@ def get_idle_timeout() -> Optional[int]:
         else:
             return None
     except ValueError:
-        return default_idle_timeout
+        return default
 
 
 # From https://docs.python.org/3/library/socket.html#socket.socket.sendmsg
-def send_fds(sock: socket.socket, *fds: int) -> int:
+def send_fds(sock: socket.socket, *fds: int, data: bytes = b'\x00') -> int:
     # At least one byte of regular data must be sent with the file descriptors, so we send a
-    # zero byte.
-    return sock.sendmsg((b'\x00',), [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    # zero byte unless the caller provides the data.
+    return sock.sendmsg((data,), [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
 
 
 def get_job_props_from_env(env: Mapping[str, str]) -> Iterator[Tuple[str, str]]:
@@ -26,18 +26,27 @@
 
 from __future__ import annotations
 
+import asyncio
+import collections
 import contextlib
 import errno
+import itertools
+import json
 import logging
 import multiprocessing
 import os
-import selectors
 import signal
 import socket
 import sys
-from typing import Iterable, List, Optional
+import time
+from typing import Any, Deque, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, \
+    Tuple, Union
 
+import mpf_cli_descriptors
 import mpf_cli_executor_process
+import mpf_cli_executor_template
+import mpf_cli_metrics
+import mpf_cli_protocol as protocol
 import mpf_cli_runner_util as util
 
 log = logging.getLogger('org.mitre.mpf.cli')
@@ -105,117 +114,714 @@ class ComponentServer(contextlib.AbstractContextManager):
     ComponentServer listens for new client connections and manages a pool of processes that run
     execute jobs. When a client connection is accepted, that socket's file descriptor is sent
     to an executor. ComponentServer does not read or write to the client socket, that is handled
-    by an executor process.
+    by an executor process. The only exception is peeking at the client's HELLO message to find
+    out which descriptor the job uses.
+
+    ComponentServer runs on a single asyncio event loop. Accepting connections, messages from
+    executor processes, executor process exits, and requests to the statistics endpoint are
+    handled by callbacks on that loop. The queue and the pool of executor processes are managed
+    by a task that runs whenever one of those callbacks changes the state of the pool or when an
+    idle timeout expires.
+
+    ComponentServer can keep a pool of warm executor processes. Warm executor processes are
+    started before they are needed and initialize the component as soon as they start.
+    The number of warm executor processes is configured with the
+    COMPONENT_SERVER_MIN_WARM_EXECUTORS and COMPONENT_SERVER_MAX_WARM_EXECUTORS environment
+    variables. The idle timeout for executor processes is also enforced by ComponentServer, so
+    that the warm pool does not shrink below the minimum.
+
+    The number of executor processes can be limited with the COMPONENT_SERVER_MAX_EXECUTORS
+    environment variable. When the limit is reached, accepted client sockets wait in a FIFO queue
+    until an executor process becomes idle. The COMPONENT_SERVER_MAX_QUEUED_JOBS environment
+    variable limits the length of that queue. When the queue is full, new jobs are rejected.
+
+    When the COMPONENT_SERVER_EXECUTOR_TEMPLATE environment variable is enabled, the component is
+    initialized once in an executor template process and executor processes are forked from it.
+    See mpf_cli_executor_template.ExecutorTemplate.
+
+    In images that contain more than one component, each executor process keeps the components
+    it initialized (see mpf_cli_component_cache.ComponentCache). When the client's HELLO message
+    names a descriptor, ComponentServer prefers executor processes that it previously sent jobs
+    for that descriptor.
     """
+    # The maximum number of connections accepted each time the server socket becomes readable,
+    # so that a burst of connections can not delay messages from executor processes.
+    _MAX_ACCEPTS_PER_WAKEUP = 256
+
+    # The longest time, in seconds, to wait for a client's HELLO message before dispatching the
+    # job without knowing which descriptor it uses. Clients send HELLO as soon as they connect, so
+    # it usually arrives well before the timeout.
+    _HELLO_WAIT_TIMEOUT = 0.005
+
     def __init__(self, server_idle_timeout: Optional[int] = None):
         with contextlib.ExitStack() as exit_stack:
             self._server_sock = exit_stack.enter_context(socket.socket(socket.AF_UNIX))
             self._server_sock.bind(util.SOCKET_ADDRESS)
             self._server_sock.listen(1024)
+            self._server_sock.setblocking(False)
+
+            self._stats_sock = exit_stack.enter_context(socket.socket(socket.AF_UNIX))
+            self._stats_sock.bind(util.STATS_SOCKET_ADDRESS)
+            self._stats_sock.listen(16)
+            self._stats_sock.setblocking(False)
 
-            self._selector = exit_stack.enter_context(selectors.DefaultSelector())
-            self._selector.register(self._server_sock, selectors.EVENT_READ)
+            # Only created when COMPONENT_SERVER_METRICS_ADDRESS is set.
+            self._metrics: Optional[mpf_cli_metrics.ServerMetrics] = None
+            self._metrics_listen_sock: Optional[socket.socket] = None
+            self._job_report_receive_sock: Optional[socket.socket] = None
+            self._job_report_send_sock: Optional[socket.socket] = None
+            # Used to measure the time from accepting a connection to dispatching it to an
+            # executor process.
+            self._accept_times: Dict[socket.socket, float] = {}
+            if metrics_address := util.get_metrics_address():
+                self._init_metrics(metrics_address, exit_stack)
 
-            self._executor_processes: List[ExecutorProcessManager] = []
+            self._executor_processes: Set[ExecutorProcessManager] = set()
+            # Ordered by how long the process has been idle, longest first. A dict is used instead
+            # of a deque, so that a process can be found and removed in constant time.
+            self._idle_processes: collections.OrderedDict[ExecutorProcessManager, None] = \
+                collections.OrderedDict()
+            # The idle processes indexed by the descriptors of the jobs they recently ran, so that
+            # a process that already initialized a component can be found without checking every
+            # process. The processes for each descriptor have the same order as
+            # self._idle_processes.
+            self._warm_idle_processes: Dict[
+                str, collections.OrderedDict[ExecutorProcessManager, None]] = {}
+            # Processes that are running jobs, but can run more jobs at the same time, indexed by
+            # the descriptors of the components they can run more jobs for.
+            self._partially_busy_processes: Dict[str, Dict[ExecutorProcessManager, None]] = {}
+            # Processes that reported that a component can run more than one job at a time.
+            self._concurrent_processes: Set[ExecutorProcessManager] = set()
+            # The index and descriptor paths each process is currently listed under.
+            self._index_entries: Dict[
+                ExecutorProcessManager,
+                Tuple[Dict[str, Dict[ExecutorProcessManager, None]], FrozenSet[str]]] = {}
+            self._num_starting_processes = 0
+            self._job_queue: Deque[socket.socket] = collections.deque()
+            # Connections that have been accepted, but not yet added to the job queue.
+            self._accepted_sockets: List[socket.socket] = []
+            # Parsed before any executor processes are started, so that they inherit the parsed
+            # descriptors.
+            mpf_cli_descriptors.preload_plugin_descriptors()
+            # Jobs are only routed by descriptor when the image contains more than one component.
+            # Otherwise, jobs that do not use --descriptor use the only plugin descriptor.
+            plugin_descriptors = mpf_cli_descriptors.find_plugin_descriptors()
+            self._route_by_descriptor = len(plugin_descriptors) > 1
+            self._default_descriptor_path = \
+                plugin_descriptors[0] if len(plugin_descriptors) == 1 else None
+            # Accepted connections whose HELLO message has not been received yet, along with the
+            # timer that stops waiting for it.
+            self._awaiting_hello: Dict[socket.socket, asyncio.TimerHandle] = {}
             self._stats = Stats()
             self._idle_timeout = server_idle_timeout
+            self._server_idle_since: Optional[float] = None
+            self._executor_idle_timeout = util.get_idle_timeout()
+            self._max_executors = util.get_max_executors()
+            self._max_queued_jobs = util.get_max_queued_jobs()
+            if self._max_executors == 0:
+                log.warning('The maximum number of executor processes must be at least 1. '
+                            'The maximum will be set to 1.')
+                self._max_executors = 1
+
+            self._min_warm_executors = util.get_min_warm_executors()
+            if self._max_executors is not None and self._min_warm_executors > self._max_executors:
+                log.warning(
+                    f'The minimum number of warm executor processes ({self._min_warm_executors}) '
+                    f'is greater than the maximum number of executor processes '
+                    f'({self._max_executors}). The minimum will be set to the maximum.')
+                self._min_warm_executors = self._max_executors
+
+            self._max_warm_executors = util.get_max_warm_executors()
+            if (self._max_warm_executors is not None
+                    and self._max_warm_executors < self._min_warm_executors):
+                log.warning(
+                    f'The maximum number of warm executor processes '
+                    f'({self._max_warm_executors}) is less than the minimum '
+                    f'({self._min_warm_executors}). The maximum will be set to the minimum.')
+                self._max_warm_executors = self._min_warm_executors
 
+            # Set when COMPONENT_SERVER_EXECUTOR_TEMPLATE is enabled and the template process
+            # initialized the component.
+            self._executor_template: Optional[mpf_cli_executor_template.ExecutorTemplate] = None
+            # Set once the event loop starts.
+            self._loop: Optional[asyncio.AbstractEventLoop] = None
+            self._pool_changed: Optional[asyncio.Event] = None
             self._exit_stack = exit_stack.pop_all()
 
 
+    def _init_metrics(self, metrics_address: str, exit_stack: contextlib.ExitStack) -> None:
+        try:
+            self._metrics_listen_sock = exit_stack.enter_context(
+                mpf_cli_metrics.create_listen_socket(metrics_address))
+        except (OSError, ValueError) as e:
+            log.error(f'Metrics will not be available because the metrics address, '
+                      f'"{metrics_address}", could not be used: {e}')
+            return
+        log.info(f'Serving metrics on {metrics_address}.')
+        self._job_report_receive_sock, self._job_report_send_sock = \
+            mpf_cli_metrics.create_report_sockets()
+        exit_stack.enter_context(self._job_report_receive_sock)
+        exit_stack.enter_context(self._job_report_send_sock)
+        self._metrics = mpf_cli_metrics.ServerMetrics()
+
+
     def __exit__(self, *exc_details):
         self._exit_stack.__exit__(*exc_details)
 
 
     def serve(self) -> None:
         try:
-            while True:
-                client_sock = self._wait_for_accept()
-                if client_sock is None:
-                    return
-                with client_sock:
-                    self._handle_single_request(client_sock)
+            asyncio.run(self._serve())
         except BaseException:
             log.debug(self._stats)
             for proc in self._executor_processes:
                 proc.terminate()
+            if self._executor_template is not None:
+                self._executor_template.terminate()
+            for client_sock in itertools.chain(self._job_queue, self._accepted_sockets,
+                                               self._awaiting_hello):
+                client_sock.close()
             raise
 
 
-    def _handle_single_request(self, client_sock: socket.socket) -> None:
-        self._stats.on_new_job_received()
-        while True:
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._pool_changed = asyncio.Event()
+        self._start_executor_template()
+        self._start_warm_pool()
+
+        async with contextlib.AsyncExitStack() as exit_stack:
+            await exit_stack.enter_async_context(await asyncio.start_unix_server(
+                self._handle_stats_request, sock=self._stats_sock))
+            if self._metrics is not None:
+                await exit_stack.enter_async_context(await asyncio.start_server(
+                    self._handle_metrics_request, sock=self._metrics_listen_sock))
+                self._loop.add_reader(self._job_report_receive_sock, self._on_job_reports_ready)
+                exit_stack.callback(self._loop.remove_reader, self._job_report_receive_sock)
+
+            self._loop.add_reader(self._server_sock, self._on_accept_ready)
+            try:
+                await self._manage_pool()
+            finally:
+                self._loop.remove_reader(self._server_sock)
+        self._stop_all_processes()
+
+
+    def _start_executor_template(self) -> None:
+        if not util.use_executor_template():
+            return
+        log.info('Starting executor template process.')
+        template = self._exit_stack.enter_context(mpf_cli_executor_template.ExecutorTemplate(
+            [self._server_sock, *self._get_listen_sockets(), *self._accepted_sockets],
+            self._job_report_send_sock))
+        # Wait for the component to be initialized before starting any executor processes, so
+        # that they can all be forked from the template. Nothing else is running on the event
+        # loop yet, so it is fine to block.
+        if template.wait_until_ready():
+            self._executor_template = template
+
+
+    def _start_warm_pool(self) -> None:
+        if self._min_warm_executors == 0:
+            return
+        log.info(f'Starting {self._min_warm_executors} warm executor processes.')
+        new_processes = [self._start_process() for _ in range(self._min_warm_executors)]
+        # Wait for the components to be initialized before accepting the first job. Nothing else
+        # is running on the event loop yet, so it is fine to block.
+        for process in new_processes:
+            self._on_executor_message(process)
+        log.info('Warm executor processes are ready.')
+
+
+    def _on_accept_ready(self) -> None:
+        for _ in range(self._MAX_ACCEPTS_PER_WAKEUP):
             try:
-                self._find_idle_process(client_sock).submit_job(client_sock)
+                client_sock = self._server_sock.accept()[0]
+            except (BlockingIOError, InterruptedError):
+                break
+            # The executor process expects a blocking socket. The file status flags are shared
+            # with the executor's copy of the file descriptor.
+            client_sock.setblocking(True)
+            if self._metrics is not None:
+                self._accept_times[client_sock] = time.monotonic()
+            if self._should_wait_for_hello(client_sock):
+                self._wait_for_hello(client_sock)
+            else:
+                self._accepted_sockets.append(client_sock)
+        if len(self._accepted_sockets) > 0:
+            # Admitting the jobs is deferred until the other callbacks that are ready have run.
+            # This way, processes that finished jobs are handled before accepting, so that they
+            # can be used for the new jobs.
+            self._loop.call_soon(self._admit_accepted_jobs)
+
+
+    def _should_wait_for_hello(self, client_sock: socket.socket) -> bool:
+        # The job is only held back when the client has not sent anything yet and its descriptor
+        # decides which of the available executor processes the job goes to. A client that sent
+        # something other than a complete HELLO message, like an older client, is dispatched
+        # right away.
+        if not self._route_by_descriptor or self._has_received_data(client_sock):
+            return False
+        if self._partially_busy_processes or self._concurrent_processes:
+            # Jobs only share a process with jobs for components that can run more than one job
+            # at a time, so the descriptor decides whether the process can accept more jobs.
+            return True
+        num_idle = len(self._idle_processes)
+        if num_idle < 2:
+            # The job goes to the only idle process, to a new process, or to the queue. Queued
+            # jobs are routed using their HELLO message when they are dispatched.
+            return False
+        # The descriptor matters when some of the idle processes are warm for a descriptor and
+        # others are not.
+        return any(len(processes) != num_idle for processes in self._warm_idle_processes.values())
+
+
+    @staticmethod
+    def _has_received_data(client_sock: socket.socket) -> bool:
+        try:
+            return len(client_sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)) > 0
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            # Let the executor process report the error.
+            return True
+
+
+    def _wait_for_hello(self, client_sock: socket.socket) -> None:
+        self._loop.add_reader(client_sock, self._on_hello_ready, client_sock)
+        self._awaiting_hello[client_sock] = self._loop.call_later(
+            self._HELLO_WAIT_TIMEOUT, self._on_hello_ready, client_sock)
+
+
+    def _on_hello_ready(self, client_sock: socket.socket) -> None:
+        # Called when the client sends data or the timeout expires. When the HELLO message is
+        # still incomplete, the job is dispatched without considering its descriptor.
+        self._loop.remove_reader(client_sock)
+        self._awaiting_hello.pop(client_sock).cancel()
+        self._admit_job(client_sock)
+        self._pool_changed.set()
+
+
+    def _admit_accepted_jobs(self) -> None:
+        accepted_sockets = self._accepted_sockets
+        self._accepted_sockets = []
+        for client_sock in accepted_sockets:
+            self._admit_job(client_sock)
+        self._pool_changed.set()
+
+
+    def _admit_job(self, client_sock: socket.socket) -> None:
+        self._stats.on_new_job_received()
+        self._job_queue.append(client_sock)
+        self._dispatch_queued_jobs()
+        if self._max_queued_jobs is not None and len(self._job_queue) > self._max_queued_jobs:
+            self._reject_job(self._job_queue.pop())
+        elif self._job_queue:
+            log.info(f'Job queued because all {len(self._executor_processes)} executor processes '
+                     f'are busy. There are {len(self._job_queue)} queued jobs.')
+        self._stats.on_queue_length_changed(len(self._job_queue))
+
+
+    def _dispatch_queued_jobs(self) -> None:
+        while self._job_queue:
+            client_sock = self._job_queue[0]
+            descriptor_path = (self._get_requested_descriptor(client_sock)
+                               or self._default_descriptor_path)
+            process = self._find_available_process(client_sock, descriptor_path)
+            if process is None:
                 return
+            try:
+                process.submit_job(client_sock, descriptor_path)
             except TryAgain:
                 log.info('Resubmitting job because selected child process exited as the job was '
                          'submitted.')
+                self._remove_availability(process)
+                continue
+            self._update_availability(process)
+            self._job_queue.popleft().close()
+            if self._metrics is not None:
+                self._metrics.accept_to_dispatch.observe(
+                    time.monotonic() - self._accept_times.pop(client_sock))
 
 
-    def _find_idle_process(self, client_sock: socket.socket) -> ExecutorProcessManager:
-        for process in self._executor_processes:
-            if process.is_alive() and process.is_idle():
-                log.info('Re-using existing process for job.')
-                return process
-
-        log.info('Creating new executor process')
-        new_process = ExecutorProcessManager(client_sock, self._server_sock)
-        self._executor_processes.append(new_process)
-        self._selector.register(new_process.get_sentinel(), selectors.EVENT_READ)
-        self._stats.on_process_started()
+    def _reject_job(self, client_sock: socket.socket) -> None:
+        log.warning(f'Rejecting job because there are already {self._max_queued_jobs} queued '
+                    'jobs.')
+        self._stats.on_job_rejected()
+        self._accept_times.pop(client_sock, None)
+        with client_sock:
+            try:
+                # Sent in place of the HELLO_ACK the client is waiting for. The client's messages
+                # are never read.
+                protocol.send_message(
+                    client_sock, protocol.MessageType.REJECTED,
+                    {'exit_code': util.SERVER_BUSY_EXIT_CODE,
+                     'message': 'The server has too many queued jobs.'})
+            except OSError:
+                # Client already disconnected.
+                pass
+
+
+    # Returns None when the client has not sent a HELLO message yet or did not use --descriptor.
+    # The executor process reads the message, so it is only peeked at here.
+    @staticmethod
+    def _get_requested_descriptor(client_sock: socket.socket) -> Optional[str]:
+        hello = protocol.peek_hello(client_sock)
+        if hello is None:
+            return None
+        descriptor_path = hello.get('descriptor')
+        return descriptor_path if isinstance(descriptor_path, str) else None
+
+
+    # Returns None when the maximum number of executor processes are already running. When
+    # descriptor_path is None, the job's component is not known, so the job can only go to an
+    # idle or new process.
+    def _find_available_process(
+            self, client_sock: socket.socket,
+            descriptor_path: Optional[str]) -> Optional[ExecutorProcessManager]:
+        if descriptor_path is not None:
+            if processes := self._partially_busy_processes.get(descriptor_path):
+                log.info('Re-using existing process that is already running a job.')
+                # Fill the processes that run multiple jobs at the same time before using idle
+                # processes, so that the idle processes can time out.
+                return next(iter(processes))
+            if processes := self._warm_idle_processes.get(descriptor_path):
+                log.info('Re-using existing process that already initialized the component for '
+                         f'{descriptor_path}.')
+                # The most recently active process, like when there is no warm process.
+                return next(reversed(processes))
+
+        if self._idle_processes:
+            log.info('Re-using existing process for job.')
+            # Use the most recently active process so that the processes that have been idle the
+            # longest can time out.
+            return next(reversed(self._idle_processes))
+
+        if self._can_start_process():
+            log.info('Creating new executor process')
+            return self._start_process(client_sock)
+        else:
+            return None
+
+
+    def _can_start_process(self) -> bool:
+        return self._max_executors is None or len(self._executor_processes) < self._max_executors
+
+
+    # The sockets, other than the job server socket, that the component server listens on. They
+    # are closed in executor processes.
+    def _get_listen_sockets(self) -> List[socket.socket]:
+        return [s for s in (self._stats_sock, self._metrics_listen_sock,
+                            self._job_report_receive_sock)
+                if s is not None]
+
+
+    # When client_sock is None, the new process is a warm process and will initialize the
+    # component before it receives a job.
+    def _start_process(self, client_sock: Optional[socket.socket] = None) -> ExecutorProcessManager:
+        inherited_sockets = [
+            *self._get_listen_sockets(),
+            *(p.get_socket() for p in self._executor_processes),
+            *(s for s in self._job_queue if s is not client_sock),
+            *self._accepted_sockets,
+            *self._awaiting_hello]
+        if self._executor_template is not None:
+            inherited_sockets.append(self._executor_template.get_socket())
+        new_process = ExecutorProcessManager(self._server_sock, inherited_sockets, client_sock,
+                                             self._executor_template, self._job_report_send_sock)
+        self._executor_processes.add(new_process)
+        if new_process.is_starting():
+            self._num_starting_processes += 1
+        self._loop.add_reader(new_process.get_sentinel(), self._on_process_exited, new_process)
+        self._loop.add_reader(new_process.get_socket(), self._on_executor_message, new_process)
+        self._stats.on_process_started(len(self._executor_processes))
         return new_process
 
 
-    def _remove_dead_processes(self) -> None:
-        still_alive = []
-        for process in self._executor_processes:
-            if process.is_alive():
-                still_alive.append(process)
-            else:
-                self._selector.unregister(process.get_sentinel())
-                exit_code = process.cleanup()
-                self._stats.on_process_exited(exit_code)
+    def _on_executor_message(self, process: ExecutorProcessManager) -> None:
+        if process not in self._executor_processes:
+            # The process's sentinel and socket were both ready, and the sentinel was handled
+            # first.
+            return
+        was_starting = process.is_starting()
+        if process.receive_messages():
+            if process.can_run_concurrent_jobs():
+                self._concurrent_processes.add(process)
+            self._update_availability(process)
+        else:
+            # The process exited. It will be removed when its sentinel becomes ready. The socket
+            # is unregistered now, so that the event loop doesn't keep reporting it as readable.
+            self._loop.remove_reader(process.get_socket())
+            self._remove_availability(process)
+        if was_starting and not process.is_starting():
+            self._num_starting_processes -= 1
+        self._pool_changed.set()
+
+
+    def _update_availability(self, process: ExecutorProcessManager) -> None:
+        if process.is_idle():
+            # A process that is already idle may report how many jobs it can run at once. It
+            # keeps its place in the idle order.
+            if process not in self._idle_processes:
+                self._idle_processes[process] = None
+            self._update_index(process, self._warm_idle_processes,
+                               process.get_warm_descriptors())
+        else:
+            self._idle_processes.pop(process, None)
+            self._update_index(process, self._partially_busy_processes,
+                               process.get_free_slot_descriptors())
+
+
+    def _remove_availability(self, process: ExecutorProcessManager) -> None:
+        self._idle_processes.pop(process, None)
+        self._concurrent_processes.discard(process)
+        self._update_index(process, None, frozenset())
 
-        num_removed = len(self._executor_processes) - len(still_alive)
-        if num_removed != 0:
-            log.info(f'Reaping {num_removed} processes.')
-        self._executor_processes = still_alive
 
+    def _update_index(self, process: ExecutorProcessManager,
+                      index: Optional[Dict[str, Dict[ExecutorProcessManager, None]]],
+                      descriptors: FrozenSet[str]) -> None:
+        prev_entry = self._index_entries.pop(process, None)
+        if prev_entry is not None:
+            prev_index, prev_descriptors = prev_entry
+            if prev_index is index and prev_descriptors == descriptors:
+                self._index_entries[process] = prev_entry
+                return
+            for descriptor_path in prev_descriptors:
+                processes = prev_index[descriptor_path]
+                del processes[process]
+                if not processes:
+                    del prev_index[descriptor_path]
+
+        if index is None or not descriptors:
+            return
+        for descriptor_path in descriptors:
+            index.setdefault(descriptor_path, collections.OrderedDict())[process] = None
+        self._index_entries[process] = (index, descriptors)
+
+
+    def _on_process_exited(self, process: ExecutorProcessManager) -> None:
+        log.info(f'Reaping process {process.pid}.')
+        self._loop.remove_reader(process.get_sentinel())
+        if process.is_starting():
+            self._num_starting_processes -= 1
+        # Already unregistered if the process was retired or the end of file was received.
+        self._loop.remove_reader(process.get_socket())
+        self._remove_availability(process)
+        self._executor_processes.remove(process)
+        exit_code = process.cleanup()
+        self._stats.on_process_exited(exit_code)
+        self._pool_changed.set()
 
-    # Returns None when the server should exit due to idle.
-    def _wait_for_accept(self) -> Optional[socket.socket]:
-        # Will loop when unblocked because a child process exited.
+
+    async def _manage_pool(self) -> None:
+        """
+        Runs until the server should exit due to idle. Waits for the state of the pool to change
+        or for an idle timeout to expire.
+        """
         while True:
-            self._remove_dead_processes()
+            self._dispatch_queued_jobs()
+            self._stats.on_queue_length_changed(len(self._job_queue))
+            self._retire_idle_processes()
+            self._refill_warm_pool()
+            self._update_server_idle_state()
             log.debug(self._stats)
-            can_exit_due_to_idle = (self._idle_timeout is not None
-                                    and len(self._executor_processes) == 0 and os.getpid() != 1)
-            if can_exit_due_to_idle:
-                return self._wait_for_accept_with_timeout()
-
-            ready_list = self._selector.select()
-            for key, _ in ready_list:
-                if key.fileobj is self._server_sock:
-                    # ready_list may also contain exited processes, but we want to prioritize
-                    # starting the new job.
-                    return self._server_sock.accept()[0]
-
-
-    # Returns None when the server should exit due to idle.
-    def _wait_for_accept_with_timeout(self) -> Optional[socket.socket]:
-        ready_list = self._selector.select(self._idle_timeout)
-        if ready_list:
-            return self._server_sock.accept()[0]
+
+            self._pool_changed.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._pool_changed.wait(), self._get_wait_timeout())
+
+            server_idle_deadline = self._get_server_idle_deadline()
+            if (not self._pool_changed.is_set()
+                    and server_idle_deadline is not None
+                    and time.monotonic() >= server_idle_deadline):
+                log.info('Exiting due to idle')
+                log.debug(self._stats)
+                return
+
+
+    def _retire_idle_processes(self) -> None:
+        if self._max_warm_executors is not None:
+            while len(self._idle_processes) > self._max_warm_executors:
+                self._retire(next(iter(self._idle_processes)),
+                             'the maximum number of warm executor processes was exceeded')
+
+        if self._executor_idle_timeout is None:
+            return
+        now = time.monotonic()
+        # self._idle_processes is ordered by how long the processes have been idle, so we only
+        # need to check the front of the queue.
+        while len(self._idle_processes) > self._min_warm_executors:
+            process = next(iter(self._idle_processes))
+            if now - process.get_idle_since() < self._executor_idle_timeout:
+                return
+            self._retire(process, 'idle timeout')
+
+
+    def _retire(self, process: ExecutorProcessManager, reason: str) -> None:
+        log.info(f'Stopping executor process {process.pid} due to {reason}.')
+        self._remove_availability(process)
+        self._loop.remove_reader(process.get_socket())
+        process.retire()
+
+
+    def _refill_warm_pool(self) -> None:
+        num_warm = len(self._idle_processes) + self._num_starting_processes
+        for _ in range(self._min_warm_executors - num_warm):
+            if not self._can_start_process():
+                return
+            log.info('Starting executor process to refill the warm pool.')
+            self._start_process()
+
+
+    def _update_server_idle_state(self) -> None:
+        can_exit_due_to_idle = (
+                self._idle_timeout is not None
+                and os.getpid() != 1
+                and not self._accepted_sockets
+                and not self._awaiting_hello
+                and len(self._executor_processes) <= self._min_warm_executors
+                and len(self._idle_processes) == len(self._executor_processes))
+        if not can_exit_due_to_idle:
+            self._server_idle_since = None
+        elif self._server_idle_since is None:
+            self._server_idle_since = time.monotonic()
+
+
+    def _get_server_idle_deadline(self) -> Optional[float]:
+        if self._server_idle_since is None:
+            return None
+        return self._server_idle_since + self._idle_timeout
+
+
+    def _get_wait_timeout(self) -> Optional[float]:
+        deadlines = []
+        if (self._executor_idle_timeout is not None
+                and len(self._idle_processes) > self._min_warm_executors):
+            deadlines.append(next(iter(self._idle_processes)).get_idle_since()
+                             + self._executor_idle_timeout)
+
+        server_idle_deadline = self._get_server_idle_deadline()
+        if server_idle_deadline is not None:
+            deadlines.append(server_idle_deadline)
+
+        if deadlines:
+            return max(0.0, min(deadlines) - time.monotonic())
         else:
-            log.info('Exiting due to idle')
-            log.debug(self._stats)
             return None
 
 
+    async def _handle_stats_request(self, reader: asyncio.StreamReader,
+                                    writer: asyncio.StreamWriter) -> None:
+        stats = {
+            **self._stats.to_dict(),
+            'queued_jobs': len(self._job_queue),
+            'executor_processes': len(self._executor_processes),
+            'idle_executor_processes': len(self._idle_processes),
+            'starting_executor_processes': self._num_starting_processes,
+            'running_jobs': sum(p.get_num_running_jobs() for p in self._executor_processes),
+        }
+        # The response is a single line, so that clients do not need to wait for the connection
+        # to close. An executor process started while this connection is open will inherit it.
+        writer.write(json.dumps(stats).encode() + b'\n')
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+        writer.close()
+
+
+    def _on_job_reports_ready(self) -> None:
+        while True:
+            try:
+                report = self._job_report_receive_sock.recv(mpf_cli_metrics.MAX_REPORT_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            self._metrics.on_job_report(report)
+
+
+    async def _handle_metrics_request(self, reader: asyncio.StreamReader,
+                                      writer: asyncio.StreamWriter) -> None:
+        try:
+            # Metrics are the only thing served, so the request is read, but not parsed.
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            body = '\n'.join((*self._render_pool_metrics(), *self._metrics.render(), '')).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         + f'Content-Length: {len(body)}\r\n'.encode()
+                         + b'Connection: close\r\n\r\n'
+                         + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+
+    def _render_pool_metrics(self) -> Iterator[str]:
+        stats = self._stats
+        num_idle = len(self._idle_processes)
+        num_busy = len(self._executor_processes) - num_idle - self._num_starting_processes
+        counters_and_gauges = (
+            ('mpf_cli_jobs_submitted_total', 'counter', 'Jobs received by the component server.',
+             stats.job_count),
+            ('mpf_cli_jobs_rejected_total', 'counter',
+             'Jobs rejected because too many jobs were queued.', stats.jobs_rejected),
+            ('mpf_cli_queued_jobs', 'gauge', 'Jobs waiting for an executor process.',
+             len(self._job_queue)),
+            ('mpf_cli_running_jobs', 'gauge', 'Jobs running in executor processes.',
+             sum(p.get_num_running_jobs() for p in self._executor_processes)),
+            ('mpf_cli_executor_processes_started_total', 'counter',
+             'Executor processes started.', stats.processes_started),
+            ('mpf_cli_executor_processes_exited_total', 'counter',
+             'Executor processes that exited.', stats.processes_exited),
+            ('mpf_cli_executor_process_errors_total', 'counter',
+             'Executor processes that exited with a non-zero exit code.', stats.process_errors),
+        )
+        for name, metric_type, documentation, value in counters_and_gauges:
+            yield from mpf_cli_metrics.render_samples(
+                name, metric_type, documentation, [({}, value)])
+
+        yield from mpf_cli_metrics.render_samples(
+            'mpf_cli_executor_processes', 'gauge', 'Executor processes in each state.',
+            [({'state': 'idle'}, num_idle),
+             ({'state': 'busy'}, num_busy),
+             ({'state': 'starting'}, self._num_starting_processes)])
+
+        processes = [('server', os.getpid())]
+        if self._executor_template is not None:
+            processes.append(('template', self._executor_template.pid))
+        processes.extend(('executor', p.pid) for p in self._executor_processes)
+        memory_samples = []
+        for role, pid in processes:
+            resident_memory = mpf_cli_metrics.get_resident_memory_bytes(pid)
+            if resident_memory is not None:
+                memory_samples.append(({'role': role, 'pid': str(pid)}, resident_memory))
+        yield from mpf_cli_metrics.render_samples(
+            'mpf_cli_resident_memory_bytes', 'gauge',
+            'Resident memory of the component server, executor template, and executor processes. '
+            'Memory pages shared between processes are counted in each process.',
+            memory_samples)
+
+
+    def _stop_all_processes(self) -> None:
+        for process in self._executor_processes:
+            if process.is_alive():
+                process.retire()
+        for process in self._executor_processes:
+            process.cleanup()
+        self._executor_processes.clear()
+        self._idle_processes.clear()
+        self._warm_idle_processes.clear()
+        self._partially_busy_processes.clear()
+        self._concurrent_processes.clear()
+        self._index_entries.clear()
+
+
 class Stats:
     def __init__(self):
         self.job_count = 0
+        self.jobs_rejected = 0
+        self.max_queued = 0
         self.max_active = 0
         self.processes_started = 0
         self.processes_exited = 0
@@ -224,17 +830,35 @@ class Stats:
     def on_new_job_received(self) -> None:
         self.job_count += 1
 
-    def on_process_started(self) -> None:
+    def on_job_rejected(self) -> None:
+        self.jobs_rejected += 1
+
+    def on_queue_length_changed(self, queue_length: int) -> None:
+        self.max_queued = max(self.max_queued, queue_length)
+
+    def on_process_started(self, num_active_processes: int) -> None:
         self.processes_started += 1
-        self.max_active = max(self.max_active, len(multiprocessing.active_children()))
+        self.max_active = max(self.max_active, num_active_processes)
 
     def on_process_exited(self, exit_code: int) -> None:
         self.processes_exited += 1
         if exit_code != 0:
             self.process_errors += 1
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'jobs_submitted': self.job_count,
+            'jobs_rejected': self.jobs_rejected,
+            'max_queued_jobs': self.max_queued,
+            'max_active_processes': self.max_active,
+            'processes_started': self.processes_started,
+            'processes_exited': self.processes_exited,
+            'process_errors': self.process_errors,
+        }
+
     def __str__(self):
-        return f'Jobs submitted = {self.job_count}, max active processes = {self.max_active}, ' \
+        return f'Jobs submitted = {self.job_count}, rejected = {self.jobs_rejected}, ' \
+               f'max queued = {self.max_queued}, max active processes = {self.max_active}, ' \
                f'processes started = {self.processes_started}, exited = {self.processes_exited}, ' \
                f'errors = {self.process_errors}'
 
@@ -246,74 +870,200 @@ class TryAgain(Exception):
 class ExecutorProcessManager:
     """
     Starts a component executor process. Sends new jobs to the executor process using a Unix
-    socket. The protocol is as follows:
-    1. Executor is informed of a new job when it receives a message containing one byte of regular
-       data and ancillary data containing a single file descriptor. The one byte of regular data
-       is ignored. It is sent because a message can't contain only ancillary data. The file
-       descriptor is the client socket returned from socket.accept.
-    2. Executor interacts with the socket to get the job information, run the job, then sends the
+    socket. The executor's messages are JSON objects, each followed by a newline. The protocol is
+    as follows:
+    1. When the executor process is started without a job, it initializes the component and then
+       sends {"event": "ready"} to ComponentServer to indicate it is ready to receive a job.
+    2. Executor is informed of a new job when it receives a message containing a session id as
+       regular data (see mpf_cli_executor_process.SESSION_ID) and ancillary data containing a
+       single file descriptor. The file descriptor is the client socket returned from
+       socket.accept.
+    3. Executor interacts with the socket to get the job information, run the job, then sends the
        results to the client socket.
-    3. Executor sends a 1 byte message to ComponentServer to indicate it finished the job and is
-       now idle.
+    4. Executor sends {"event": "session_done", "session_id": <id>} to ComponentServer to
+       indicate it finished the client's jobs.
+    5. When ComponentServer wants an idle executor to exit, it sends a 1 byte message without
+       any ancillary data.
+    6. When a component that can run multiple jobs at the same time is initialized, the next
+       message from step 1 or 4 also contains "max_concurrent_jobs", which maps the component's
+       descriptor path to its maximum number of concurrent jobs. Until then, the executor only
+       runs one job at a time. After that, ComponentServer may send the executor a client for
+       one of those components while the executor is running fewer than the maximum number of
+       jobs for the component, and it is only running jobs for components with a maximum.
+
+    The executor does not report which components it has initialized. Instead, the descriptors of
+    the jobs submitted to it are tracked with the same least recently used policy and size as
+    the executor's component cache.
     """
-    def __init__(self, client_sock: socket.socket, listen_sock: socket.socket):
+    def __init__(self, listen_sock: socket.socket, inherited_sockets: Iterable[socket.socket],
+                 client_sock: Optional[socket.socket] = None,
+                 template: Optional[mpf_cli_executor_template.ExecutorTemplate] = None,
+                 metrics_socket: Optional[socket.socket] = None):
         self._to_child, from_parent = socket.socketpair(socket.AF_UNIX)
         with from_parent, contextlib.ExitStack() as exit_stack:
             exit_stack.enter_context(self._to_child)
             # The executor process will inherit the parent's file descriptors, even the ones it
             # does not need.
-            close_in_child = (
+            close_in_child = [
                 # Executor process doesn't listen for new connections.
                 listen_sock,
-                # If we don't close this, the executor will keep open the socket to the client
-                # that was being processed when it was initially created.
-                client_sock,
+                # If we don't close these, the other executors will not see the socket get closed
+                # when the server exits.
+                *inherited_sockets,
                 # This is the server process's side of the socket pair.
                 self._to_child
-            )
-            self._process = multiprocessing.Process(
-                target=self._run_executor_in_subprocess,
-                args=(from_parent, close_in_child),
-                daemon=True)
-            self._process.start()
+            ]
+            if client_sock is not None:
+                # If we don't close this, the executor will keep open the socket to the client
+                # that was being processed when it was initially created.
+                close_in_child.append(client_sock)
+
+            init_component_on_start = client_sock is None
+            self._process = self._start_executor(
+                template, from_parent, close_in_child, init_component_on_start, metrics_socket)
             exit_stack.callback(self._process.close)
-            self._pid = self._process.pid
-            self._is_idle = True
+            self.pid = self._process.pid
+            self._is_starting = init_component_on_start
+            self._next_session_id = 0
+            # The descriptor path of each running session's job, by session id. None when the
+            # job's component is not known.
+            self._running_sessions: Dict[int, Optional[str]] = {}
+            self._num_running_jobs_by_descriptor: Dict[Optional[str], int] = {}
+            # Only contains the components that can run more than one job at a time.
+            self._max_concurrent_jobs: Dict[str, int] = {}
+            # Holds the start of a message that was not completely received.
+            self._receive_buffer = b''
+            self._idle_since = time.monotonic()
+            self._is_retired = False
             self._broken_pipe = False
+            self._warm_descriptors: collections.OrderedDict[str, None] = \
+                collections.OrderedDict()
+            self._max_warm_descriptors = util.get_component_cache_size()
+            self._exit_stack = exit_stack.pop_all()
 
-            self._selector = exit_stack.enter_context(selectors.DefaultSelector())
-            self._selector.register(self._to_child, selectors.EVENT_READ)
 
-            self._exit_stack = exit_stack.pop_all()
+    @classmethod
+    def _start_executor(
+            cls, template: Optional[mpf_cli_executor_template.ExecutorTemplate],
+            from_parent: socket.socket, close_in_child: List[socket.socket],
+            init_component_on_start: bool, metrics_socket: Optional[socket.socket]
+    ) -> Union[multiprocessing.Process, mpf_cli_executor_template.ForkedExecutorProcess]:
+        if template is not None and template.is_alive():
+            try:
+                return template.fork_executor(from_parent, init_component_on_start)
+            except OSError:
+                log.exception('Failed to fork executor process from the executor template. The '
+                              'executor process will initialize the component separately.')
+        process = multiprocessing.Process(
+            target=cls._run_executor_in_subprocess,
+            args=(from_parent, close_in_child, init_component_on_start, metrics_socket),
+            daemon=True)
+        process.start()
+        return process
 
 
     @staticmethod
     def _run_executor_in_subprocess(from_parent_socket: socket.socket,
-                                    sockets_to_close: Iterable[socket.socket]) -> None:
+                                    sockets_to_close: Iterable[socket.socket],
+                                    init_component_on_start: bool,
+                                    metrics_socket: Optional[socket.socket]) -> None:
         for s in sockets_to_close:
             s.close()
-        with mpf_cli_executor_process.ExecutorProcess(from_parent_socket) as executor:
+        log.info(f'Executor process started with pid {os.getpid()}.')
+        with mpf_cli_executor_process.ExecutorProcess(
+                from_parent_socket, init_component_on_start, metrics_socket) as executor:
             executor.run_jobs()
 
 
-    def submit_job(self, client_sock: socket.socket) -> None:
-        self._is_idle = False
+    def submit_job(self, client_sock: socket.socket,
+                   descriptor_path: Optional[str] = None) -> None:
+        session_id = self._next_session_id
         try:
-            util.send_fds(self._to_child, client_sock.fileno())
+            util.send_fds(self._to_child, client_sock.fileno(),
+                          data=mpf_cli_executor_process.SESSION_ID.pack(session_id))
         except BrokenPipeError as e:
             self._broken_pipe = True
             raise TryAgain() from e
+        self._next_session_id = (session_id + 1) % (1 << 32)
+        self._running_sessions[session_id] = descriptor_path
+        self._num_running_jobs_by_descriptor[descriptor_path] = \
+            self._num_running_jobs_by_descriptor.get(descriptor_path, 0) + 1
+        if descriptor_path is not None:
+            self._warm_descriptors[descriptor_path] = None
+            self._warm_descriptors.move_to_end(descriptor_path)
+            if len(self._warm_descriptors) > self._max_warm_descriptors:
+                self._warm_descriptors.popitem(last=False)
+
+
+    def receive_messages(self) -> bool:
+        """
+        Receives the messages the executor sends when it finishes a job, when it finishes
+        initializing the component, or when it reports how many jobs it can run at once.
+        :return: True if the executor is still running, or False if the executor exited.
+        """
+        data = self._to_child.recv(4096)
+        if not data:
+            # The child process closed its end of the socket, so it must have exited.
+            self._is_starting = False
+            self._broken_pipe = True
+            return False
+
+        *messages, self._receive_buffer = (self._receive_buffer + data).split(b'\n')
+        for message in map(json.loads, messages):
+            self._max_concurrent_jobs.update(message.get('max_concurrent_jobs', ()))
+            if message['event'] == 'ready':
+                self._is_starting = False
+            else:
+                descriptor_path = self._running_sessions.pop(message['session_id'])
+                num_running = self._num_running_jobs_by_descriptor.pop(descriptor_path) - 1
+                if num_running > 0:
+                    self._num_running_jobs_by_descriptor[descriptor_path] = num_running
+        if not self._running_sessions:
+            self._idle_since = time.monotonic()
+        return True
+
+
+    def is_starting(self) -> bool:
+        return self._is_starting
 
+    def get_warm_descriptors(self) -> FrozenSet[str]:
+        return frozenset(self._warm_descriptors)
 
     def is_idle(self) -> bool:
-        if self._is_idle:
-            return True
-        job_complete = len(self._selector.select(0)) > 0
-        if job_complete:
-            self._to_child.recv(1)
-            self._is_idle = True
-        return self._is_idle
+        return not self._is_starting and not self._running_sessions
+
+    def get_free_slot_descriptors(self) -> FrozenSet[str]:
+        """
+        :return: The descriptors of the components that another job can be sent for while the
+                 executor is running jobs. Empty when the executor is idle or starting.
+        """
+        if self._is_starting or not self._running_sessions:
+            return frozenset()
+        # A job for a component that can only run one job at a time, or whose component is not
+        # known, has the executor to itself.
+        if any(d not in self._max_concurrent_jobs for d in self._num_running_jobs_by_descriptor):
+            return frozenset()
+        return frozenset(d for d, max_jobs in self._max_concurrent_jobs.items()
+                         if self._num_running_jobs_by_descriptor.get(d, 0) < max_jobs)
+
+    def can_run_concurrent_jobs(self) -> bool:
+        return len(self._max_concurrent_jobs) > 0
 
+    def get_num_running_jobs(self) -> int:
+        return len(self._running_sessions)
+
+    def get_idle_since(self) -> float:
+        return self._idle_since
+
+    def retire(self) -> None:
+        self._is_retired = True
+        try:
+            self._to_child.send(b'\x01')
+        except BrokenPipeError:
+            self._broken_pipe = True
+
+    def is_retired(self) -> bool:
+        return self._is_retired
 
     def is_alive(self) -> bool:
         return self._process.is_alive() and not self._broken_pipe
@@ -322,14 +1072,18 @@ class ExecutorProcessManager:
         self._process.join(0.5)
         if self._process.is_alive():
             self._process.terminate()
+            self._process.join()
         exit_code = self._process.exitcode
-        log.info(f'Process {self._pid} exited wit exit code {exit_code}')
+        log.info(f'Process {self.pid} exited wit exit code {exit_code}')
         self._exit_stack.close()
         return exit_code
 
     def get_sentinel(self) -> int:
         return self._process.sentinel
 
+    def get_socket(self) -> socket.socket:
+        return self._to_child
+
     def terminate(self) -> None:
         self._process.terminate()
 
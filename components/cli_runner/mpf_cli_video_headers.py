@@ -0,0 +1,492 @@
+#############################################################################
+# NOTICE                                                                    #
+#                                                                           #
+# This software (or technical data) was produced for the U.S. Government    #
+# under contract, and is subject to the Rights in Data-General Clause       #
+# 52.227-14, Alt. IV (DEC 2007).                                            #
+#                                                                           #
+# Copyright 2024 The MITRE Corporation. All Rights Reserved.                #
+#############################################################################
+
+#############################################################################
+# Copyright 2024 The MITRE Corporation                                      #
+#                                                                           #
+# Licensed under the Apache License, Version 2.0 (the "License");           #
+# you may not use this file except in compliance with the License.          #
+# You may obtain a copy of the License at                                   #
+#                                                                           #
+#    http://www.apache.org/licenses/LICENSE-2.0                             #
+#                                                                           #
+# Unless required by applicable law or agreed to in writing, software       #
+# distributed under the License is distributed on an "AS IS" BASIS,         #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  #
+# See the License for the specific language governing permissions and       #
+# limitations under the License.                                            #
+#############################################################################
+
+"""
+Reads video information directly from the headers of common container formats, so that the
+ffprobe subprocess is only needed for formats that are not supported here.
+"""
+
+import logging
+import math
+import os
+import struct
+from typing import BinaryIO, Iterator, NamedTuple, Optional, Tuple
+
+log = logging.getLogger('org.mitre.mpf.cli')
+
+
+class VideoInfo(NamedTuple):
+    fps: float
+    # None when the container does not store the number of frames. Use
+    # mpf_cli_media_info.count_video_frames to get the frame count in that case.
+    frame_count: Optional[int]
+    duration_ms: Optional[float]
+    width: Optional[int]
+    height: Optional[int]
+    # Degrees clockwise the video needs to be rotated to display correctly.
+    rotation: float
+
+
+class UnsupportedHeadersError(Exception):
+    pass
+
+
+def read_video_headers(media_path: str) -> Optional[VideoInfo]:
+    """
+    Gets the same information as ffprobe from the container headers of MP4/MOV, Matroska/WebM,
+    and AVI files.
+    :return: The video information, or None when the format is not supported or the headers do
+             not contain everything needed.
+    """
+    try:
+        with open(media_path, 'rb') as media_file:
+            magic = media_file.read(12)
+            media_file.seek(0)
+            if magic[4:8] in _MP4_TOP_LEVEL_BOXES:
+                return _read_mp4(media_file)
+            if magic[:4] == _EBML_HEADER_ID_BYTES:
+                return _read_matroska(media_file)
+            if magic[:4] == b'RIFF' and magic[8:12] == b'AVI ':
+                return _read_avi(media_file)
+            return None
+    except (UnsupportedHeadersError, OSError, struct.error, ValueError) as e:
+        log.debug(f'Unable to read video information from the headers of {media_path}: {e}')
+        return None
+
+
+def reduce_fraction(num: int, den: int, max_value: int) -> Tuple[int, int]:
+    """
+    Finds the closest fraction to num/den where both the numerator and denominator are at most
+    max_value. This is the same algorithm as FFmpeg's av_reduce, so frame rates match ffprobe.
+    """
+    gcd = math.gcd(num, den)
+    if gcd:
+        num //= gcd
+        den //= gcd
+    a0_num, a0_den = 0, 1
+    a1_num, a1_den = 1, 0
+    if num <= max_value and den <= max_value:
+        return num, den
+
+    while den:
+        x = num // den
+        next_den = num - den * x
+        a2_num = x * a1_num + a0_num
+        a2_den = x * a1_den + a0_den
+        if a2_num > max_value or a2_den > max_value:
+            if a1_num:
+                x = (max_value - a0_num) // a1_num
+            if a1_den:
+                x = min(x, (max_value - a0_den) // a1_den)
+            if den * (2 * x * a1_den + a0_den) > num * a1_den:
+                a1_num, a1_den = x * a1_num + a0_num, x * a1_den + a0_den
+            break
+        a0_num, a0_den = a1_num, a1_den
+        a1_num, a1_den = a2_num, a2_den
+        num = den
+        den = next_den
+    return a1_num, a1_den
+
+
+def _to_fps(num: int, den: int, max_value: int) -> float:
+    if num <= 0 or den <= 0:
+        raise UnsupportedHeadersError('Invalid frame rate.')
+    reduced_num, reduced_den = reduce_fraction(num, den, max_value)
+    return reduced_num / reduced_den
+
+
+############################################################
+# MP4/MOV
+############################################################
+
+_MP4_TOP_LEVEL_BOXES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot'}
+
+_INT_MAX = 2 ** 31 - 1
+
+
+class _Mp4Track(NamedTuple):
+    handler_type: bytes
+    timescale: int
+    media_duration: int
+    frame_count: int
+    sample_duration_sum: int
+    width: Optional[int]
+    height: Optional[int]
+    rotation: float
+
+
+def _read_mp4(media_file: BinaryIO) -> VideoInfo:
+    file_size = os.fstat(media_file.fileno()).st_size
+    for box_type, start, end in _iter_mp4_boxes(media_file, 0, file_size):
+        if box_type == b'moov':
+            return _read_moov(media_file, start, end)
+    raise UnsupportedHeadersError('No moov box.')
+
+
+def _read_moov(media_file: BinaryIO, start: int, end: int) -> VideoInfo:
+    video_track = None
+    for box_type, box_start, box_end in _iter_mp4_boxes(media_file, start, end):
+        if box_type == b'mvex':
+            # The samples of fragmented files are described in moof boxes throughout the file.
+            raise UnsupportedHeadersError('Fragmented MP4 files are not supported.')
+        if box_type == b'trak' and video_track is None:
+            track = _read_trak(media_file, box_start, box_end)
+            if track.handler_type == b'vide':
+                video_track = track
+
+    if video_track is None:
+        raise UnsupportedHeadersError('No video track.')
+    if video_track.frame_count == 0 or video_track.timescale == 0:
+        raise UnsupportedHeadersError('Video track is empty.')
+
+    # Like FFmpeg, use the shorter of the mdhd duration and the sum of the sample durations.
+    duration = video_track.sample_duration_sum
+    if 0 < video_track.media_duration < duration:
+        duration = video_track.media_duration
+    return VideoInfo(
+        fps=_to_fps(video_track.timescale * video_track.frame_count, duration, _INT_MAX),
+        frame_count=video_track.frame_count,
+        duration_ms=duration * 1000 / video_track.timescale,
+        width=video_track.width,
+        height=video_track.height,
+        rotation=video_track.rotation)
+
+
+def _read_trak(media_file: BinaryIO, start: int, end: int) -> _Mp4Track:
+    handler_type = b''
+    timescale = media_duration = frame_count = sample_duration_sum = 0
+    width = height = None
+    rotation = 0.0
+    # Only the boxes needed to get to tkhd, mdhd, hdlr, stsd, and stts are visited.
+    containers = {b'mdia', b'minf', b'stbl'}
+    pending = [(b'trak', start, end)]
+    while pending:
+        parent_type, parent_start, parent_end = pending.pop()
+        for box_type, box_start, box_end in _iter_mp4_boxes(media_file, parent_start,
+                                                            parent_end):
+            if box_type in containers:
+                pending.append((box_type, box_start, box_end))
+            elif box_type == b'tkhd':
+                rotation = _read_tkhd_rotation(media_file)
+            elif box_type == b'mdhd':
+                timescale, media_duration = _read_mdhd(media_file)
+            elif box_type == b'hdlr' and parent_type == b'mdia':
+                # QuickTime files also have a data handler in minf, which is not the media type.
+                handler_type = media_file.read(12)[8:12]
+            elif box_type == b'stsd':
+                width, height = _read_stsd_dimensions(media_file)
+            elif box_type == b'stts':
+                frame_count, sample_duration_sum = _read_stts(media_file)
+    return _Mp4Track(handler_type, timescale, media_duration, frame_count, sample_duration_sum,
+                     width, height, rotation)
+
+
+def _read_tkhd_rotation(media_file: BinaryIO) -> float:
+    version = media_file.read(4)[0]
+    # Skip the times, track id, and duration, then reserved, layer, alternate group, and volume.
+    media_file.seek((32 if version == 1 else 20) + 16, os.SEEK_CUR)
+    a, b = struct.unpack('>ii', media_file.read(8))
+    if a == 0 and b == 0:
+        return 0.0
+    # The display matrix maps the decoded frame to the displayed frame.
+    return round(math.degrees(math.atan2(b, a)), 2) % 360
+
+
+def _read_mdhd(media_file: BinaryIO) -> Tuple[int, int]:
+    version = media_file.read(4)[0]
+    if version == 1:
+        return struct.unpack('>16xIQ', media_file.read(28))
+    return struct.unpack('>8xII', media_file.read(16))
+
+
+def _read_stsd_dimensions(media_file: BinaryIO) -> Tuple[Optional[int], Optional[int]]:
+    # Skip version, flags, and entry count, then read the first visual sample entry.
+    header = media_file.read(8 + 36)
+    if len(header) < 44:
+        return None, None
+    return struct.unpack('>HH', header[40:44])
+
+
+def _read_stts(media_file: BinaryIO) -> Tuple[int, int]:
+    entry_count = struct.unpack('>4xI', media_file.read(8))[0]
+    entries = media_file.read(entry_count * 8)
+    if len(entries) != entry_count * 8:
+        raise UnsupportedHeadersError('Truncated stts box.')
+    frame_count = 0
+    duration_sum = 0
+    for sample_count, sample_delta in struct.iter_unpack('>II', entries):
+        frame_count += sample_count
+        duration_sum += sample_count * sample_delta
+    return frame_count, duration_sum
+
+
+def _iter_mp4_boxes(media_file: BinaryIO, start: int,
+                    end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """
+    Yields the type, payload start position, and end position of each box between start and
+    end. The caller may read from media_file before requesting the next box.
+    """
+    position = start
+    while position + 8 <= end:
+        media_file.seek(position)
+        size, box_type = struct.unpack('>I4s', media_file.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', media_file.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            raise UnsupportedHeadersError(f'Invalid size for {box_type!r} box.')
+        yield box_type, position + header_size, min(position + size, end)
+        position += size
+
+
+############################################################
+# Matroska/WebM
+############################################################
+
+_EBML_HEADER_ID_BYTES = b'\x1a\x45\xdf\xa3'
+_EBML_HEADER_ID = 0x1A45DFA3
+_EBML_DOC_TYPE_ID = 0x4282
+_SEGMENT_ID = 0x18538067
+_INFO_ID = 0x1549A966
+_TIMESTAMP_SCALE_ID = 0x2AD7B1
+_DURATION_ID = 0x4489
+_TRACKS_ID = 0x1654AE6B
+_TRACK_ENTRY_ID = 0xAE
+_TRACK_TYPE_ID = 0x83
+_DEFAULT_DURATION_ID = 0x23E383
+_VIDEO_ID = 0xE0
+_PIXEL_WIDTH_ID = 0xB0
+_PIXEL_HEIGHT_ID = 0xBA
+_CLUSTER_ID = 0x1F43B675
+
+_MATROSKA_VIDEO_TRACK_TYPE = 1
+
+
+def _read_matroska(media_file: BinaryIO) -> VideoInfo:
+    elements = _iter_ebml_elements(media_file, 0, None)
+    element_id, data_start, data_end = next(elements)
+    if element_id != _EBML_HEADER_ID or data_end is None:
+        raise UnsupportedHeadersError('Invalid EBML header.')
+    doc_type = _find_ebml_value(media_file, data_start, data_end, _EBML_DOC_TYPE_ID, _read_str)
+    if doc_type not in ('matroska', 'webm'):
+        raise UnsupportedHeadersError(f'Unsupported EBML document type: {doc_type}')
+
+    element_id, segment_start, segment_end = next(elements)
+    if element_id != _SEGMENT_ID:
+        raise UnsupportedHeadersError('Missing Matroska segment.')
+
+    timestamp_scale = 1_000_000
+    duration = None
+    track = None
+    for element_id, data_start, data_end in _iter_ebml_elements(
+            media_file, segment_start, segment_end):
+        if element_id == _INFO_ID and data_end is not None:
+            timestamp_scale, duration = _read_matroska_info(media_file, data_start, data_end)
+        elif element_id == _TRACKS_ID and data_end is not None:
+            track = _read_matroska_video_track(media_file, data_start, data_end)
+        elif element_id == _CLUSTER_ID:
+            # The headers needed are always before the first cluster in files produced by
+            # common muxers.
+            break
+        if track is not None and duration is not None:
+            break
+
+    if track is None:
+        raise UnsupportedHeadersError('No video track with a default duration.')
+    default_duration, width, height = track
+    return VideoInfo(
+        # FFmpeg limits the numerator and denominator to 30000 for Matroska frame rates.
+        fps=_to_fps(1_000_000_000, default_duration, 30000),
+        frame_count=None,
+        duration_ms=duration * timestamp_scale / 1_000_000 if duration is not None else None,
+        width=width,
+        height=height,
+        rotation=0.0)
+
+
+def _read_matroska_info(media_file: BinaryIO, start: int,
+                        end: int) -> Tuple[int, Optional[float]]:
+    timestamp_scale = 1_000_000
+    duration = None
+    for element_id, data_start, data_end in _iter_ebml_elements(media_file, start, end):
+        if element_id == _TIMESTAMP_SCALE_ID:
+            timestamp_scale = _read_uint(media_file, data_start, data_end)
+        elif element_id == _DURATION_ID:
+            duration = _read_float(media_file, data_start, data_end)
+    return timestamp_scale, duration
+
+
+def _read_matroska_video_track(
+        media_file: BinaryIO, start: int,
+        end: int) -> Optional[Tuple[int, Optional[int], Optional[int]]]:
+    for element_id, data_start, data_end in _iter_ebml_elements(media_file, start, end):
+        if element_id != _TRACK_ENTRY_ID:
+            continue
+        track_type = default_duration = width = height = None
+        for child_id, child_start, child_end in _iter_ebml_elements(
+                media_file, data_start, data_end):
+            if child_id == _TRACK_TYPE_ID:
+                track_type = _read_uint(media_file, child_start, child_end)
+            elif child_id == _DEFAULT_DURATION_ID:
+                default_duration = _read_uint(media_file, child_start, child_end)
+            elif child_id == _VIDEO_ID:
+                width = _find_ebml_value(media_file, child_start, child_end, _PIXEL_WIDTH_ID,
+                                         _read_uint)
+                height = _find_ebml_value(media_file, child_start, child_end, _PIXEL_HEIGHT_ID,
+                                          _read_uint)
+        if track_type == _MATROSKA_VIDEO_TRACK_TYPE:
+            # Only the first video track is used, to match ffprobe's "-select_streams v:0".
+            if not default_duration:
+                return None
+            return default_duration, width, height
+    return None
+
+
+def _iter_ebml_elements(media_file: BinaryIO, start: int,
+                        end: Optional[int]) -> Iterator[Tuple[int, int, Optional[int]]]:
+    """
+    Yields the id, data start position, and data end position of each element between start
+    and end. The end position is None when the element's size is unknown. Since an element with
+    an unknown size can not be skipped, iteration stops after such an element.
+    """
+    position = start
+    while end is None or position < end:
+        media_file.seek(position)
+        element_id = _read_ebml_vint(media_file, keep_marker=True)
+        if element_id is None:
+            return
+        size = _read_ebml_vint(media_file, keep_marker=False)
+        data_start = media_file.tell()
+        if size is None:
+            yield element_id, data_start, None
+            return
+        yield element_id, data_start, data_start + size
+        position = data_start + size
+
+
+def _read_ebml_vint(media_file: BinaryIO, keep_marker: bool) -> Optional[int]:
+    first_byte = media_file.read(1)
+    if not first_byte:
+        return None
+    value = first_byte[0]
+    if value == 0:
+        raise UnsupportedHeadersError('Invalid EBML variable length integer.')
+    length = 9 - value.bit_length()
+    if not keep_marker:
+        value &= (1 << (8 - length)) - 1
+    remaining = media_file.read(length - 1)
+    if len(remaining) != length - 1:
+        raise UnsupportedHeadersError('Truncated EBML element.')
+    all_ones = value == (1 << (8 - length)) - 1 and remaining == b'\xff' * (length - 1)
+    for byte in remaining:
+        value = (value << 8) | byte
+    if not keep_marker and all_ones:
+        # A size with all bits set means the size is unknown.
+        return None
+    return value
+
+
+def _find_ebml_value(media_file: BinaryIO, start: int, end: int, element_id: int, reader):
+    for child_id, child_start, child_end in _iter_ebml_elements(media_file, start, end):
+        if child_id == element_id and child_end is not None:
+            return reader(media_file, child_start, child_end)
+    return None
+
+
+def _read_uint(media_file: BinaryIO, start: int, end: int) -> int:
+    media_file.seek(start)
+    return int.from_bytes(media_file.read(end - start), 'big')
+
+
+def _read_float(media_file: BinaryIO, start: int, end: int) -> float:
+    media_file.seek(start)
+    if end - start == 4:
+        return struct.unpack('>f', media_file.read(4))[0]
+    if end - start == 8:
+        return struct.unpack('>d', media_file.read(8))[0]
+    raise UnsupportedHeadersError('Invalid EBML float size.')
+
+
+def _read_str(media_file: BinaryIO, start: int, end: int) -> str:
+    media_file.seek(start)
+    return media_file.read(end - start).rstrip(b'\x00').decode('ascii', errors='replace')
+
+
+############################################################
+# AVI
+############################################################
+
+def _read_avi(media_file: BinaryIO) -> VideoInfo:
+    riff_size = struct.unpack('<4xI', media_file.read(8))[0]
+    end = min(riff_size + 8, os.fstat(media_file.fileno()).st_size)
+    for chunk_id, data_start, data_end in _iter_riff_chunks(media_file, 12, end):
+        if chunk_id == b'LIST' and media_file.read(4) == b'hdrl':
+            return _read_avi_hdrl(media_file, data_start + 4, data_end)
+    raise UnsupportedHeadersError('No hdrl list.')
+
+
+def _read_avi_hdrl(media_file: BinaryIO, start: int, end: int) -> VideoInfo:
+    for chunk_id, data_start, data_end in _iter_riff_chunks(media_file, start, end):
+        if chunk_id != b'LIST' or media_file.read(4) != b'strl':
+            continue
+        stream_header = None
+        width = height = None
+        for child_id, child_start, child_end in _iter_riff_chunks(
+                media_file, data_start + 4, data_end):
+            if child_id == b'strh':
+                stream_header = struct.unpack('<4s4sIHHIIIII', media_file.read(36))
+            elif child_id == b'strf' and stream_header is not None:
+                width, height = struct.unpack('<4xii', media_file.read(12))
+        if stream_header is None or stream_header[0] != b'vids':
+            continue
+
+        scale, rate, length = stream_header[6], stream_header[7], stream_header[9]
+        if scale == 0 or rate == 0:
+            raise UnsupportedHeadersError('Invalid AVI frame rate.')
+        return VideoInfo(
+            fps=_to_fps(rate, scale, 60000),
+            frame_count=length,
+            duration_ms=length * scale * 1000 / rate,
+            width=width,
+            # A negative height indicates a top-down bitmap.
+            height=abs(height) if height is not None else None,
+            rotation=0.0)
+    raise UnsupportedHeadersError('No video stream.')
+
+
+def _iter_riff_chunks(media_file: BinaryIO, start: int,
+                      end: int) -> Iterator[Tuple[bytes, int, int]]:
+    position = start
+    while position + 8 <= end:
+        media_file.seek(position)
+        chunk_id, size = struct.unpack('<4sI', media_file.read(8))
+        data_start = position + 8
+        yield chunk_id, data_start, min(data_start + size, end)
+        # Chunks are padded to an even size.
+        position = data_start + size + (size & 1)
@@ -24,6 +24,7 @@
 # limitations under the License.                                            #
 #############################################################################
 
+import contextlib
 from datetime import datetime
 import os
 import json
@@ -31,7 +32,7 @@ import shlex
 import subprocess
 import time
 import unittest
-from typing import Dict, Any, List, ClassVar
+from typing import Dict, Any, List, ClassVar, Optional, Sequence
 
 
 def get_test_media(file_name: str) -> str:
@@ -61,6 +62,29 @@ class BaseTestCliRunner(unittest.TestCase):
         print('Stopping test container with command: ', shlex.join(command))
         subprocess.run(command, check=True)
 
+    def start_container(self, env_dict: Optional[Dict[str, str]] = None,
+                        setup_script: Optional[str] = None) -> str:
+        """
+        Starts a separate container for tests that need the component server to start with
+        different environment variables or files. The container is stopped when the test ends.
+        :param setup_script: A shell script that runs before the component server starts.
+        """
+        env_params = (f'-e{k}={v}' for k, v in (env_dict or {}).items())
+        if setup_script is None:
+            command = ['docker', 'run', '--rm', '-d', *env_params, self._get_full_image_name(),
+                       '-d']
+        else:
+            command = ['docker', 'run', '--rm', '-d', *env_params, '--entrypoint', 'bash',
+                       self._get_full_image_name(), '-c',
+                       f'{setup_script} && exec /scripts/docker-entrypoint.sh -d']
+        print('Starting test container with command: ', shlex.join(command))
+        proc = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
+        container_id = proc.stdout.strip()
+        self.addCleanup(subprocess.run, ('docker', 'stop', container_id), check=True)
+        time.sleep(1)
+        return container_id
+
+
     @classmethod
     def _get_full_image_name(cls):
         test_registry = os.getenv('TEST_REGISTRY', '')
@@ -95,13 +119,20 @@ class BaseTestCliRunner(unittest.TestCase):
 
 
     @classmethod
-    def run_cli_runner(cls, media_path, *runner_args: str) -> Dict[str, Any]:
-        file_name = os.path.basename(media_path)
-        container_path = os.path.join('/root', file_name)
-        cp_command = ('docker', 'cp', media_path, f'{cls._container_id}:{container_path}')
-        print('Copying media into container with command: ', shlex.join(cp_command))
-        subprocess.run(cp_command, check=True)
+    def run_cli_runner_stdin_media_ndjson(cls, media_path: str,
+                                          *runner_args: str) -> List[Dict[str, Any]]:
+        command = ['docker', 'exec', '-i', cls._container_id, 'runner', *runner_args]
+        print('Running job with command: ', shlex.join(command))
 
+        with open(media_path) as media_file, \
+                subprocess.Popen(command, stdin=media_file, stdout=subprocess.PIPE,
+                                 text=True) as proc:
+            return [json.loads(line) for line in proc.stdout]
+
+
+    @classmethod
+    def run_cli_runner(cls, media_path, *runner_args: str) -> Dict[str, Any]:
+        container_path = cls._copy_to_container(media_path, '/root')
         exec_command = ['docker', 'exec', '-i', cls._container_id, 'runner', container_path,
                         *runner_args]
         print('Running job with command: ', shlex.join(exec_command))
@@ -109,6 +140,63 @@ class BaseTestCliRunner(unittest.TestCase):
             return json.load(proc.stdout)
 
 
+    @classmethod
+    def run_cli_runner_batch(cls, media_paths: List[str], *runner_args: str) -> Dict[str, Any]:
+        container_dir = '/root/batch'
+        mkdir_command = ('docker', 'exec', cls._container_id, 'mkdir', '-p', container_dir)
+        subprocess.run(mkdir_command, check=True)
+        for media_path in media_paths:
+            cls._copy_to_container(media_path, container_dir)
+
+        exec_command = ['docker', 'exec', '-i', cls._container_id, 'runner', container_dir,
+                        *runner_args]
+        print('Running job with command: ', shlex.join(exec_command))
+        with subprocess.Popen(exec_command, stdout=subprocess.PIPE, text=True) as proc:
+            return json.load(proc.stdout)
+
+
+    @classmethod
+    def run_cli_runner_process(cls, *runner_args: str,
+                               env_dict: Optional[Dict[str, str]] = None,
+                               stdin_path: Optional[str] = None,
+                               container_id: Optional[str] = None) -> subprocess.CompletedProcess:
+        """ Runs the runner without checking its exit code or parsing its output. """
+        env_params = (f'-e{k}={v}' for k, v in (env_dict or {}).items())
+        command = ['docker', 'exec', '-i', *env_params, container_id or cls._container_id,
+                   'runner', *runner_args]
+        print('Running job with command: ', shlex.join(command))
+        with contextlib.ExitStack() as exit_stack:
+            if stdin_path is None:
+                stdin = subprocess.DEVNULL
+            else:
+                stdin = exit_stack.enter_context(open(stdin_path, 'rb'))
+            return subprocess.run(command, stdin=stdin, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, text=True)
+
+
+    @classmethod
+    def run_python_in_container(cls, script_lines: Sequence[str],
+                                container_id: Optional[str] = None) -> str:
+        """ Runs a Python script that can import the CLI runner modules and returns its output. """
+        command = ['docker', 'exec', '-e', 'PYTHONPATH=/scripts/cli_runner',
+                   container_id or cls._container_id, 'python3', '-c', '\n'.join(script_lines)]
+        print('Running script with command: ', shlex.join(command))
+        proc = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
+        return proc.stdout
+
+
+    @classmethod
+    def _copy_to_container(cls, media_path: str, container_dir: str,
+                           container_id: Optional[str] = None) -> str:
+        file_name = os.path.basename(media_path)
+        container_path = os.path.join(container_dir, file_name)
+        cp_command = ('docker', 'cp', media_path,
+                      f'{container_id or cls._container_id}:{container_path}')
+        print('Copying media into container with command: ', shlex.join(cp_command))
+        subprocess.run(cp_command, check=True)
+        return container_path
+
+
     def get_image_tracks(
             self,
             expected_mime_type: str,
@@ -402,6 +490,27 @@ class TestCppCliRunnerWithTesseract(BaseTestCliRunner):
                                'UNSTRUCTURED_TEXT_SCALE': '2.6',
                                'UNSTRUCTURED_TEXT_SHARPEN': '1.0'}
 
+    def test_rejects_unsupported_media_type(self):
+        container_path = self._copy_to_container(get_test_media('hello.avi'), '/root')
+        proc = self.run_cli_runner_process(container_path)
+        self.assertEqual(1, proc.returncode)
+        self.assertIn('The component does not support video jobs.', proc.stderr)
+        self.assertEqual('', proc.stdout)
+
+
+    def test_batch_job_rejects_unsupported_media_type(self):
+        container_dir = '/root/unsupported_batch'
+        subprocess.run(('docker', 'exec', self._container_id, 'mkdir', '-p', container_dir),
+                       check=True)
+        self._copy_to_container(get_test_media('test.pdf'), container_dir)
+        self._copy_to_container(get_test_media('hello.avi'), container_dir)
+
+        proc = self.run_cli_runner_process(container_dir)
+        self.assertEqual(1, proc.returncode)
+        self.assertIn(f'{container_dir}/hello.avi: The component does not support video jobs.',
+                      proc.stderr)
+
+
     def test_can_run_generic_job(self):
         output_object = self.run_cli_runner(get_test_media('test.pdf'))
         tracks = self.get_image_tracks(
@@ -518,6 +627,1057 @@ class TestPythonCliRunner(BaseTestCliRunner):
         self.assertAlmostEqual(0.99997675, detection['confidence'], places=2)
 
 
+    def test_can_run_batch_job(self):
+        output_object = self.run_cli_runner_batch(
+            [self._text_image, get_test_media('meds-af-S419-01_40deg.jpg')])
+        self.assertEqual(self._default_job_properties, output_object['jobProperties'])
+
+        media_entries = output_object['media']
+        self.assertEqual(2, len(media_entries))
+        self.assertEqual('/root/batch/hello-world.png', media_entries[0]['path'])
+        self.assertEqual('image/png', media_entries[0]['mimeType'])
+        self.assertEqual('/root/batch/meds-af-S419-01_40deg.jpg', media_entries[1]['path'])
+        self.assertEqual('image/jpeg', media_entries[1]['mimeType'])
+
+        text_tracks = media_entries[0]['output'][self.track_type][0]['tracks']
+        self.assertEqual(2, len(text_tracks))
+        for track in text_tracks:
+            self._assertTrackIsFromImage(track)
+        self.assertAlmostEqual(0.9999814, text_tracks[0]['confidence'])
+        self.assertAlmostEqual(0.9999863, text_tracks[1]['confidence'])
+
+
+    def test_can_run_jobs_in_session(self):
+        expected_output = self.run_cli_runner(self._text_image, '--brief')
+        container_path = self._copy_to_container(self._text_image, '/root')
+        script = '\n'.join((
+            'import json, mpf_cli_client',
+            'with mpf_cli_client.Session() as session:',
+            f'    futures = [session.submit([{container_path!r}, "--brief"]) for _ in range(3)]',
+            '    results = [f.result() for f in futures]',
+            'print(json.dumps([[r.exit_code, json.loads(r.output)] for r in results]))'))
+        command = ['docker', 'exec', '-e', 'PYTHONPATH=/scripts/cli_runner', self._container_id,
+                   'python3', '-c', script]
+        print('Running session with command: ', shlex.join(command))
+        proc = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
+
+        results = json.loads(proc.stdout)
+        self.assertEqual(3, len(results))
+        for exit_code, output in results:
+            self.assertEqual(0, exit_code)
+            self.assertEqual(expected_output, output)
+
+
+    def test_server_stats(self):
+        self.run_cli_runner_stdin_media(self._text_image, '-t', 'image', '-')
+        command = ['docker', 'exec', self._container_id, 'runner', '--server-stats']
+        proc = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
+        stats = json.loads(proc.stdout)
+        self.assertGreaterEqual(stats['jobs_submitted'], 1)
+        self.assertEqual(0, stats['queued_jobs'])
+        self.assertGreaterEqual(stats['executor_processes'], 1)
+
+
+    def test_late_hello_does_not_delay_dispatch(self):
+        # A second copy of the descriptor makes the server route jobs by descriptor.
+        container_id = self.start_container(
+            {'COMPONENT_SERVER_METRICS_ADDRESS': '9100'},
+            'mkdir -p /opt/mpf/plugins/Copy/descriptor '
+            '&& cp /opt/mpf/plugins/*/descriptor/descriptor.json /opt/mpf/plugins/Copy/descriptor')
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+        output = self.run_python_in_container((
+            'import os, socket, subprocess, time, urllib.request',
+            'import mpf_cli_client, mpf_cli_descriptors',
+            'descriptors = mpf_cli_descriptors.find_plugin_descriptors()',
+            'assert len(descriptors) == 2, descriptors',
+            '# Leave two idle executor processes that initialized different components.',
+            f'jobs = [subprocess.Popen(["runner", "--descriptor", d, {image_path!r}],',
+            '                         stdout=subprocess.DEVNULL) for d in descriptors]',
+            'assert all(j.wait() == 0 for j in jobs)',
+            'def get_dispatch_seconds():',
+            '    metrics = urllib.request.urlopen("http://127.0.0.1:9100").read().decode()',
+            '    return float(next(line.split()[1] for line in metrics.splitlines()',
+            '                      if line.startswith("mpf_cli_accept_to_dispatch_seconds_sum")))',
+            'before = get_dispatch_seconds()',
+            '# Connect, but wait before sending HELLO, like a slow client.',
+            'with socket.socket(socket.AF_UNIX) as sock, open(os.devnull, "w") as dev_null:',
+            '    mpf_cli_client.connect_to_server(sock)',
+            '    time.sleep(2)',
+            '    exit_code = mpf_cli_client.submit_job(',
+            '        sock, dev_null.fileno(), dev_null.fileno(), 2,',
+            f'        ["runner", "--descriptor", descriptors[0], {image_path!r}])',
+            'assert exit_code == 0, exit_code',
+            'print(get_dispatch_seconds() - before)'), container_id)
+
+        # The server only waits briefly for the HELLO message, so the job must have been
+        # dispatched long before the client sent it. The bound is loose so that a slow machine
+        # does not cause the test to fail.
+        dispatch_delay = float(output)
+        self.assertLess(dispatch_delay, 1)
+
+
+    def test_warm_pool_is_ready_before_first_job(self):
+        container_id = self.start_container({'COMPONENT_SERVER_MIN_WARM_EXECUTORS': '2'})
+        # The server does not respond to stats requests until the warm pool is ready.
+        stats = self._get_server_stats(container_id)
+        self.assertEqual(0, stats['jobs_submitted'])
+        self.assertEqual(2, stats['executor_processes'])
+        self.assertEqual(2, stats['idle_executor_processes'])
+        self.assertEqual(0, stats['starting_executor_processes'])
+
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+        proc = self.run_cli_runner_process(image_path, container_id=container_id)
+        self.assertEqual(0, proc.returncode)
+        # The component was already initialized by the warm executor process, so the job did not
+        # log that it was initializing the component.
+        self.assertNotIn('Initializing the component', proc.stderr)
+
+        stats = self._get_server_stats(container_id)
+        self.assertEqual(1, stats['jobs_submitted'])
+        self.assertGreaterEqual(stats['idle_executor_processes'], 2)
+
+
+    def test_rejects_job_when_queue_is_full(self):
+        container_id = self.start_container({'COMPONENT_SERVER_MAX_EXECUTORS': '1',
+                                             'COMPONENT_SERVER_MAX_QUEUED_JOBS': '0'})
+        long_video_path = self._create_long_video(container_id)
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+
+        command = ['docker', 'exec', container_id, 'runner', long_video_path, '--brief']
+        print('Running job with command: ', shlex.join(command))
+        with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as long_job:
+            # Give the server time to dispatch the first job to the only executor process.
+            time.sleep(1)
+            rejected_proc = self.run_cli_runner_process(image_path, container_id=container_id)
+            long_job_output = long_job.communicate()[0]
+
+        self.assertEqual(7, rejected_proc.returncode)
+        self.assertEqual('', rejected_proc.stdout)
+        self.assertIn('rejected', rejected_proc.stderr)
+        self.assertEqual(0, long_job.returncode)
+        self.assertGreater(len(json.loads(long_job_output)), 0)
+
+        stats = self._get_server_stats(container_id)
+        self.assertEqual(2, stats['jobs_submitted'])
+        self.assertEqual(1, stats['jobs_rejected'])
+        self.assertEqual(1, stats['max_active_processes'])
+
+
+    def test_server_responds_while_jobs_are_queued(self):
+        container_id = self.start_container({'COMPONENT_SERVER_MAX_EXECUTORS': '1'})
+        long_video_path = self._create_long_video(container_id)
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+
+        long_job_command = ['docker', 'exec', container_id, 'runner', long_video_path, '--brief']
+        queued_job_command = ['docker', 'exec', container_id, 'runner', image_path, '--brief']
+        print('Running jobs with commands: ', shlex.join(long_job_command), ', ',
+              shlex.join(queued_job_command))
+        with subprocess.Popen(long_job_command, stdout=subprocess.PIPE, text=True) as long_job:
+            time.sleep(1)
+            with subprocess.Popen(queued_job_command, stdout=subprocess.PIPE,
+                                  text=True) as queued_job:
+                time.sleep(0.5)
+                # The stats request is handled by the server's event loop, so it does not wait
+                # for the executor process.
+                stats = self._get_server_stats(container_id)
+                queued_job_output = queued_job.communicate()[0]
+            long_job_output = long_job.communicate()[0]
+
+        self.assertEqual(1, stats['queued_jobs'])
+        self.assertEqual(1, stats['running_jobs'])
+        self.assertEqual(0, stats['idle_executor_processes'])
+        self.assertEqual(0, long_job.returncode)
+        self.assertGreater(len(json.loads(long_job_output)), 0)
+        self.assertEqual(0, queued_job.returncode)
+        self.assertGreater(len(json.loads(queued_job_output)), 0)
+
+
+    def test_sequential_jobs_reuse_idle_executor_process(self):
+        container_id = self.start_container()
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+        for _ in range(3):
+            proc = self.run_cli_runner_process(image_path, container_id=container_id)
+            self.assertEqual(0, proc.returncode)
+
+        stats = self._get_server_stats(container_id)
+        self.assertEqual(3, stats['jobs_submitted'])
+        self.assertEqual(1, stats['processes_started'])
+        self.assertEqual(1, stats['idle_executor_processes'])
+        self.assertEqual(0, stats['running_jobs'])
+
+
+    def test_invalid_session_start_gets_error_message(self):
+        output = self.run_python_in_container((
+            'import json, socket, mpf_cli_client, mpf_cli_protocol as protocol',
+            'results = []',
+            'for frame in (None, b"not a protocol frame"):',
+            '    with socket.socket(socket.AF_UNIX) as sock:',
+            '        mpf_cli_client.connect_to_server(sock)',
+            '        if frame is None:',
+            '            protocol.send_message(sock, protocol.MessageType.HELLO,',
+            '                                  {"versions": [999], "capabilities": []})',
+            '        else:',
+            '            sock.sendall(frame)',
+            '        message = protocol.recv_message(sock)',
+            '        results.append([message.type.name, message.payload.get("message")])',
+            'print(json.dumps(results))'))
+        (version_type, version_error), (frame_type, frame_error) = json.loads(output)
+        self.assertEqual('ERROR', version_type)
+        self.assertIn('protocol versions [999]', version_error)
+        self.assertEqual('ERROR', frame_type)
+        self.assertIn('not part of the protocol', frame_error)
+
+        # The executor process must still be usable after the failed sessions.
+        expected_output = self.run_cli_runner(self._text_image, '--brief')
+        self.assertGreater(len(expected_output), 0)
+
+
+    def test_failed_job_exits_with_error_code(self):
+        proc = self.run_cli_runner_process('/root/does-not-exist.png')
+        self.assertEqual(1, proc.returncode)
+        self.assertEqual('', proc.stdout)
+        self.assertIn('does not exist', proc.stderr)
+
+
+    def test_can_pipeline_job_requests(self):
+        expected_output = self.run_cli_runner(self._text_image, '--brief')
+        image_path = f'/root/{os.path.basename(self._text_image)}'
+        # The failed job in the middle must not prevent the last job from running.
+        output = self.run_python_in_container((
+            'import json, os, socket, tempfile, mpf_cli_client',
+            f'paths = [{image_path!r}, "/root/does-not-exist.png", {image_path!r}]',
+            'with socket.socket(socket.AF_UNIX) as sock, open(os.devnull, "w") as dev_null:',
+            '    mpf_cli_client.connect_to_server(sock)',
+            '    output_files = [tempfile.TemporaryFile("w+") for _ in paths]',
+            '    statuses = mpf_cli_client.submit_jobs(sock, [',
+            '        mpf_cli_client.JobSubmission(["runner", p, "--brief"], dev_null.fileno(),',
+            '                                     f.fileno(), dev_null.fileno())',
+            '        for p, f in zip(paths, output_files)])',
+            'outputs = []',
+            'for output_file in output_files:',
+            '    output_file.seek(0)',
+            '    outputs.append(output_file.read())',
+            'print(json.dumps([[s.get("job_id"), s["exit_code"], o]',
+            '                  for s, o in zip(statuses, outputs)]))'))
+
+        results = json.loads(output)
+        self.assertEqual([0, 1, 2], [job_id for job_id, _, _ in results])
+        self.assertEqual([0, 1, 0], [exit_code for _, exit_code, _ in results])
+        self.assertEqual(expected_output, json.loads(results[0][2]))
+        self.assertEqual('', results[1][2])
+        self.assertEqual(expected_output, json.loads(results[2][2]))
+
+
+    def test_executor_processes_are_forked_from_template(self):
+        container_id = self.start_container({'COMPONENT_SERVER_EXECUTOR_TEMPLATE': 'true',
+                                             'COMPONENT_SERVER_METRICS_ADDRESS': '9100'})
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+        proc = self.run_cli_runner_process(image_path, container_id=container_id)
+        self.assertEqual(0, proc.returncode)
+        # The executor process was forked after the template initialized the component.
+        self.assertNotIn('Initializing the component', proc.stderr)
+
+        pids = self._get_server_process_ids(container_id)
+        self.assertEqual(1, len(pids['template']))
+        self.assertEqual(1, len(pids['executor_parents']))
+        self.assertEqual(pids['template'], pids['executor_parents'])
+
+
+    def test_executor_template_falls_back_when_initialization_fails(self):
+        # The template can not choose which component to initialize when there are two
+        # descriptors, so executor processes need to initialize the component themselves.
+        container_id = self.start_container(
+            {'COMPONENT_SERVER_EXECUTOR_TEMPLATE': 'true',
+             'COMPONENT_SERVER_METRICS_ADDRESS': '9100'},
+            'mkdir -p /opt/mpf/plugins/Copy/descriptor '
+            '&& cp /opt/mpf/plugins/*/descriptor/descriptor.json /opt/mpf/plugins/Copy/descriptor')
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+        proc = self.run_cli_runner_process(
+            '--descriptor', '/opt/mpf/plugins/Copy/descriptor/descriptor.json', image_path,
+            '--brief', container_id=container_id)
+        self.assertEqual(0, proc.returncode)
+        self.assertGreater(len(json.loads(proc.stdout)), 0)
+
+        pids = self._get_server_process_ids(container_id)
+        self.assertNotIn('template', pids)
+        self.assertEqual(pids['server'], pids['executor_parents'])
+
+        logs_proc = subprocess.run(('docker', 'logs', container_id), stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True, check=True)
+        self.assertIn('Failed to initialize the component in the executor template process',
+                      logs_proc.stdout)
+
+
+    def test_components_in_same_executor_have_separate_environments(self):
+        # The two copies of the descriptor set the same environment variables to different
+        # values.
+        container_id = self.start_container(
+            {'COMPONENT_SERVER_MAX_EXECUTORS': '1'},
+            self._get_descriptor_copies_script({
+                name: [{'name': 'MPF_PROP_CONFLICTING_PROP', 'value': name},
+                       {'name': 'LD_LIBRARY_PATH', 'value': f'/opt/{name}', 'sep': ':'}]
+                for name in ('A', 'B')}))
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+
+        # With one executor process, both components are initialized in the same process.
+        for name in ('A', 'B', 'A'):
+            proc = self.run_cli_runner_process(
+                '--descriptor', f'/opt/mpf/plugins/{name}/descriptor/descriptor.json',
+                image_path, container_id=container_id)
+            self.assertEqual(0, proc.returncode)
+            self.assertEqual(name, json.loads(proc.stdout)['jobProperties']['CONFLICTING_PROP'])
+        self.assertEqual(1, self._get_server_stats(container_id)['processes_started'])
+
+        output = self.run_python_in_container((
+            'import json, os, mpf_cli_descriptors',
+            'original_ld_path = os.getenv("LD_LIBRARY_PATH")',
+            'results = []',
+            'for name in ("A", "B", "A"):',
+            '    descriptor = mpf_cli_descriptors.get_descriptor(',
+            '        f"/opt/mpf/plugins/{name}/descriptor/descriptor.json")',
+            '    descriptor.set_env_vars()',
+            '    results.append([os.environ["MPF_PROP_CONFLICTING_PROP"],',
+            '                    os.environ["LD_LIBRARY_PATH"],',
+            '                    descriptor.env["LD_LIBRARY_PATH"]])',
+            'print(json.dumps([original_ld_path, results]))'), container_id)
+        original_ld_path, results = json.loads(output)
+        for name, (prop_value, ld_path, descriptor_ld_path) in zip(('A', 'B', 'A'), results):
+            self.assertEqual(name, prop_value)
+            expected_ld_path = f'{original_ld_path}:/opt/{name}' if original_ld_path \
+                else f'/opt/{name}'
+            # The other component's directory must not be appended.
+            self.assertEqual(expected_ld_path, ld_path)
+            self.assertEqual(expected_ld_path, descriptor_ld_path)
+
+
+    def test_concurrent_jobs_are_limited_per_component(self):
+        # Only the "Concurrent" copy of the descriptor allows concurrent jobs.
+        container_id = self.start_container(
+            {'COMPONENT_SERVER_MAX_EXECUTORS': '1'},
+            self._get_descriptor_copies_script({
+                'Concurrent': [{'name': 'COMPONENT_MAX_CONCURRENT_JOBS', 'value': '2'}],
+                'Serial': []}))
+        long_video_path = self._create_long_video(container_id)
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+        concurrent_args = ('--descriptor', '/opt/mpf/plugins/Concurrent/descriptor/descriptor.json')
+        serial_args = ('--descriptor', '/opt/mpf/plugins/Serial/descriptor/descriptor.json')
+
+        # The limit takes effect once the job that initialized the component completes.
+        for descriptor_args in (concurrent_args, serial_args):
+            proc = self.run_cli_runner_process(*descriptor_args, image_path, '--brief',
+                                               container_id=container_id)
+            self.assertEqual(0, proc.returncode)
+
+        explicit_type_job, guessed_type_job = self._run_jobs_at_same_time(
+            container_id,
+            (*concurrent_args, long_video_path, '-t', 'video', '--brief'),
+            (*concurrent_args, long_video_path, '--brief'))
+        self.assertEqual(0, explicit_type_job.returncode)
+        self.assertEqual(0, guessed_type_job.returncode)
+        self.assertEqual(json.loads(explicit_type_job.stdout), json.loads(guessed_type_job.stdout))
+        # With only one executor process, the jobs could only avoid the queue by running at the
+        # same time in that process.
+        stats = self._get_server_stats(container_id)
+        self.assertEqual(0, stats['max_queued_jobs'])
+        self.assertEqual(1, stats['processes_started'])
+        # Each client only receives its own job's log messages.
+        self.assertIn('Guessed that this is a video job', guessed_type_job.stderr)
+        self.assertNotIn('Guessed that this is a video job', explicit_type_job.stderr)
+
+        for job_args_list in ((serial_args, serial_args), (concurrent_args, serial_args)):
+            jobs = self._run_jobs_at_same_time(
+                container_id,
+                *((*descriptor_args, long_video_path, '--brief')
+                  for descriptor_args in job_args_list))
+            self.assertEqual([0, 0], [j.returncode for j in jobs])
+        # A job for the component without the variable never runs at the same time as another
+        # job, even a job for a component that has the variable.
+        logs_proc = subprocess.run(('docker', 'logs', container_id), stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True, check=True)
+        self.assertEqual(2, logs_proc.stdout.count('Job queued because'))
+        self.assertIn('jobs at the same time for the component described by '
+                      '/opt/mpf/plugins/Concurrent/', logs_proc.stdout)
+        self.assertNotIn('jobs at the same time for the component described by '
+                         '/opt/mpf/plugins/Serial/', logs_proc.stdout)
+
+
+    def test_failed_stdin_video_job_releases_stdin(self):
+        # The component can not be initialized using this copy of the descriptor, so the job
+        # fails while the video is still being copied from standard in.
+        setup_script = '\n'.join((
+            'import json, pathlib',
+            'src = next(pathlib.Path("/opt/mpf/plugins").glob("*/descriptor/descriptor.json"))',
+            'descriptor = json.loads(src.read_text())',
+            'descriptor["batchLibrary"] = "does_not_exist"',
+            'path = pathlib.Path("/opt/mpf/plugins/Broken/descriptor/descriptor.json")',
+            'path.parent.mkdir(parents=True)',
+            'path.write_text(json.dumps(descriptor))'))
+        container_id = self.start_container(setup_script=f'python3 -c {shlex.quote(setup_script)}')
+
+        # /dev/zero never ends, so the pipeline only completes when the executor process stops
+        # reading the job's standard in and closes it. Otherwise, timeout exits with 124.
+        command = ['docker', 'exec', container_id, 'timeout', '30', 'bash', '-c',
+                   'cat /dev/zero | runner --descriptor '
+                   '/opt/mpf/plugins/Broken/descriptor/descriptor.json -t video -']
+        print('Running job with command: ', shlex.join(command))
+        proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        self.assertEqual(1, proc.returncode)
+        self.assertIn('does_not_exist', proc.stderr)
+
+        logs_proc = subprocess.run(('docker', 'logs', container_id), stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True, check=True)
+        self.assertIn('Stopped copying standard in because the job ended.', logs_proc.stdout)
+
+
+    def test_descriptor_registry_notices_changed_plugins(self):
+        output = self.run_python_in_container((
+            'import json, pathlib, shutil, tempfile, mpf_cli_descriptors',
+            'src = next(pathlib.Path("/opt/mpf/plugins").glob("*/descriptor/descriptor.json"))',
+            'plugins_dir = pathlib.Path(tempfile.mkdtemp(), "plugins")',
+            'registry = mpf_cli_descriptors.DescriptorRegistry(',
+            '    f"{plugins_dir}/*/descriptor/descriptor.json")',
+            'def add_descriptor(name):',
+            '    path = plugins_dir / name / "descriptor" / "descriptor.json"',
+            '    path.parent.mkdir(parents=True, exist_ok=True)',
+            '    shutil.copy(src, path)',
+            'def find_names():',
+            '    return [pathlib.Path(p).parts[-3] for p in registry.find_plugin_descriptors()]',
+            'results = {"missing_plugins_dir": find_names()}',
+            'plugins_dir.mkdir()',
+            'results["empty_plugins_dir"] = find_names()',
+            'add_descriptor("A")',
+            'results["new_plugin_dir"] = find_names()',
+            '(plugins_dir / "B" / "descriptor").mkdir(parents=True)',
+            'results["empty_descriptor_dir"] = find_names()',
+            'add_descriptor("B")',
+            'results["new_descriptor_file"] = find_names()',
+            '(plugins_dir / "C").mkdir()',
+            'results["empty_plugin_dir"] = find_names()',
+            'add_descriptor("C")',
+            'results["new_descriptor_dir"] = find_names()',
+            '(plugins_dir / "A" / "descriptor" / "descriptor.json").unlink()',
+            'results["removed_descriptor_file"] = find_names()',
+            'shutil.rmtree(plugins_dir / "B")',
+            'results["removed_plugin_dir"] = find_names()',
+            'print(json.dumps(results))'))
+        results = json.loads(output)
+        self.assertEqual([], results['missing_plugins_dir'])
+        self.assertEqual([], results['empty_plugins_dir'])
+        self.assertEqual(['A'], results['new_plugin_dir'])
+        self.assertEqual(['A'], results['empty_descriptor_dir'])
+        self.assertEqual(['A', 'B'], results['new_descriptor_file'])
+        self.assertEqual(['A', 'B'], results['empty_plugin_dir'])
+        self.assertEqual(['A', 'B', 'C'], results['new_descriptor_dir'])
+        self.assertEqual(['B', 'C'], results['removed_descriptor_file'])
+        self.assertEqual(['C'], results['removed_plugin_dir'])
+
+
+    def test_descriptor_registry_reparses_edited_descriptor(self):
+        output = self.run_python_in_container((
+            'import json, pathlib, shutil, tempfile, mpf_cli_descriptors',
+            'src = next(pathlib.Path("/opt/mpf/plugins").glob("*/descriptor/descriptor.json"))',
+            'path = pathlib.Path(tempfile.mkdtemp(), "descriptor.json")',
+            'shutil.copy(src, path)',
+            'registry = mpf_cli_descriptors.DescriptorRegistry(',
+            '    "/does_not_exist/*/descriptor/descriptor.json")',
+            'original = registry.get(str(path))',
+            'unchanged = registry.get(str(path))',
+            'descriptor_json = json.loads(path.read_text())',
+            'descriptor_json["algorithm"]["providesCollection"]["properties"].append(',
+            '    {"name": "EDITED_PROP", "defaultValue": "edited"})',
+            '# Writing to the existing file keeps the same inode.',
+            'with path.open("w") as f:',
+            '    json.dump(descriptor_json, f)',
+            'edited = registry.get(str(path))',
+            'print(json.dumps({',
+            '    "unchanged_is_same": unchanged is original,',
+            '    "original_key": original.key, "edited_key": edited.key,',
+            '    "edited_default": edited.property_defaults.get("EDITED_PROP")}))'))
+        results = json.loads(output)
+        self.assertTrue(results['unchanged_is_same'])
+        original_path, original_digest = results['original_key']
+        edited_path, edited_digest = results['edited_key']
+        self.assertEqual(original_path, edited_path)
+        self.assertNotEqual(original_digest, edited_digest)
+        self.assertEqual('edited', results['edited_default'])
+
+
+    def test_editing_descriptor_initializes_new_component(self):
+        container_id = self.start_container(
+            {'COMPONENT_SERVER_MAX_EXECUTORS': '1'},
+            self._get_descriptor_copies_script({'Edited': []}))
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+        descriptor_path = '/opt/mpf/plugins/Edited/descriptor/descriptor.json'
+
+        def run_job():
+            proc = self.run_cli_runner_process('--descriptor', descriptor_path, image_path,
+                                               container_id=container_id)
+            self.assertEqual(0, proc.returncode)
+            return json.loads(proc.stdout)['jobProperties'], proc.stderr
+
+        job_props, stderr = run_job()
+        self.assertNotIn('EDITED_PROP', job_props)
+        self.assertIn('Initializing the component', stderr)
+
+        _, stderr = run_job()
+        self.assertNotIn('Initializing the component', stderr)
+
+        self.run_python_in_container((
+            'import json, pathlib',
+            f'path = pathlib.Path("{descriptor_path}")',
+            'descriptor_json = json.loads(path.read_text())',
+            'descriptor_json["algorithm"]["providesCollection"]["properties"].append(',
+            '    {"name": "EDITED_PROP", "defaultValue": "edited"})',
+            'with path.open("w") as f:',
+            '    json.dump(descriptor_json, f)'), container_id)
+
+        job_props, stderr = run_job()
+        self.assertEqual('edited', job_props['EDITED_PROP'])
+        self.assertIn('Initializing the component', stderr)
+        self.assertEqual(1, self._get_server_stats(container_id)['processes_started'])
+
+
+    def test_job_property_layers_have_expected_precedence(self):
+        # Every layer sets all of the properties that the layers below it set.
+        layer_names = ('DESCRIPTOR', 'COMPONENT_ENV', 'CLIENT_ENV', 'COMMAND_LINE')
+        setup_script = '\n'.join((
+            'import json, pathlib',
+            'src = next(pathlib.Path("/opt/mpf/plugins").glob("*/descriptor/descriptor.json"))',
+            'descriptor = json.loads(src.read_text())',
+            f'layer_names = {layer_names!r}',
+            'descriptor["algorithm"]["providesCollection"]["properties"].extend(',
+            '    {"name": f"{name}_PROP", "defaultValue": "descriptor"} for name in layer_names)',
+            'descriptor.setdefault("environmentVariables", []).extend(',
+            '    {"name": f"MPF_PROP_{name}_PROP", "value": "component_env"}',
+            '    for name in layer_names[1:])',
+            'path = pathlib.Path("/opt/mpf/plugins/Layered/descriptor/descriptor.json")',
+            'path.parent.mkdir(parents=True)',
+            'path.write_text(json.dumps(descriptor))'))
+        container_id = self.start_container(setup_script=f'python3 -c {shlex.quote(setup_script)}')
+        image_path = self._copy_to_container(self._text_image, '/root', container_id)
+
+        proc = self.run_cli_runner_process(
+            '--descriptor', '/opt/mpf/plugins/Layered/descriptor/descriptor.json', image_path,
+            *(arg for name in layer_names for arg in ('-M', f'{name}_PROP=media')),
+            '-P', 'COMMAND_LINE_PROP=command_line',
+            env_dict={'MPF_PROP_CLIENT_ENV_PROP': 'client_env',
+                      'MPF_PROP_COMMAND_LINE_PROP': 'client_env'},
+            container_id=container_id)
+        self.assertEqual(0, proc.returncode)
+        output_object = json.loads(proc.stdout)
+
+        job_props = output_object['jobProperties']
+        self.assertEqual('descriptor', job_props['DESCRIPTOR_PROP'])
+        self.assertEqual('component_env', job_props['COMPONENT_ENV_PROP'])
+        self.assertEqual('client_env', job_props['CLIENT_ENV_PROP'])
+        self.assertEqual('command_line', job_props['COMMAND_LINE_PROP'])
+        self.assertEqual(sorted(job_props, key=lambda k: (k.upper(), k)), list(job_props))
+        # Media metadata is kept separate from the job properties.
+        media_metadata = output_object['media'][0]['mediaMetadata']
+        for name in layer_names:
+            self.assertEqual('media', media_metadata[f'{name}_PROP'])
+
+
+    def test_job_property_defaults_match_sorted_setdefault(self):
+        # Compares JobPropertyDefaults with applying each layer using setdefault, starting from
+        # the highest precedence layer, and then sorting the result.
+        output = self.run_python_in_container((
+            'import json, itertools, mpf_cli_job_runner as job_runner',
+            'names = ["a", "A", "A_B", "AB", "b", "B", "_C"]',
+            'failures = []',
+            'for layer_sizes in itertools.product(range(len(names) + 1), repeat=4):',
+            '    defaults, component_env, client_env, command_line = (',
+            '        {n: f"{layer}_{n}" for n in names[:size]}',
+            '        for layer, size in enumerate(layer_sizes))',
+            '    env = {f"MPF_PROP_{n}": v for n, v in component_env.items()}',
+            '    env["NOT_A_PROP"] = "x"',
+            '    expected = dict(command_line)',
+            '    for layer in (client_env, component_env, defaults):',
+            '        for pair in layer.items():',
+            '            expected.setdefault(*pair)',
+            '    expected = job_runner.sort_property_dict(expected)',
+            '    actual = job_runner.JobPropertyDefaults(env, defaults).overlay(',
+            '        {**client_env, **command_line})',
+            '    if list(actual.items()) != list(expected.items()):',
+            '        failures.append([layer_sizes, actual, expected])',
+            'print(json.dumps(failures[:5]))'))
+        self.assertEqual([], json.loads(output))
+
+
+    @staticmethod
+    def _run_jobs_at_same_time(container_id: str,
+                               *runner_args_list: Sequence[str]
+                               ) -> List[subprocess.CompletedProcess]:
+        commands = [['docker', 'exec', container_id, 'runner', *runner_args]
+                    for runner_args in runner_args_list]
+        print('Running jobs with commands: ', ', '.join(map(shlex.join, commands)))
+        procs = [subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  text=True)
+                 for command in commands]
+        results = []
+        for proc in procs:
+            stdout, stderr = proc.communicate()
+            results.append(subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr))
+        return results
+
+
+    @staticmethod
+    def _get_descriptor_copies_script(
+            env_vars_by_name: Dict[str, List[Dict[str, str]]]) -> str:
+        """
+        Creates a container setup script that adds copies of the image's descriptor to
+        /opt/mpf/plugins/<name>, with the given entries added to each copy's
+        "environmentVariables".
+        """
+        script = '\n'.join((
+            'import json, pathlib',
+            'src = next(pathlib.Path("/opt/mpf/plugins").glob("*/descriptor/descriptor.json"))',
+            'descriptor = json.loads(src.read_text())',
+            'env_vars = descriptor.get("environmentVariables", [])',
+            f'for name, extra_env_vars in {env_vars_by_name!r}.items():',
+            '    descriptor["environmentVariables"] = [*env_vars, *extra_env_vars]',
+            '    path = pathlib.Path(f"/opt/mpf/plugins/{name}/descriptor/descriptor.json")',
+            '    path.parent.mkdir(parents=True)',
+            '    path.write_text(json.dumps(descriptor))'))
+        return f'python3 -c {shlex.quote(script)}'
+
+
+    def _get_server_process_ids(self, container_id: str) -> Dict[str, List[int]]:
+        """
+        Uses the resident memory metrics to get the pids of the server, executor template, and
+        the parent of each executor process.
+        """
+        output = self.run_python_in_container((
+            'import json, re, urllib.request',
+            'metrics = urllib.request.urlopen("http://127.0.0.1:9100").read().decode()',
+            'pids = {}',
+            'for role, pid in re.findall(',
+            '        r\'mpf_cli_resident_memory_bytes\\{role="(\\w+)",pid="(\\d+)"\\}\', metrics):',
+            '    pids.setdefault(role, []).append(int(pid))',
+            'def get_parent_pid(pid):',
+            '    with open(f"/proc/{pid}/stat") as stat_file:',
+            '        # The command name is in parentheses and can contain spaces.',
+            '        return int(stat_file.read().rsplit(")", 1)[1].split()[1])',
+            'pids["executor_parents"] = [get_parent_pid(pid) for pid in pids.pop("executor")]',
+            'print(json.dumps(pids))'), container_id)
+        return json.loads(output)
+
+
+    def _get_server_stats(self, container_id: Optional[str] = None) -> Dict[str, Any]:
+        proc = self.run_cli_runner_process('--server-stats', container_id=container_id)
+        self.assertEqual(0, proc.returncode)
+        return json.loads(proc.stdout)
+
+
+    def test_fast_client_only_imports_built_in_modules(self):
+        baseline_imports = self._get_import_times('pass')
+        client_imports = self._get_import_times('import mpf_cli_fast_client')
+        added_modules = client_imports.keys() - baseline_imports.keys()
+        self.assertLessEqual(added_modules, {'mpf_cli_fast_client', '_json', '_socket'})
+        # Cumulative time in microseconds.
+        self.assertLess(client_imports['mpf_cli_fast_client'], 10_000)
+
+
+    def _get_import_times(self, code: str) -> Dict[str, int]:
+        command = ['docker', 'exec', '-w', '/scripts/cli_runner', self._container_id,
+                   'python3', '-X', 'importtime', '-c', code]
+        proc = subprocess.run(command, stderr=subprocess.PIPE, text=True, check=True)
+        import_times = {}
+        for line in proc.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, module_name = line.split('|')
+                if cumulative.strip().isdigit():
+                    import_times[module_name.strip()] = int(cumulative)
+        return import_times
+
+
+    def test_fast_client_constants_match_protocol(self):
+        script = '\n'.join((
+            'import mpf_cli_fast_client as fast, mpf_cli_protocol as p, mpf_cli_runner_util as u',
+            'assert fast._SOCKET_ADDRESS == u.SOCKET_ADDRESS',
+            'assert fast._SERVER_BUSY_EXIT_CODE == u.SERVER_BUSY_EXIT_CODE',
+            'assert fast._PROTOCOL_VERSION == p.PROTOCOL_VERSION',
+            'assert fast._MAX_PAYLOAD_SIZE == p.MAX_PAYLOAD_SIZE',
+            'assert fast._HEADER_SIZE == p._HEADER.size',
+            'assert p.json.loads(fast._HELLO_PAYLOAD) == p.create_hello()',
+            'assert p.json.loads(fast.create_hello_payload("/a/\\"b"))'
+            ' == p.create_hello("/a/\\"b")',
+            'assert fast._MESSAGE_TYPE_NAMES == tuple(t.name for t in p.MessageType)',
+            'assert (fast._HELLO, fast._HELLO_ACK, fast._JOB_REQUEST, fast._JOB_STATUS, fast._END,'
+            ' fast._REJECTED) == tuple(p.MessageType)[:6]',
+            'assert fast._PROGRESS == p.MessageType.PROGRESS'))
+        command = ['docker', 'exec', '-w', '/scripts/cli_runner', self._container_id,
+                   'python3', '-c', script]
+        subprocess.run(command, check=True)
+
+
+    def test_fast_client_finds_options_like_argparse(self):
+        script = '\n'.join((
+            'import mpf_cli_fast_client as fast, mpf_cli_executor_process as e',
+            'actions = [a for a in e.ArgumentParser()._actions if a.option_strings]',
+            'options = {next(o for o in a.option_strings if o.startswith("--")): a'
+            ' for a in actions}',
+            'assert set(fast._OPTIONS_WITH_VALUES)'
+            ' == {o for o, a in options.items() if a.nargs != 0}',
+            'assert set(fast._FLAG_OPTIONS) == {o for o, a in options.items() if a.nargs == 0}',
+            'assert fast._SHORT_OPTIONS'
+            ' == {s: o for o, a in options.items() for s in a.option_strings if s != o}',
+            'assert fast.is_parallel_job(["runner", "-j", "2", "media"])',
+            'assert fast.is_parallel_job(["runner", "-pj2", "media"])',
+            'assert fast.is_parallel_job(["runner", "--par=2", "media"])',
+            'assert not fast.is_parallel_job(["runner", "-P", "A=-j2", "media"])',
+            'assert not fast.is_parallel_job(["runner", "-o", "-j.json", "media"])',
+            'assert not fast.is_parallel_job(["runner", "--", "-j2.png"])'))
+        command = ['docker', 'exec', '-w', '/scripts/cli_runner', self._container_id,
+                   'python3', '-c', script]
+        subprocess.run(command, check=True)
+
+
+    def test_parallel_batch_job_matches_normal_batch_job(self):
+        media_paths = [self._text_image, get_test_media('meds-af-S419-01_40deg.jpg')]
+        expected_output = self.run_cli_runner_batch(media_paths, '-P', 'ROTATION=15', '--profile')
+        self.assertIn('timing', expected_output)
+
+        parallel_output = self.run_cli_runner_batch(
+            media_paths, '-P', 'ROTATION=15', '--profile', '-j', '2')
+        for output in (expected_output, parallel_output):
+            del output['timeStart']
+            del output['timeStop']
+            output.pop('timing', None)
+        self.assertEqual(expected_output, parallel_output)
+
+
+    def test_profile_adds_timing(self):
+        output_object = self.run_cli_runner(self._text_image, '--profile')
+        timing = output_object['timing']
+        for phase in ('parse', 'media_resolution', 'component', 'conversion', 'sort'):
+            self.assertGreaterEqual(timing[f'{phase}_ms'], 0)
+
+
+    def test_ndjson_sorted_output_matches_json_output(self):
+        video_file = get_test_media('hello.avi')
+        output_object = self.run_cli_runner_stdin_media(video_file, '-', '-t', 'video')
+        expected_tracks = self.get_video_tracks(
+            'video/octet-stream', self._default_job_properties, {'FPS': '1.0'}, output_object)
+
+        ndjson_lines = self.run_cli_runner_stdin_media_ndjson(
+            video_file, '-', '-t', 'video', '--output-format', 'ndjson-sorted')
+        self.assertEqual(len(expected_tracks), len(ndjson_lines))
+        for expected_track, line in zip(expected_tracks, ndjson_lines):
+            self.assertTrue(line['path'].startswith('/tmp/'))
+            self.assertEqual(expected_track, line['track'])
+
+        brief_lines = self.run_cli_runner_stdin_media_ndjson(
+            video_file, '-', '-t', 'video', '--output-format', 'ndjson', '--brief')
+        self.assertCountEqual(expected_tracks, brief_lines)
+
+
+    def test_json_encoders_match_json_module(self):
+        # Covers orjson when it is installed in the image, and the json module otherwise.
+        script = '\n'.join((
+            'import io, json, math, mpf_cli_output_encoders as e',
+            'doc = {"a": [0.5, float("nan")], "b": {"c": float("-inf")}, "d": None, "e": "\u00e9"}',
+            'assert e.dumps_json(doc)'
+            ' == json.dumps(doc, ensure_ascii=False, separators=(",", ":"))',
+            'assert e.dumps_json({"x": [1, "null"]}) == \'{"x":[1,"null"]}\'',
+            'loaded = e.loads_json(e.dumps_json(doc))',
+            'assert math.isnan(loaded["a"][1]) and loaded["b"]["c"] == -math.inf',
+            'output = io.StringIO()',
+            'e.write_document(doc, "json", False, output)',
+            'assert output.getvalue() == json.dumps(doc, ensure_ascii=False)'))
+        command = ['docker', 'exec', '-w', '/scripts/cli_runner', self._container_id,
+                   'python3', '-c', script]
+        subprocess.run(command, check=True)
+
+
+    def test_binary_output_formats_match_json_output(self):
+        expected_output = self.run_cli_runner(self._text_image)
+        container_path = f'/root/{os.path.basename(self._text_image)}'
+        for output_format, package in (('msgpack', 'msgpack'), ('cbor', 'cbor2')):
+            with self.subTest(output_format=output_format):
+                command = ['docker', 'exec', self._container_id, 'runner', container_path,
+                           '--output-format', output_format]
+                print('Running job with command: ', shlex.join(command))
+                proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+                if not self._container_has_package(package):
+                    self.assertEqual(1, proc.returncode)
+                    self.assertEqual(b'', proc.stdout)
+                    self.assertIn(f'requires the "{package}" Python package',
+                                  proc.stderr.decode())
+                    continue
+
+                self.assertEqual(0, proc.returncode)
+                decode_command = [
+                    'docker', 'exec', '-i', self._container_id, 'python3', '-c',
+                    f'import json, sys, {package}; '
+                    f'json.dump({package}.loads(sys.stdin.buffer.read()), sys.stdout)']
+                decode_proc = subprocess.run(decode_command, input=proc.stdout,
+                                             stdout=subprocess.PIPE, check=True)
+                decoded_output = json.loads(decode_proc.stdout)
+                for output in (expected_output, decoded_output):
+                    output.pop('timeStart', None)
+                    output.pop('timeStop', None)
+                self.assertEqual(expected_output, decoded_output)
+
+
+    def _container_has_package(self, package: str) -> bool:
+        command = ['docker', 'exec', self._container_id, 'python3', '-c', f'import {package}']
+        return subprocess.run(command, stderr=subprocess.DEVNULL).returncode == 0
+
+
+    def test_progress_heartbeat_is_logged(self):
+        container_id = self.start_container({'CLI_RUNNER_PROGRESS_INTERVAL': '1'})
+        # The job needs to run for longer than the interval.
+        long_video_path = self._create_long_video(container_id)
+
+        proc = self.run_cli_runner_process(long_video_path, '--brief', container_id=container_id)
+        self.assertEqual(0, proc.returncode)
+        self.assertGreater(len(json.loads(proc.stdout)), 0)
+        self.assertIn('Still running after', proc.stderr)
+
+
+    def test_progress_is_only_sent_to_clients_that_support_it(self):
+        # The job needs to run for longer than the progress update interval.
+        long_video_path = self._create_long_video(self._container_id)
+        output = self.run_python_in_container((
+            'import json, os, socket, mpf_cli_client, mpf_cli_protocol as protocol',
+            'results = []',
+            'for capabilities in (protocol.CAPABILITIES,',
+            '                     [c for c in protocol.CAPABILITIES',
+            '                      if c != protocol.PROGRESS_CAPABILITY]):',
+            '    messages = []',
+            '    with socket.socket(socket.AF_UNIX) as sock, open(os.devnull, "r+") as dev_null:',
+            '        mpf_cli_client.connect_to_server(sock)',
+            '        protocol.send_message(sock, protocol.MessageType.HELLO, {',
+            '            "versions": list(protocol.SUPPORTED_VERSIONS),',
+            '            "capabilities": list(capabilities)})',
+            '        protocol.send_message(sock, protocol.MessageType.JOB_REQUEST, {',
+            '            "job_id": 0, "cwd": "/", "env_props": {},',
+            f'            "argv": ["runner", {long_video_path!r}, "--brief",',
+            '                     "--progress", "json"]},',
+            '            (dev_null.fileno(),) * 3)',
+            '        protocol.send_message(sock, protocol.MessageType.END)',
+            '        while True:',
+            '            message = protocol.recv_message(sock)',
+            '            if message is None:',
+            '                break',
+            '            protocol.close_fds(message.fds)',
+            '            messages.append([message.type.name, message.payload])',
+            '            if message.type == protocol.MessageType.JOB_STATUS:',
+            '                break',
+            '    results.append(messages)',
+            'print(json.dumps(results))'))
+        with_progress, without_progress = json.loads(output)
+
+        message_types = [message_type for message_type, _ in with_progress]
+        self.assertEqual('HELLO_ACK', message_types[0])
+        self.assertIn('progress', with_progress[0][1]['capabilities'])
+        self.assertEqual('JOB_STATUS', message_types[-1])
+        self.assertEqual(0, with_progress[-1][1]['exit_code'])
+        progress_payloads = [payload for message_type, payload in with_progress
+                             if message_type == 'PROGRESS']
+        self.assertGreater(len(progress_payloads), 0)
+        # Every PROGRESS message arrives before the job's JOB_STATUS message.
+        self.assertEqual(['HELLO_ACK', *['PROGRESS'] * len(progress_payloads), 'JOB_STATUS'],
+                         message_types)
+        for payload in progress_payloads:
+            self.assertEqual(0, payload['job_id'])
+            self.assertIn('elapsed_ms', payload)
+            self.assertIn('tracks', payload)
+            # The payload is a flat JSON object.
+            self.assertFalse(any(isinstance(v, (dict, list)) for v in payload.values()))
+
+        self.assertEqual(['HELLO_ACK', 'JOB_STATUS'],
+                         [message_type for message_type, _ in without_progress])
+        self.assertNotIn('progress', without_progress[0][1]['capabilities'])
+        self.assertEqual(0, without_progress[-1][1]['exit_code'])
+
+
+    def _create_long_video(self, container_id: str) -> str:
+        """ Creates a video that takes the component several seconds to process. """
+        video_path = self._copy_to_container(get_test_media('hello.avi'), '/root', container_id)
+        long_video_path = '/root/hello-long.avi'
+        ffmpeg_command = ['docker', 'exec', container_id, 'ffmpeg', '-loglevel', 'error',
+                          '-stream_loop', '30', '-i', video_path, '-c', 'copy', long_video_path]
+        subprocess.run(ffmpeg_command, check=True)
+        return long_video_path
+
+
+    def test_video_headers_match_ffprobe(self):
+        self._create_test_videos()
+        video_infos = self._get_video_infos(
+            ('hello.avi', 'ff-region-motion-face-first10-frames.avi', 'hello.mp4', 'hello.mkv',
+             'hello-rotated.mp4'))
+
+        expected_fields = {
+            'hello.avi': (1.0, 3, 3000, 466, 362),
+            'ff-region-motion-face-first10-frames.avi': (30.0, 10, 333.33, 640, 480),
+            'hello.mp4': (1.0, 3, 3000, 466, 362),
+            # Matroska does not store the number of frames, so ffprobe does not report it.
+            'hello.mkv': (1.0, None, 3000, 466, 362),
+            'hello-rotated.mp4': (1.0, 3, 3000, 466, 362)}
+        for video_name, (fps, frame_count, duration_ms, width, height) in expected_fields.items():
+            with self.subTest(video_name=video_name):
+                header_info, ffprobe_info = video_infos[video_name]
+                self.assertIsNotNone(header_info)
+                self.assertAlmostEqual(ffprobe_info['fps'], header_info['fps'])
+                self.assertAlmostEqual(fps, header_info['fps'])
+                self.assertEqual(ffprobe_info['frame_count'], header_info['frame_count'])
+                self.assertEqual(frame_count, header_info['frame_count'])
+                self.assertAlmostEqual(ffprobe_info['duration_ms'], header_info['duration_ms'],
+                                       delta=1)
+                self.assertAlmostEqual(duration_ms, header_info['duration_ms'], delta=1)
+                self.assertEqual(ffprobe_info['width'], header_info['width'])
+                self.assertEqual(width, header_info['width'])
+                self.assertEqual(ffprobe_info['height'], header_info['height'])
+                self.assertEqual(height, header_info['height'])
+                self.assertAlmostEqual(ffprobe_info['rotation'], header_info['rotation'])
+
+        rotation = video_infos['hello-rotated.mp4'][0]['rotation']
+        self.assertIn(rotation, (90, 270))
+        for video_name in expected_fields.keys() - {'hello-rotated.mp4'}:
+            self.assertEqual(0, video_infos[video_name][0]['rotation'])
+
+
+    def test_video_headers_fall_back_to_ffprobe(self):
+        self._create_test_videos()
+        output = self.run_python_in_container((
+            'import json, mpf_cli_media_info, mpf_cli_video_headers',
+            'probed_paths = []',
+            'probe_with_ffprobe = mpf_cli_media_info._probe_video_with_ffprobe',
+            'def record_probe(path):',
+            '    probed_paths.append(path)',
+            '    return probe_with_ffprobe(path)',
+            'mpf_cli_media_info._probe_video_with_ffprobe = record_probe',
+            'results = {}',
+            'for name in ("hello.mp4", "hello-fragmented.mp4", "hello.nut",',
+            '             "hello-truncated.mp4", "hello-truncated.avi"):',
+            '    path = "/root/videos/" + name',
+            '    headers = mpf_cli_video_headers.read_video_headers(path)',
+            '    try:',
+            '        fps = mpf_cli_media_info.probe_video(path).fps',
+            '    except RuntimeError:',
+            '        fps = None',
+            '    results[name] = (headers, path in probed_paths, fps)',
+            'print(json.dumps(results))'))
+        results = json.loads(output)
+
+        headers, used_ffprobe, fps = results['hello.mp4']
+        self.assertIsNotNone(headers)
+        self.assertFalse(used_ffprobe)
+        self.assertEqual(1, fps)
+
+        for video_name in ('hello-fragmented.mp4', 'hello.nut'):
+            with self.subTest(video_name=video_name):
+                headers, used_ffprobe, fps = results[video_name]
+                self.assertIsNone(headers)
+                self.assertTrue(used_ffprobe)
+                self.assertEqual(1, fps)
+
+        # ffprobe may also be unable to read the truncated files, so only check that it was used.
+        for video_name in ('hello-truncated.mp4', 'hello-truncated.avi'):
+            with self.subTest(video_name=video_name):
+                headers, used_ffprobe, _ = results[video_name]
+                self.assertIsNone(headers)
+                self.assertTrue(used_ffprobe)
+
+
+    def test_video_info_cache_probes_changed_videos_again(self):
+        video_path = self._copy_to_container(get_test_media('hello.avi'), '/root')
+        output = self.run_python_in_container((
+            'import json, os, shutil, tempfile, mpf_cli_media_info',
+            'probed_paths = []',
+            'probe_video = mpf_cli_media_info.probe_video',
+            'def record_probe(path):',
+            '    probed_paths.append(path)',
+            '    return probe_video(path)',
+            'mpf_cli_media_info.probe_video = record_probe',
+            'tmp_dir = tempfile.mkdtemp()',
+            'video_path = os.path.join(tmp_dir, "video.avi")',
+            f'shutil.copy("{video_path}", video_path)',
+            'cache_dir = os.path.join(tmp_dir, "cache")',
+            'cache = mpf_cli_media_info.VideoInfoCache(10, cache_dir)',
+            'results = {}',
+            'def get_info(name, cache=cache):',
+            '    num_probes = len(probed_paths)',
+            '    info = cache.get(video_path)._asdict()',
+            '    results[name] = [info, len(probed_paths) > num_probes]',
+            'get_info("first")',
+            'get_info("unchanged")',
+            'stat = os.stat(video_path)',
+            'os.utime(video_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))',
+            'get_info("modified")',
+            'replacement_path = os.path.join(tmp_dir, "replacement.avi")',
+            'shutil.copy(video_path, replacement_path)',
+            'os.utime(replacement_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))',
+            'os.replace(replacement_path, video_path)',
+            'get_info("replaced")',
+            '# A new instance can only get the information from the disk cache.',
+            'get_info("from_disk", mpf_cli_media_info.VideoInfoCache(10, cache_dir))',
+            'cache_file_path = cache._get_disk_path(cache._get_key(video_path))',
+            'with open(cache_file_path, "w") as f:',
+            '    f.write("{not json")',
+            'get_info("corrupt_disk_entry", mpf_cli_media_info.VideoInfoCache(10, cache_dir))',
+            'get_info("rewritten_disk_entry", mpf_cli_media_info.VideoInfoCache(10, cache_dir))',
+            'print(json.dumps(results))'))
+        results = json.loads(output)
+
+        expected_info, probed = results['first']
+        self.assertTrue(probed)
+        self.assertEqual(1, expected_info['fps'])
+        expected_probes = {
+            'unchanged': False,
+            'modified': True,
+            'replaced': True,
+            'from_disk': False,
+            'corrupt_disk_entry': True,
+            'rewritten_disk_entry': False,
+        }
+        for name, expected_probed in expected_probes.items():
+            with self.subTest(name=name):
+                info, probed = results[name]
+                self.assertEqual(expected_info, info)
+                self.assertEqual(expected_probed, probed)
+
+
+    def _create_test_videos(self) -> None:
+        subprocess.run(('docker', 'exec', self._container_id, 'mkdir', '-p', '/root/videos'),
+                       check=True)
+        for video_name in ('hello.avi', 'ff-region-motion-face-first10-frames.avi'):
+            self._copy_to_container(get_test_media(video_name), '/root/videos')
+        # Newer versions of ffmpeg ignore the rotate tag and require -display_rotation instead.
+        script = ' && '.join((
+            'cd /root/videos',
+            'ffmpeg -loglevel error -y -i hello.avi -c:v mpeg4 hello.mp4',
+            'ffmpeg -loglevel error -y -i hello.avi -c:v mpeg4 hello.mkv',
+            'ffmpeg -loglevel error -y -i hello.avi -c:v mpeg4 hello.nut',
+            'ffmpeg -loglevel error -y -i hello.mp4 -c copy '
+            '-movflags frag_keyframe+empty_moov hello-fragmented.mp4',
+            'ffmpeg -loglevel error -y -i hello.mp4 -c copy -movflags +faststart '
+            'hello-faststart.mp4',
+            'head -c 200 hello-faststart.mp4 > hello-truncated.mp4',
+            'head -c 100 hello.avi > hello-truncated.avi',
+            '(ffmpeg -loglevel error -y -display_rotation 90 -i hello.mp4 -c copy '
+            'hello-rotated.mp4 || ffmpeg -loglevel error -y -i hello.mp4 -c copy '
+            '-metadata:s:v:0 rotate=90 hello-rotated.mp4)'))
+        subprocess.run(('docker', 'exec', self._container_id, 'bash', '-c', script), check=True)
+
+
+    def _get_video_infos(self, video_names: Sequence[str]) -> Dict[str, List[Dict[str, Any]]]:
+        """ Gets the header and ffprobe information for each video in /root/videos. """
+        output = self.run_python_in_container((
+            'import json, mpf_cli_media_info, mpf_cli_video_headers',
+            'infos = {}',
+            f'for name in {tuple(video_names)!r}:',
+            '    path = "/root/videos/" + name',
+            '    header_info = mpf_cli_video_headers.read_video_headers(path)',
+            '    infos[name] = [header_info and header_info._asdict(),',
+            '                   mpf_cli_media_info._probe_video_with_ffprobe(path)._asdict()]',
+            'print(json.dumps(infos))'))
+        return json.loads(output)
+
+
     def test_can_run_video_job(self):
         video_file = get_test_media('hello.avi')
         output_object = self.run_cli_runner_stdin_media(video_file, '-', '-t', 'video')